@@ -0,0 +1,67 @@
+"""Compare `fill_holes` with `scipy.ndimage.binary_fill_holes` on synthetic masks.
+
+A synthetic eroded ice mask is mostly ice, split into floes by leads (lines of
+open water) and with holes of open water inside the floes, like the masks
+filled in each round of `identify_floes`. Both functions are timed on masks
+of each size, and their results are checked to be identical.
+
+Usage:
+    python benchmarks/fill_holes.py --sizes 1024 2048 4096 --ice 0.9
+"""
+
+import argparse
+import time
+
+
+def synthetic_mask(size: int, ice: float, seed: int = 0):
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    mask = np.ones((size, size), dtype=np.uint8)
+    # leads, until the requested fraction of open water is reached
+    while np.count_nonzero(mask) > ice * size * size:
+        (x0, y0), (x1, y1) = rng.integers(0, size, (2, 2))
+        thickness = int(rng.integers(1, 6))
+        cv2.line(mask, (int(x0), int(y0)), (int(x1), int(y1)), 0, thickness)
+    # holes inside the floes
+    for _ in range(size * size // 4096):
+        x, y = rng.integers(0, size, 2)
+        cv2.circle(mask, (int(x), int(y)), int(rng.integers(1, 8)), 0, -1)
+    return mask
+
+
+def best_of(repeat: int, fn, *args) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    import numpy as np
+    from scipy import ndimage
+
+    from ebfloeseg.preprocess import fill_holes
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1024, 2048, 4096], help="pixels"
+    )
+    parser.add_argument("--ice", type=float, default=0.9, help="fraction of ice")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'size':>6} {'scipy s':>8} {'fill_holes s':>13} {'speedup':>8}")
+    for size in args.sizes:
+        mask = synthetic_mask(size, args.ice)
+        assert np.array_equal(fill_holes(mask), ndimage.binary_fill_holes(mask))
+        scipy_s = best_of(args.repeat, ndimage.binary_fill_holes, mask)
+        ours_s = best_of(args.repeat, fill_holes, mask)
+        print(f"{size:>6} {scipy_s:>8.3f} {ours_s:>13.4f} {scipy_s / ours_s:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
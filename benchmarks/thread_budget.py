@@ -0,0 +1,109 @@
+"""Compare splits of the cores between worker processes and threads per worker.
+
+A synthetic scene is made by tiling the test images in `tests/process` up to the
+requested size, and a batch of copies of it is processed with each split, the
+way `fsdproc process-batch --max-workers W --threads-per-worker T` does.
+
+Usage:
+    python benchmarks/thread_budget.py --size 2048 --scenes 8
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+
+TEST_DATA = Path(__file__).parents[1] / "tests" / "process"
+
+
+def tile_raster(src_path: Path, dst_path: Path, size: int) -> None:
+    import numpy as np
+    import rasterio
+
+    with rasterio.open(src_path) as src:
+        data = src.read()
+        profile = src.profile
+    reps = (1, -(-size // data.shape[1]), -(-size // data.shape[2]))
+    data = np.tile(data, reps)[:, :size, :size]
+    profile.update(height=size, width=size, compress=None, tiled=False)
+    profile.pop("blockxsize", None)
+    profile.pop("blockysize", None)
+    with rasterio.open(dst_path, "w", **profile) as dst:
+        dst.write(data)
+
+
+def process_scene(ftci, fcloud, fland, save_direc):
+    from ebfloeseg.preprocess import preprocess_b
+
+    preprocess_b(
+        ftci=ftci,
+        fcloud=fcloud,
+        fland=fland,
+        itmax=8,
+        itmin=3,
+        step=-1,
+        erosion_kernel_type="diamond",
+        erosion_kernel_size=1,
+        save_figs=False,
+        save_direc=save_direc,
+        fname_prefix="",
+        date=None,
+    )
+
+
+def candidate_splits(cpus: int) -> list[tuple[int, int]]:
+    threads = [t for t in range(1, cpus + 1) if cpus % t == 0]
+    return [(cpus // t, t) for t in threads]
+
+
+def main():
+    from ebfloeseg.batch import Task, run_tasks
+    from ebfloeseg.threads import set_thread_budget
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=2048, help="scene side, pixels")
+    parser.add_argument("--scenes", type=int, default=None, help="scenes per run")
+    parser.add_argument("--cpus", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    scenes = args.scenes or 2 * args.cpus
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        for name in ["truecolor", "cloud", "landmask"]:
+            tile_raster(TEST_DATA / f"{name}.tiff", tmp / f"{name}.tiff", args.size)
+
+        print(f"{scenes} scenes of {args.size}x{args.size} pixels, {args.cpus} cores")
+        print(f"{'workers':>8} {'threads':>8} {'seconds':>8} {'scenes/min':>11}")
+        for workers, threads in candidate_splits(args.cpus):
+            tasks = [
+                Task(
+                    name=str(i),
+                    fn=process_scene,
+                    args=(
+                        tmp / "truecolor.tiff",
+                        tmp / "cloud.tiff",
+                        tmp / "landmask.tiff",
+                        tmp / f"{workers}x{threads}" / str(i),
+                    ),
+                )
+                for i in range(scenes)
+            ]
+            start = time.perf_counter()
+            results = run_tasks(
+                tasks,
+                max_workers=workers,
+                initializer=set_thread_budget,
+                initargs=(threads,),
+            )
+            elapsed = time.perf_counter() - start
+            failed = sum(result.status != "succeeded" for result in results)
+            note = f"  ({failed} failed)" if failed else ""
+            print(
+                f"{workers:>8} {threads:>8} {elapsed:>8.1f} "
+                f"{60 * scenes / elapsed:>11.1f}{note}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,25 +2,26 @@
 
 import logging
 import tomllib
-from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
+from functools import partial
 from pathlib import Path
 from typing import Annotated, Optional
 
-import pandas
 import typer
 
+# Only lightweight modules are imported here. The numerical stack (cv2, scipy,
+# skimage, rasterio, pandas, matplotlib) is imported inside the commands which
+# need it, so that `fsdproc --help` and the simple commands start quickly.
 from ebfloeseg.bbox import BoundingBox, BoundingBoxParser
-from ebfloeseg.load import (
+from ebfloeseg.dataset import (
     ImageType,
     Satellite,
     ExampleDataSetBeaufortSea as ExampleDataSet,
 )
-from ebfloeseg.load import load as load_
-from ebfloeseg.masking import create_land_mask
-from ebfloeseg.preprocess import preprocess, preprocess_b
+from ebfloeseg.shards import Shard, ShardParser
+from ebfloeseg.window import SceneWindow, WindowUnits
 
 _logger = logging.getLogger(__name__)
 
@@ -81,9 +82,29 @@ def load(
     ts: int = ExampleDataSet.ts,
     format: str = "image/tiff",
     validate: Annotated[bool, typer.Option(help="validate the image")] = True,
+    tile_size: Annotated[
+        Optional[int],
+        typer.Option(
+            help="request larger images as tiles of up to this many pixels, also the tile size of --cache-dir"
+        ),
+    ] = None,
+    max_workers: Annotated[
+        int, typer.Option(help="number of tiles to request at a time")
+    ] = 8,
+    retries: Annotated[
+        int, typer.Option(help="how often to retry each failed request")
+    ] = 0,
+    cache_dir: Annotated[
+        Optional[Path],
+        typer.Option(
+            help="assemble the images from a cache of tiles in this directory"
+        ),
+    ] = None,
 ):
     _logger.debug(locals())
 
+    from ebfloeseg.load import load as load_
+
     result = load_(
         datetime=datetime,
         wrap=wrap,
@@ -95,6 +116,10 @@ def load(
         ts=ts,
         format=format,
         validate=validate,
+        tile_size=tile_size,
+        max_workers=max_workers,
+        retries=retries,
+        cache_dir=cache_dir,
     )
 
     with open(outfile, "wb") as f:
@@ -131,28 +156,274 @@ def process(
         KernelType, typer.Option(..., "--kernel-type")
     ] = KernelType.diamond,
     kernel_size: Annotated[int, typer.Option(..., "--kernel-size")] = 1,
+    coarse_block_size: Annotated[
+        Optional[int],
+        typer.Option(
+            help="skip the ice threshold for blocks of this many pixels without ice"
+        ),
+    ] = None,
+    triage: Annotated[
+        bool,
+        typer.Option(
+            help="skip scenes which are mostly clouded or have too little ice, writing empty outputs"
+        ),
+    ] = False,
+    quicklook: Annotated[
+        Optional[int],
+        typer.Option(
+            help="write quicklook.png, a preview of the scene with every Nth row and column"
+        ),
+    ] = None,
+    stack: Annotated[
+        Optional[Path],
+        typer.Option(
+            help="also append the labels and masks to the stack of the location in this directory"
+        ),
+    ] = None,
     date: Annotated[Optional[datetime], typer.Option()] = None,
+    window: Annotated[
+        Optional[BoundingBox],
+        typer.Option(
+            click_type=BoundingBoxParser(),
+            help="only process this part of the images",
+        ),
+    ] = None,
+    window_units: Annotated[
+        WindowUnits,
+        typer.Option(help="whether the window is in CRS coordinates or pixels"),
+    ] = WindowUnits.crs,
+    threads: Annotated[
+        Optional[int],
+        typer.Option(help="number of threads for OpenCV, OpenMP, BLAS and GDAL"),
+    ] = None,
 ):
     _logger.debug(locals())
 
-    preprocess_b(
-        ftci=truecolorimg,
-        fcloud=cloudimg,
-        fland=landmask,
+    run_process(
+        truecolorimg=truecolorimg,
+        cloudimg=cloudimg,
+        landmask=landmask,
+        outdir=outdir,
+        save_figs=save_figs,
+        out_prefix=out_prefix,
         itmax=itmax,
         itmin=itmin,
         step=step,
-        erosion_kernel_type=kernel_type,
-        erosion_kernel_size=kernel_size,
-        save_figs=save_figs,
-        save_direc=outdir,
-        fname_prefix=out_prefix,
+        kernel_type=kernel_type,
+        kernel_size=kernel_size,
+        coarse_block_size=coarse_block_size,
+        triage=triage,
+        quicklook=quicklook,
+        stack=stack,
         date=date,
+        window=window,
+        window_units=window_units,
+        threads=threads,
     )
 
     return
 
 
+def run_process(
+    truecolorimg: Path,
+    cloudimg: Path,
+    landmask: Path,
+    outdir: Path,
+    save_figs: bool,
+    out_prefix: str,
+    itmax: int,
+    itmin: int,
+    step: int,
+    kernel_type: KernelType,
+    kernel_size: int,
+    coarse_block_size: Optional[int],
+    triage: bool,
+    quicklook: Optional[int],
+    stack: Optional[Path],
+    date: Optional[datetime],
+    window: Optional[BoundingBox],
+    window_units: WindowUnits,
+    threads: Optional[int],
+    cached_masks: bool = False,
+) -> None:
+    """
+    Process a set of images with the parameters of `fsdproc process`.
+
+    Shared by the `process` command and the workers of `fsdproc serve`, which
+    set `cached_masks` to reuse the land mask and its dilation between jobs.
+    """
+    from ebfloeseg.threads import thread_budget
+
+    # the server passes the values click parsed, before typer converted them
+    truecolorimg, cloudimg, landmask, outdir = map(
+        Path, (truecolorimg, cloudimg, landmask, outdir)
+    )
+    kernel_type, window_units = KernelType(kernel_type), WindowUnits(window_units)
+
+    # before importing the libraries, so the limit applies to all of them
+    with thread_budget(threads):
+        from ebfloeseg.preprocess import preprocess_b
+        from ebfloeseg.stack import SceneStack
+        from ebfloeseg.triage import TriageThresholds
+
+        scene_window = None if window is None else SceneWindow(window, window_units)
+        masks = {}
+        if cached_masks:
+            from ebfloeseg.serve import get_land_mask, get_mask_dilation
+
+            masks = dict(
+                land_mask=get_land_mask(landmask, scene_window),
+                mask_dilation=get_mask_dilation(landmask, scene_window),
+            )
+
+        preprocess_b(
+            ftci=truecolorimg,
+            fcloud=cloudimg,
+            fland=landmask,
+            itmax=itmax,
+            itmin=itmin,
+            step=step,
+            erosion_kernel_type=kernel_type,
+            erosion_kernel_size=kernel_size,
+            save_figs=save_figs,
+            save_direc=outdir,
+            fname_prefix=out_prefix,
+            date=date,
+            window=scene_window,
+            coarse_block_size=coarse_block_size,
+            triage=TriageThresholds() if triage else None,
+            quicklook_factor=quicklook,
+            stack=None if stack is None else SceneStack(stack),
+            **masks,
+        )
+
+
+@app.command(
+    help="Download the images of a satellite-day and process them, without temporary files.",
+    epilog=f"Example: {name} run-scene out/ --date 2016-07-01 --satellite aqua",
+)
+def run_scene(
+    outdir: Annotated[Path, typer.Argument()],
+    date: Annotated[datetime, typer.Option(formats=["%Y-%m-%d"])],
+    satellite: Satellite = ExampleDataSet.satellite,
+    bbox: Annotated[
+        BoundingBox,
+        typer.Option(click_type=BoundingBoxParser()),
+    ] = ExampleDataSet.bbox,
+    scale: Annotated[
+        int, typer.Option(help="size of a pixel in units of the bounding box")
+    ] = ExampleDataSet.scale,
+    crs: str = ExampleDataSet.crs,
+    wrap: str = ExampleDataSet.wrap,
+    ts: int = ExampleDataSet.ts,
+    validate: Annotated[bool, typer.Option(help="validate the images")] = True,
+    tile_size: Annotated[
+        Optional[int],
+        typer.Option(
+            help="request larger images as tiles of up to this many pixels, also the tile size of --cache-dir"
+        ),
+    ] = None,
+    retries: Annotated[
+        int, typer.Option(help="how often to retry each failed request")
+    ] = 0,
+    cache_dir: Annotated[
+        Optional[Path],
+        typer.Option(
+            help="assemble the images from a cache of tiles in this directory"
+        ),
+    ] = None,
+    save_figs: Annotated[bool, typer.Option()] = False,
+    save_inputs: Annotated[
+        bool, typer.Option(help="also write the downloaded images")
+    ] = False,
+    out_prefix: Annotated[
+        str, typer.Option(help="string to prepend to filenames")
+    ] = "",
+    itmax: Annotated[
+        int,
+        typer.Option(..., "--itmax", help="maximum number of iterations for erosion"),
+    ] = 8,
+    itmin: Annotated[
+        int,
+        typer.Option(..., "--itmin", help="minimum number of iterations for erosion"),
+    ] = 3,
+    step: Annotated[int, typer.Option(..., "--step")] = -1,
+    kernel_type: Annotated[
+        KernelType, typer.Option(..., "--kernel-type")
+    ] = KernelType.diamond,
+    kernel_size: Annotated[int, typer.Option(..., "--kernel-size")] = 1,
+    coarse_block_size: Annotated[
+        Optional[int],
+        typer.Option(
+            help="skip the ice threshold for blocks of this many pixels without ice"
+        ),
+    ] = None,
+    triage: Annotated[
+        bool,
+        typer.Option(
+            help="skip scenes which are mostly clouded or have too little ice, writing empty outputs"
+        ),
+    ] = False,
+    quicklook: Annotated[
+        Optional[int],
+        typer.Option(
+            help="write quicklook.png, a preview of the scene with every Nth row and column"
+        ),
+    ] = None,
+    stack: Annotated[
+        Optional[Path],
+        typer.Option(
+            help="also append the labels and masks to the stack of the location in this directory"
+        ),
+    ] = None,
+    threads: Annotated[
+        Optional[int],
+        typer.Option(help="number of threads for OpenCV, OpenMP, BLAS and GDAL"),
+    ] = None,
+):
+    _logger.debug(locals())
+
+    if threads is not None:
+        # before importing the libraries, so the limit applies to all of them
+        from ebfloeseg.threads import set_thread_budget
+
+        set_thread_budget(threads)
+
+    from ebfloeseg.preprocess import SegmentationParams
+    from ebfloeseg.run_scene import run_scene as run_scene_
+    from ebfloeseg.stack import SceneStack
+    from ebfloeseg.triage import TriageThresholds
+
+    run_scene_(
+        date=date.date(),
+        save_direc=outdir,
+        satellite=satellite,
+        bbox=bbox,
+        scale=scale,
+        crs=crs,
+        wrap=wrap,
+        ts=ts,
+        params=SegmentationParams(
+            itmax=itmax,
+            itmin=itmin,
+            step=step,
+            erosion_kernel_type=kernel_type,
+            erosion_kernel_size=kernel_size,
+            coarse_block_size=coarse_block_size,
+            triage=TriageThresholds() if triage else None,
+        ),
+        save_figs=save_figs,
+        save_inputs=save_inputs,
+        fname_prefix=out_prefix,
+        validate=validate,
+        tile_size=tile_size,
+        retries=retries,
+        cache_dir=cache_dir,
+        quicklook_factor=quicklook,
+        stack=None if stack is None else SceneStack(stack),
+    )
+
+
 @dataclass
 class ConfigParams:
     data_direc: Path
@@ -164,6 +435,11 @@ class ConfigParams:
     step: int
     kernel_type: str
     kernel_size: int
+    window: Optional[SceneWindow] = None
+    triage: Optional[dict] = None  # the arguments of TriageThresholds
+    quicklook: Optional[int] = None
+    stack_direc: Optional[Path] = None
+    coarse_block_size: Optional[int] = None
 
 
 def validate_kernel_type(ctx: typer.Context, value: str) -> str:
@@ -190,6 +466,12 @@ def parse_config_file(config_file: Path) -> ConfigParams:
         "step": -1,
         "kernel_type": "diamond",  # type of kernel (either diamond or ellipse)
         "kernel_size": 1,
+        "window": None,  # only process this part of the images, [x1, y1, x2, y2]
+        "window_units": "crs",  # units of the window (either crs or pixel)
+        "triage": None,  # thresholds to skip unusable scenes, see TriageThresholds
+        "quicklook": None,  # decimation factor of the preview of each scene
+        "stack_direc": None,  # directory of a stack to append the rasters to
+        "coarse_block_size": None,  # pixels of the blocks of the coarse pass
     }
 
     erosion = config["erosion"]
@@ -203,6 +485,10 @@ def parse_config_file(config_file: Path) -> ConfigParams:
                 value = Path(value)
             defaults[key] = value
 
+    window_units = defaults.pop("window_units")
+    if defaults["window"] is not None:
+        defaults["window"] = SceneWindow(defaults["window"], window_units)
+
     return ConfigParams(**defaults)
 
 
@@ -219,11 +505,72 @@ def process_batch(
     ),
     max_workers: Optional[int] = typer.Option(
         None,
-        help="The maximum number of workers. If None, uses all available processors.",
+        help="The maximum number of workers. If None, uses all available processors divided by --threads-per-worker.",
+    ),
+    threads_per_worker: Optional[int] = typer.Option(
+        None,
+        help="Threads for OpenCV, OpenMP, BLAS and GDAL in each worker. If None, the available processors divided by --max-workers, or 1.",
+    ),
+    timeout: Optional[float] = typer.Option(
+        None,
+        help="Maximum time in seconds for one scene. The worker is killed if it takes longer.",
+    ),
+    retries: int = typer.Option(
+        0, help="How often to retry a scene which failed or timed out."
+    ),
+    continue_on_error: bool = typer.Option(
+        False, help="Carry on processing the other scenes when a scene fails."
+    ),
+    memory_budget: Optional[float] = typer.Option(
+        None,
+        help="Memory in GiB the scenes processed at the same time may use together.",
+    ),
+    max_tasks_per_worker: Optional[int] = typer.Option(
+        None, help="Replace each worker after it has processed this many scenes."
+    ),
+    max_worker_memory: Optional[float] = typer.Option(
+        None,
+        help="Replace a worker once its resident memory exceeds this many GiB.",
+    ),
+    report: Optional[Path] = typer.Option(
+        None,
+        help="Path for the JSON report of the batch. Defaults to batch_report.json in the save directory, or batch_report.shard-I-of-N.json with --shard.",
+    ),
+    shard: Annotated[
+        Optional[Shard],
+        typer.Option(
+            click_type=ShardParser(),
+            help="Only process part I of N (counting from 0) of the scenes, e.g. one task of an array job. Combine the outputs with merge.",
+        ),
+    ] = None,
+    queue_dir: Optional[Path] = typer.Option(
+        None,
+        help="Take the scenes from a queue in this directory, shared with other process-batch commands on any node, until all are processed.",
+    ),
+    lease_duration: float = typer.Option(
+        600.0,
+        help="Seconds after which the scenes claimed from --queue-dir by a process which died are taken over by others.",
     ),
 ):
     _logger.debug(locals())
 
+    if shard is not None and queue_dir is not None:
+        raise typer.BadParameter("--shard and --queue-dir can't be used together")
+
+    from ebfloeseg.threads import set_thread_budget, split_cores
+
+    # split the cores between the workers and their threads, and apply the limit
+    # before importing the libraries, so that the workers inherit it
+    max_workers, threads_per_worker = split_cores(max_workers, threads_per_worker)
+    set_thread_budget(threads_per_worker)
+
+    from ebfloeseg.batch import Task, run_tasks, write_report
+    from ebfloeseg.masking import MaskDilation, create_land_mask
+    from ebfloeseg.preprocess import preprocess
+    from ebfloeseg.scenes import index_scenes, longest_first, shard_scenes
+    from ebfloeseg.stack import SceneStack
+    from ebfloeseg.triage import TriageThresholds
+
     args = parse_config_file(config_file)
 
     save_direc = args.save_direc
@@ -233,26 +580,40 @@ def process_batch(
 
     # ## land mask
     # this is the same landmask as the original IFT- can be downloaded w SOIT
-    land_mask = create_land_mask(args.land)
+    land_mask = create_land_mask(args.land, window=args.window)
+    # the dilated land mask is the same for every scene
+    mask_dilation = MaskDilation(land_mask)
 
     # ## load files
-    data_direc = args.data_direc
-    ftci_direc = data_direc / "tci/"
-    fcloud_direc = data_direc / "cloud/"
+    # pair the true-color and cloud images by their date and satellite
+    scenes = index_scenes(args.data_direc, window=args.window)
+    if shard is not None:
+        scenes = shard_scenes(scenes, shard.index, shard.count)
+        _logger.info("shard %s/%s has %s scenes", *shard, len(scenes))
 
     # option to save figs after each step
     save_figs = args.save_figs
 
-    ftcis = sorted(Path(ftci_direc).iterdir())
-    fclouds = sorted(Path(fcloud_direc).iterdir())
+    # skip unusable scenes, if the config has a [triage] table
+    triage = None if args.triage is None else TriageThresholds(**args.triage)
 
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = []
-        for ftci, fcloud in zip(ftcis, fclouds):
-            future = executor.submit(
+    # append the rasters of every scene to a stack, if the config names one
+    stack = None if args.stack_direc is None else SceneStack(args.stack_direc)
+
+    def make_task(item: dict) -> Task:
+        return Task(
+            name=Path(item["fcloud"]).name,
+            fn=partial(
                 preprocess,
-                ftci,
-                fcloud,
+                mask_dilation=mask_dilation,
+                triage=triage,
+                coarse_block_size=args.coarse_block_size,
+                quicklook_factor=args.quicklook,
+                stack=stack,
+            ),
+            args=(
+                Path(item["ftci"]),
+                Path(item["fcloud"]),
                 land_mask,
                 args.itmax,
                 args.itmin,
@@ -261,12 +622,271 @@ def process_batch(
                 args.kernel_size,
                 save_figs,
                 save_direc,
-            )
-            futures.append(future)
+                args.window,
+            ),
+            info={
+                key: item[key] for key in ("ftci", "fcloud", "year", "doy", "satellite")
+            },
+            size=item["pixels"],
+        )
+
+    # submit the most expensive scenes first so no worker is left idle at the end
+    items = [
+        {
+            "ftci": str(scene.ftci),
+            "fcloud": str(scene.fcloud),
+            "year": scene.year,
+            "doy": scene.doy,
+            "satellite": scene.sat,
+            "pixels": scene.pixels,
+            "cost": scene.estimated_cost,
+        }
+        for scene in longest_first(scenes)
+    ]
+
+    run_kwargs = dict(
+        max_workers=max_workers,
+        timeout=timeout,
+        retries=retries,
+        continue_on_error=continue_on_error,
+        memory_budget=None if memory_budget is None else int(memory_budget * 2**30),
+        max_tasks_per_worker=max_tasks_per_worker,
+        max_worker_memory=(
+            None if max_worker_memory is None else int(max_worker_memory * 2**30)
+        ),
+        initializer=set_thread_budget,
+        initargs=(threads_per_worker,),
+    )
+
+    if queue_dir is not None:
+        from ebfloeseg.workqueue import WorkQueue, process_queue, write_queue_report
+
+        queue = WorkQueue(queue_dir, lease_duration=lease_duration)
+        for item in items:
+            queue.add("%s_%s_%s" % (item["year"], item["doy"], item["satellite"]), item)
+        results = process_queue(queue, make_task, **run_kwargs)
+        if queue.remaining():
+            raise typer.Exit(code=1)  # stopped after a failure
+        merged = write_queue_report(queue, report or save_direc / "batch_report.json")
+        if merged["summary"]["succeeded"] != len(merged["tasks"]):
+            raise typer.Exit(code=1)
+        return
+
+    results = run_tasks([make_task(item) for item in items], **run_kwargs)
+
+    if shard is None:
+        write_report(results, report or save_direc / "batch_report.json")
+    else:
+        write_report(
+            results, report or save_direc / shard.report_name, shard=shard._asdict()
+        )
+
+    if any(result.status != "succeeded" for result in results):
+        raise typer.Exit(code=1)
+
+
+@app.command(help="Combine the outputs of the shards of process-batch.")
+def merge(
+    shard_direcs: Annotated[
+        list[Path],
+        typer.Argument(
+            help="save directories of the shards", exists=True, metavar="DIRECS..."
+        ),
+    ],
+    save_direc: Annotated[
+        Path, typer.Option(help="directory for the combined outputs")
+    ],
+):
+    _logger.debug(locals())
+
+    from ebfloeseg.shards import merge_shards
+
+    try:
+        merged = merge_shards(shard_direcs, save_direc)
+    except ValueError as e:
+        raise typer.BadParameter(str(e))
+
+    _logger.info("merged %s", merged["summary"])
+    if merged["summary"]["succeeded"] != len(merged["tasks"]):
+        raise typer.Exit(code=1)
+
+
+@app.command(
+    help="Compare the floes of two label images, or of two output directories.",
+    epilog=f"Example: {name} compare reference/ candidate/ --report compare.json",
+)
+def compare(
+    reference: Annotated[
+        Path, typer.Argument(help="reference final.tif, or directory", exists=True)
+    ],
+    candidate: Annotated[
+        Path, typer.Argument(help="candidate final.tif, or directory", exists=True)
+    ],
+    min_iou: Annotated[float, typer.Option(help="smallest IoU of matched floes")] = 0.5,
+    max_mismatch: Annotated[
+        float, typer.Option(help="largest fraction of floes which aren't matched")
+    ] = 0.0,
+    max_iou_loss: Annotated[
+        float, typer.Option(help="largest 1 - IoU of matched floes")
+    ] = 0.0,
+    max_property_delta: Annotated[
+        float,
+        typer.Option(help="largest relative difference of the props of matched floes"),
+    ] = 1e-6,
+    report: Annotated[
+        Optional[Path], typer.Option(help="write the comparison as JSON")
+    ] = None,
+):
+    _logger.debug(locals())
+
+    from ebfloeseg.compare import Tolerances, compare_outputs, write_comparison_report
+
+    if reference.is_dir() != candidate.is_dir():
+        raise typer.BadParameter("compare two files or two directories")
+    tolerances = Tolerances(max_mismatch, max_iou_loss, max_property_delta)
+    comparisons = compare_outputs(reference, candidate, min_iou, tolerances)
+    if report is not None:
+        write_comparison_report(comparisons, report)
+
+    for comparison in comparisons:
+        if comparison.labels is not None:
+            summary = comparison.labels.summary()
+            counts = ", ".join("%s %s" % item for item in summary.items())
+            typer.echo("%s: %s" % (comparison.candidate, counts))
+        for violation in comparison.violations:
+            typer.echo("%s: %s" % (comparison.candidate, violation), err=True)
+    if any(comparison.violations for comparison in comparisons):
+        raise typer.Exit(code=1)
+
+
+@app.command(
+    help="Index the floes of the props tables in output directories by location and date.",
+    epilog=f"Example: {name} index out/ --index floes.sqlite",
+)
+def index(
+    direcs: Annotated[
+        list[Path],
+        typer.Argument(
+            help="output directories of process-batch", exists=True, metavar="DIRECS..."
+        ),
+    ],
+    index: Annotated[
+        Path, typer.Option(help="the index, created if it doesn't exist")
+    ] = Path("floes.sqlite"),
+):
+    _logger.debug(locals())
+
+    from ebfloeseg.floeindex import FloeIndex
+
+    with FloeIndex(index) as floe_index:
+        try:
+            summary = floe_index.update(direcs)
+        except ValueError as e:
+            raise typer.BadParameter(str(e))
+    typer.echo(", ".join("%s %s" % item for item in summary.items()))
+
+
+@app.command(
+    help="Find the floes of an index in a region and date range.",
+    epilog=f"Example: {name} query floes.sqlite --bbox -1700000,100000,-1600000,200000 --start 2012-06-01 --end 2012-06-30",
+)
+def query(
+    index: Annotated[Path, typer.Argument(help="the index", exists=True)],
+    bbox: Annotated[
+        BoundingBox,
+        typer.Option(
+            click_type=BoundingBoxParser(), help="the region, in the CRS of the index"
+        ),
+    ],
+    start: Annotated[
+        Optional[datetime], typer.Option(formats=["%Y-%m-%d"], help="first day")
+    ] = None,
+    end: Annotated[
+        Optional[datetime], typer.Option(formats=["%Y-%m-%d"], help="last day")
+    ] = None,
+    satellite: Optional[Satellite] = None,
+    centroid: Annotated[
+        bool,
+        typer.Option(
+            help="find the floes whose centroid is in the region, rather than whose bounding box overlaps it"
+        ),
+    ] = False,
+    output: Annotated[
+        Optional[Path],
+        typer.Option(help="write the floes as CSV, instead of printing them"),
+    ] = None,
+):
+    _logger.debug(locals())
+
+    from ebfloeseg.floeindex import FloeIndex
+
+    with FloeIndex(index) as floe_index:
+        floes = floe_index.query(
+            bbox,
+            start=None if start is None else start.date(),
+            end=None if end is None else end.date(),
+            satellite=None if satellite is None else satellite.value,
+            by="centroid" if centroid else "bbox",
+        )
+    if output is None:
+        typer.echo(floes.to_csv(index=False), nl=False)
+    else:
+        floes.to_csv(output, index=False)
+        _logger.info("wrote %s floes to %s", len(floes), output)
+
+
+@app.command(help="Start a local server whose warm workers run submitted jobs.")
+def serve(
+    socket: Annotated[
+        Optional[Path],
+        typer.Option(
+            help="Unix socket to listen on. Defaults to fsdproc-UID/serve.sock in $XDG_RUNTIME_DIR, or in the temporary directory, where fsdproc-UID is only accessible by the user."
+        ),
+    ] = None,
+    max_workers: Optional[int] = typer.Option(
+        None,
+        help="The maximum number of workers. If None, uses all available processors divided by --threads-per-worker.",
+    ),
+    threads_per_worker: Optional[int] = typer.Option(
+        None,
+        help="Threads for OpenCV, OpenMP, BLAS and GDAL in each worker. If None, the available processors divided by --max-workers, or 1.",
+    ),
+):
+    _logger.debug(locals())
+
+    from ebfloeseg.serve import serve as serve_
+    from ebfloeseg.threads import split_cores
+
+    max_workers, threads_per_worker = split_cores(max_workers, threads_per_worker)
+    serve_(
+        socket_path=socket,
+        max_workers=max_workers,
+        threads_per_worker=threads_per_worker,
+    )
+
+
+@app.command(
+    help="Submit a `process` or `load` job to a running server and wait for it.",
+    epilog=f"Example: {name} submit process tci.tiff cloud.tiff land.tiff out/ --itmax 5",
+    context_settings={"allow_extra_args": True, "ignore_unknown_options": True},
+)
+def submit(
+    ctx: typer.Context,
+    command: Annotated[str, typer.Argument(help="either 'process' or 'load'")],
+    socket: Annotated[
+        Optional[Path],
+        typer.Option(help="Unix socket of the server, as given to `fsdproc serve`."),
+    ] = None,
+):
+    _logger.debug(locals())
+
+    from ebfloeseg.serve import submit as submit_
 
-        # Wait for all threads to complete
-        for future in futures:
-            future.result()
+    result = submit_(command, ctx.args, socket_path=socket)
+    _logger.info(result)
+    if result["status"] != "succeeded":
+        typer.echo("job failed: %s" % result.get("error"), err=True)
+        raise typer.Exit(code=1)
 
 
 @app.command(help="Get the bounding box x1, y1, x2, y2 from a CSV file.")
@@ -282,6 +902,7 @@ def get_bbox(
     ],
     separator: Annotated[str, typer.Option()] = ",",
 ):
+    import pandas
 
     df = pandas.read_csv(datafile, index_col=index_col)
     output = separator.join(str(s) for s in list(df.loc[index][colnames]))
@@ -0,0 +1,338 @@
+"""Fault-tolerant execution of batches of scenes.
+
+Each scene runs in one of a pool of worker processes. Unlike a
+`ProcessPoolExecutor`, a worker which exceeds the per-scene timeout (or dies)
+is killed and replaced without affecting the other scenes, failed scenes can be
+retried, and the outcome of every scene is recorded.
+
+Scenes are only started while their estimated memory fits into a memory budget,
+and workers can be replaced after a number of scenes or once they use too much
+memory, so that all cores can be used without running out of memory.
+"""
+
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import traceback
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from logging import getLogger
+from multiprocessing.connection import wait
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+logger = getLogger(__name__)
+
+# Rough peak memory of processing one pixel of a scene, in bytes, used until
+# the memory of finished scenes has been measured. `_preprocess` keeps around
+# a dozen full-size arrays of up to 8 bytes per pixel.
+DEFAULT_BYTES_PER_PIXEL = 100
+
+
+@dataclass
+class Task:
+    """A function call to run in a worker, e.g. processing one scene."""
+
+    name: str
+    fn: Callable
+    args: tuple = ()
+    info: dict[str, Any] = field(default_factory=dict)  # recorded in the report
+    size: int = 0  # e.g. number of pixels, used to estimate the memory needed
+
+
+@dataclass
+class TaskResult:
+    name: str
+    status: str  # "succeeded", "failed", "timed_out" or "cancelled"
+    attempts: int = 0
+    duration: Optional[float] = None  # of the last attempt, in seconds
+    error: Optional[str] = None
+    traceback: Optional[str] = None
+    peak_memory: Optional[int] = None  # peak resident memory of the worker, bytes
+    info: dict[str, Any] = field(default_factory=dict)
+
+
+def _memory_usage() -> tuple[int, int]:
+    """Get the current and peak resident memory of this process, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak *= 1 if sys.platform == "darwin" else 1024
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        current = peak
+    return current, peak
+
+
+def _worker_main(conn, initializer, initargs) -> None:
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        fn, args = message
+        before, _ = _memory_usage()
+        try:
+            fn(*args)
+        except Exception as e:
+            status, error, trace = (
+                "failed",
+                repr(e),
+                "".join(traceback.format_exception(e)),
+            )
+        else:
+            status, error, trace = "succeeded", None, None
+        conn.send((status, error, trace, (before, *_memory_usage())))
+    conn.close()
+
+
+class _Worker:
+    def __init__(self, context, initializer=None, initargs=()):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_conn, initializer, initargs),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.task: Optional[Task] = None
+        self.attempt = 0
+        self.started = 0.0
+        self.tasks_done = 0
+        self.last_size = 0
+
+    def submit(self, task: Task, attempt: int) -> None:
+        self.task = task
+        self.attempt = attempt
+        self.started = time.monotonic()
+        self.conn.send((task.fn, task.args))
+
+    def done(self) -> tuple[Task, int, float]:
+        task, attempt = self.task, self.attempt
+        self.task = None
+        self.tasks_done += 1
+        self.last_size = task.size
+        return task, attempt, time.monotonic() - self.started
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self) -> None:
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join()
+        self.conn.close()
+
+
+def run_tasks(
+    tasks: list[Task],
+    max_workers: Optional[int] = None,
+    timeout: Optional[float] = None,
+    retries: int = 0,
+    continue_on_error: bool = False,
+    memory_budget: Optional[int] = None,
+    bytes_per_unit: float = DEFAULT_BYTES_PER_PIXEL,
+    max_tasks_per_worker: Optional[int] = None,
+    max_worker_memory: Optional[int] = None,
+    initializer: Optional[Callable] = None,
+    initargs: tuple = (),
+    claim: Optional[Callable[[], Optional[Task]]] = None,
+    on_result: Optional[Callable[[Task, TaskResult], None]] = None,
+) -> list[TaskResult]:
+    """
+    Run the tasks in a pool of worker processes, in the order given.
+
+    Args:
+        tasks (list[Task]): The tasks.
+        max_workers (int, optional): Number of workers. Defaults to the number of CPUs.
+        timeout (float, optional): Wall-clock limit for one attempt at a task, in
+            seconds. The worker running a task which exceeds it is killed and
+            replaced.
+        retries (int): How often a failed or timed-out task is tried again.
+        continue_on_error (bool): Whether to carry on with the remaining tasks
+            after a task has finally failed. Otherwise no further tasks are
+            started, and they are reported as "cancelled".
+        memory_budget (int, optional): Bytes of memory the running tasks may use
+            together, on top of the memory of the idle workers. A task is only
+            started if its estimated memory fits into what is left of the
+            budget, or if no other task is running.
+        bytes_per_unit (float): Initial estimate of the memory needed per unit of
+            `Task.size`. Once tasks have finished, the largest measured growth
+            of a worker's peak memory per unit is used instead.
+        max_tasks_per_worker (int, optional): Replace workers after this many tasks.
+        max_worker_memory (int, optional): Replace workers whose resident memory
+            exceeds this many bytes after a task.
+        initializer (Callable, optional): Called with `initargs` in each new worker,
+            e.g. to limit the threads it uses.
+        claim (Callable, optional): Called for another task whenever a worker is
+            free and no tasks are pending, e.g. to take tasks from a shared
+            queue. Returns None if there is no task to run for now.
+        on_result (Callable, optional): Called with each task and its final
+            result, including tasks which were cancelled.
+
+    Returns:
+        list[TaskResult]: The outcome of each task, in the order of `tasks`,
+            followed by the claimed tasks in the order they were claimed.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    context = multiprocessing.get_context()
+
+    tasks = list(tasks)
+    pending = deque((task, 1) for task in tasks)
+    results: dict[int, TaskResult] = {}
+    workers: list[_Worker] = []
+    stopping = False
+    measured_bytes_per_unit = None
+
+    def estimated_memory(task: Task) -> float:
+        return task.size * (measured_bytes_per_unit or bytes_per_unit)
+
+    def next_admissible(running: list[_Worker]) -> Optional[int]:
+        """Index of the first pending task which fits into the memory budget."""
+        if memory_budget is None or not running:
+            return 0
+        available = memory_budget - sum(estimated_memory(w.task) for w in running)
+        for i, (task, _) in enumerate(pending):
+            if estimated_memory(task) <= available:
+                return i
+        return None
+
+    def finish(worker, status, error=None, trace=None, peak_memory=None):
+        nonlocal stopping
+        task, attempt, duration = worker.done()
+        if status != "succeeded" and attempt <= retries:
+            logger.warning("%s %s (attempt %s), retrying", task.name, status, attempt)
+            pending.appendleft((task, attempt + 1))
+            return
+        if status != "succeeded":
+            logger.error("%s %s: %s", task.name, status, error)
+            stopping = stopping or not continue_on_error
+        results[id(task)] = TaskResult(
+            name=task.name,
+            status=status,
+            attempts=attempt,
+            duration=duration,
+            error=error,
+            traceback=trace,
+            peak_memory=peak_memory,
+            info=task.info,
+        )
+        if on_result is not None:
+            on_result(task, results[id(task)])
+
+    def recycle(worker, memory) -> None:
+        nonlocal measured_bytes_per_unit
+        before, current, peak = memory
+        if worker.last_size and peak > before:
+            # the peak may be from an earlier task, so this errs on the large side
+            measured = (peak - before) / worker.last_size
+            measured_bytes_per_unit = max(measured_bytes_per_unit or 0, measured)
+        if (
+            max_tasks_per_worker is not None
+            and worker.tasks_done >= max_tasks_per_worker
+        ) or (max_worker_memory is not None and current > max_worker_memory):
+            logger.info("replacing worker %s", worker.process.pid)
+            worker.stop()
+            workers.remove(worker)
+
+    try:
+        while True:
+            while (pending or claim is not None) and not stopping:
+                worker = next((w for w in workers if w.task is None), None)
+                if worker is None and len(workers) < max_workers:
+                    worker = _Worker(context, initializer, initargs)
+                    workers.append(worker)
+                if worker is None:
+                    break
+                if not pending:
+                    claimed = claim()
+                    if claimed is None:
+                        break
+                    tasks.append(claimed)
+                    pending.append((claimed, 1))
+                index = next_admissible([w for w in workers if w.task is not None])
+                if index is None:
+                    break
+                task, attempt = pending[index]
+                del pending[index]
+                logger.info("starting %s (attempt %s)", task.name, attempt)
+                worker.submit(task, attempt)
+
+            busy = [w for w in workers if w.task is not None]
+            if not busy:
+                break
+
+            wait_timeout = None
+            if timeout is not None:
+                next_deadline = min(w.started for w in busy) + timeout
+                wait_timeout = max(0.0, next_deadline - time.monotonic())
+            ready = wait([w.conn for w in busy], timeout=wait_timeout)
+
+            for worker in busy:
+                if worker.conn in ready:
+                    try:
+                        status, error, trace, memory = worker.conn.recv()
+                    except (EOFError, OSError):
+                        worker.kill()
+                        workers.remove(worker)
+                        error = "worker exited with code %s" % worker.process.exitcode
+                        finish(worker, "failed", error)
+                        continue
+                    finish(worker, status, error, trace, peak_memory=memory[2])
+                    recycle(worker, memory)
+                elif (
+                    timeout is not None and time.monotonic() - worker.started >= timeout
+                ):
+                    worker.kill()
+                    workers.remove(worker)
+                    finish(worker, "timed_out", "exceeded %s seconds" % timeout)
+    finally:
+        for worker in workers:
+            if worker.task is None:
+                worker.stop()
+            else:
+                worker.kill()
+
+    for task in tasks:
+        if id(task) not in results:
+            results[id(task)] = TaskResult(
+                name=task.name, status="cancelled", info=task.info
+            )
+            if on_result is not None:
+                on_result(task, results[id(task)])
+
+    return [results[id(task)] for task in tasks]
+
+
+def make_report(tasks: list[dict], **metadata) -> dict:
+    """Summarize the outcomes of tasks, given as dicts, by the number of tasks per status."""
+    return {
+        "summary": {
+            status: sum(task["status"] == status for task in tasks)
+            for status in ("succeeded", "failed", "timed_out", "cancelled")
+        },
+        **metadata,
+        "tasks": tasks,
+    }
+
+
+def write_report(results: list[TaskResult], path: Path, **metadata) -> None:
+    """Write the outcome of each task as JSON, with the number of tasks per status.
+
+    Any `metadata` is written alongside the summary.
+    """
+    report = make_report([asdict(result) for result in results], **metadata)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, default=str)
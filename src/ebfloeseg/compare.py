@@ -0,0 +1,378 @@
+"""Comparing the floes found by two runs, e.g. before and after a change.
+
+Floes are matched by the overlap of their labels, so the comparison doesn't
+depend on how the floes are numbered.
+"""
+
+import json
+from dataclasses import dataclass, field
+from logging import getLogger
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from numpy.typing import NDArray
+
+logger = getLogger(__name__)
+
+# Columns of the props table which aren't compared between matched floes.
+IGNORED_PROPS = ("Unnamed: 0", "label")
+
+
+@dataclass
+class LabelComparison:
+    """
+    The floes of a candidate label image, matched to those of a reference.
+
+    A reference floe and a candidate floe are matched if each overlaps the
+    other more than any other floe, and their IoU is at least the threshold.
+    Of the floes which aren't matched, a reference floe is split if several
+    candidate floes overlap it the most, a candidate floe merges reference
+    floes if several of them overlap it the most, and the rest are missing
+    from the candidate or added to it.
+    """
+
+    reference_floes: int
+    candidate_floes: int
+    matched: NDArray  # (n, 2) reference and candidate labels
+    iou: NDArray  # of each matched pair
+    split: NDArray  # reference labels
+    merged: NDArray  # candidate labels
+    missing: NDArray  # reference labels
+    added: NDArray  # candidate labels
+
+    @property
+    def mismatch(self) -> float:
+        """Fraction of the floes of both images which aren't matched."""
+        total = self.reference_floes + self.candidate_floes
+        return 1 - 2 * len(self.matched) / total if total else 0.0
+
+    def summary(self) -> dict:
+        return {
+            "reference_floes": self.reference_floes,
+            "candidate_floes": self.candidate_floes,
+            "matched": len(self.matched),
+            "split": len(self.split),
+            "merged": len(self.merged),
+            "missing": len(self.missing),
+            "added": len(self.added),
+            "mismatch": self.mismatch,
+            "mean_iou": float(self.iou.mean()) if len(self.iou) else None,
+            "min_iou": float(self.iou.min()) if len(self.iou) else None,
+        }
+
+
+def _best_partner(labels, partners, overlap, size):
+    """For each label, the partner with the largest overlap (0 if none)."""
+    best = np.zeros(size, dtype=np.int64)
+    # after sorting by label and overlap, the last pair of each label is its best
+    order = np.lexsort((overlap, labels))
+    best[labels[order]] = partners[order]
+    return best
+
+
+def compare_labels(
+    reference: NDArray, candidate: NDArray, min_iou: float = 0.5
+) -> LabelComparison:
+    """
+    Match the floes of two label images of the same scene.
+
+    The overlaps of all pairs of floes come from a single joint histogram of
+    the label pairs of the pixels, so this takes a few seconds even for scenes
+    with 100k floes.
+
+    Args:
+        reference (NDArray): The reference labels, 0 for no floe.
+        candidate (NDArray): The candidate labels, 0 for no floe.
+        min_iou (float): The smallest intersection over union of matched floes.
+
+    Returns:
+        LabelComparison: The matched and unmatched floes.
+
+    Examples:
+        >>> reference = np.array([[1, 1, 0, 2, 2, 0, 3, 3, 3, 3, 3, 3]])
+        >>> candidate = np.array([[5, 5, 0, 0, 0, 0, 6, 6, 7, 7, 8, 8]])
+        >>> comparison = compare_labels(reference, candidate)
+        >>> comparison.matched.tolist(), comparison.split.tolist()
+        ([[1, 5]], [3])
+        >>> comparison.missing.tolist(), comparison.added.tolist()
+        ([2], [])
+    """
+    if reference.shape != candidate.shape:
+        msg = "the label images have different shapes %s and %s" % (
+            reference.shape,
+            candidate.shape,
+        )
+        raise ValueError(msg)
+    reference = reference.astype(np.int64, copy=False).ravel()
+    candidate = candidate.astype(np.int64, copy=False).ravel()
+    if reference.min(initial=0) < 0 or candidate.min(initial=0) < 0:
+        raise ValueError("labels must not be negative")
+
+    reference_area = np.bincount(reference)
+    candidate_area = np.bincount(candidate)
+    reference_area[0] = candidate_area[0] = 0
+    reference_labels = np.flatnonzero(reference_area)
+    candidate_labels = np.flatnonzero(candidate_area)
+
+    # joint histogram of the label pairs of the pixels covered by both
+    both = (reference > 0) & (candidate > 0)
+    stride = len(candidate_area)
+    pairs, overlap = np.unique(
+        reference[both] * stride + candidate[both], return_counts=True
+    )
+    pair_reference, pair_candidate = np.divmod(pairs, stride)
+    iou = overlap / (
+        reference_area[pair_reference] + candidate_area[pair_candidate] - overlap
+    )
+
+    best_candidate = _best_partner(
+        pair_reference, pair_candidate, overlap, len(reference_area)
+    )
+    best_reference = _best_partner(
+        pair_candidate, pair_reference, overlap, len(candidate_area)
+    )
+
+    is_match = (
+        (best_candidate[pair_reference] == pair_candidate)
+        & (best_reference[pair_candidate] == pair_reference)
+        & (iou >= min_iou)
+    )
+    matched = np.stack([pair_reference[is_match], pair_candidate[is_match]], axis=1)
+    reference_matched = np.zeros(len(reference_area), dtype=bool)
+    reference_matched[matched[:, 0]] = True
+    candidate_matched = np.zeros(len(candidate_area), dtype=bool)
+    candidate_matched[matched[:, 1]] = True
+
+    # how many unmatched floes of the other image overlap each floe the most
+    unmatched_candidates = candidate_labels[~candidate_matched[candidate_labels]]
+    unmatched_references = reference_labels[~reference_matched[reference_labels]]
+    pieces = np.bincount(
+        best_reference[unmatched_candidates], minlength=len(reference_area)
+    )
+    parts = np.bincount(
+        best_candidate[unmatched_references], minlength=len(candidate_area)
+    )
+    pieces[0] = parts[0] = 0
+
+    split = unmatched_references[pieces[unmatched_references] >= 2]
+    merged = unmatched_candidates[parts[unmatched_candidates] >= 2]
+    is_split = np.zeros(len(reference_area), dtype=bool)
+    is_split[split] = True
+    is_merged = np.zeros(len(candidate_area), dtype=bool)
+    is_merged[merged] = True
+    missing = unmatched_references[
+        ~is_split[unmatched_references]
+        & ~is_merged[best_candidate[unmatched_references]]
+    ]
+    added = unmatched_candidates[
+        ~is_merged[unmatched_candidates]
+        & ~is_split[best_reference[unmatched_candidates]]
+    ]
+
+    return LabelComparison(
+        reference_floes=len(reference_labels),
+        candidate_floes=len(candidate_labels),
+        matched=matched,
+        iou=iou[is_match],
+        split=split,
+        merged=merged,
+        missing=missing,
+        added=added,
+    )
+
+
+def compare_props(
+    reference: pd.DataFrame, candidate: pd.DataFrame, matched: NDArray
+) -> pd.DataFrame:
+    """
+    Compare the properties of matched floes.
+
+    Args:
+        reference (pd.DataFrame): The props table of the reference, with a
+            "label" column.
+        candidate (pd.DataFrame): The props table of the candidate.
+        matched (NDArray): The (n, 2) reference and candidate labels of the
+            matched floes.
+
+    Returns:
+        pd.DataFrame: For each numerical property, the mean and largest
+            absolute difference, and the largest difference relative to the
+            reference value.
+    """
+    pairs = pd.DataFrame(matched, columns=["label", "candidate_label"])
+    both = pairs.merge(reference, on="label").merge(
+        candidate,
+        left_on="candidate_label",
+        right_on="label",
+        suffixes=("", "_candidate"),
+    )
+    rows = []
+    for column in reference.select_dtypes("number").columns:
+        if column in IGNORED_PROPS or f"{column}_candidate" not in both:
+            continue
+        ref = both[column].to_numpy(dtype=float)
+        delta = np.abs(both[f"{column}_candidate"].to_numpy(dtype=float) - ref)
+        relative = delta / np.maximum(np.abs(ref), np.finfo(float).tiny)
+        rows.append(
+            {
+                "property": column,
+                "mean_abs_delta": float(delta.mean()) if len(delta) else 0.0,
+                "max_abs_delta": float(delta.max(initial=0)),
+                "max_rel_delta": float(relative.max(initial=0)),
+            }
+        )
+    return pd.DataFrame(
+        rows,
+        columns=["property", "mean_abs_delta", "max_abs_delta", "max_rel_delta"],
+    )
+
+
+@dataclass
+class Tolerances:
+    """The largest differences which are still accepted."""
+
+    max_mismatch: float = 0.0  # see LabelComparison.mismatch
+    max_iou_loss: float = 0.0  # 1 - the smallest IoU of matched floes
+    max_property_delta: float = 1e-6  # relative
+
+    def violations(
+        self, labels: LabelComparison, props: Optional[pd.DataFrame] = None
+    ) -> list[str]:
+        """Describe how the comparison exceeds the tolerances."""
+        violations = []
+        if labels.mismatch > self.max_mismatch:
+            violations.append(
+                "%.3g of the floes aren't matched (accepting %.3g)"
+                % (labels.mismatch, self.max_mismatch)
+            )
+        if len(labels.iou) and 1 - labels.iou.min() > self.max_iou_loss:
+            violations.append(
+                "the smallest IoU of matched floes is %.6g (accepting %.6g)"
+                % (labels.iou.min(), 1 - self.max_iou_loss)
+            )
+        if props is not None:
+            for row in props.itertuples():
+                if row.max_rel_delta > self.max_property_delta:
+                    violations.append(
+                        "%s differs by up to %.3g relative (accepting %.3g)"
+                        % (row.property, row.max_rel_delta, self.max_property_delta)
+                    )
+        return violations
+
+
+@dataclass
+class FileComparison:
+    reference: Path
+    candidate: Path
+    labels: Optional[LabelComparison] = None
+    props: Optional[pd.DataFrame] = None
+    violations: list[str] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return {
+            "reference": str(self.reference),
+            "candidate": str(self.candidate),
+            "labels": None if self.labels is None else self.labels.summary(),
+            "props": None if self.props is None else self.props.to_dict("records"),
+            "violations": self.violations,
+        }
+
+
+def props_path(label_path: Path) -> Path:
+    """
+    Get the path of the props table written next to a label image.
+
+    Examples:
+        >>> props_path(Path("out/214/2012-08-01_terra_final.tif")).as_posix()
+        'out/214/2012-08-01_terra_props.csv'
+    """
+    return label_path.with_name(label_path.name.replace("final.tif", "props.csv"))
+
+
+def compare_files(
+    reference: Path,
+    candidate: Path,
+    min_iou: float = 0.5,
+    tolerances: Optional[Tolerances] = None,
+) -> FileComparison:
+    """
+    Compare two label images, and their props tables if they exist.
+
+    Args:
+        reference (Path): The reference label image, e.g. a final.tif.
+        candidate (Path): The candidate label image.
+        min_iou (float): The smallest IoU of matched floes.
+        tolerances (Tolerances, optional): The largest differences which are
+            accepted. Defaults to `Tolerances()`.
+
+    Returns:
+        FileComparison: The comparison, with any violations of the tolerances.
+    """
+    import rasterio
+
+    with rasterio.open(reference) as ref, rasterio.open(candidate) as cand:
+        labels = compare_labels(ref.read(1), cand.read(1), min_iou=min_iou)
+
+    props = None
+    if props_path(reference).exists() and props_path(candidate).exists():
+        props = compare_props(
+            pd.read_csv(props_path(reference)),
+            pd.read_csv(props_path(candidate)),
+            labels.matched,
+        )
+
+    comparison = FileComparison(reference, candidate, labels, props)
+    comparison.violations = (tolerances or Tolerances()).violations(labels, props)
+    return comparison
+
+
+def compare_outputs(
+    reference: Path,
+    candidate: Path,
+    min_iou: float = 0.5,
+    tolerances: Optional[Tolerances] = None,
+) -> list[FileComparison]:
+    """
+    Compare label images, or all the label images in two output directories.
+
+    Label images (`*final.tif`) are paired by their path relative to the
+    directories. A label image which only one directory has is a violation.
+
+    Returns:
+        list[FileComparison]: The comparison of each pair of label images.
+    """
+    reference, candidate = Path(reference), Path(candidate)
+    if not reference.is_dir():
+        return [compare_files(reference, candidate, min_iou, tolerances)]
+
+    def label_images(direc):
+        return {path.relative_to(direc) for path in direc.rglob("*final.tif")}
+
+    reference_images = label_images(reference)
+    candidate_images = label_images(candidate)
+    comparisons = []
+    for relative in sorted(reference_images | candidate_images):
+        if relative not in candidate_images or relative not in reference_images:
+            missing_from = candidate if relative in reference_images else reference
+            comparisons.append(
+                FileComparison(
+                    reference / relative,
+                    candidate / relative,
+                    violations=["%s is missing from %s" % (relative, missing_from)],
+                )
+            )
+            continue
+        logger.info("comparing %s", relative)
+        comparisons.append(
+            compare_files(
+                reference / relative, candidate / relative, min_iou, tolerances
+            )
+        )
+    return comparisons
+
+
+def write_comparison_report(comparisons: list[FileComparison], path: Path) -> None:
+    with open(path, "w") as f:
+        json.dump([c.to_dict() for c in comparisons], f, indent=2)
@@ -0,0 +1,54 @@
+from dataclasses import dataclass
+from enum import Enum
+
+from ebfloeseg.bbox import BoundingBox
+
+
+class ImageType(str, Enum):
+    truecolor = "truecolor"
+    cloud = "cloud"
+    landmask = "landmask"
+    bands721 = "bands721"
+
+
+class Satellite(str, Enum):
+    terra = "terra"
+    aqua = "aqua"
+
+
+@dataclass
+class DataSet:
+    datetime: str
+    wrap: str
+    satellite: Satellite
+    kind: ImageType
+    bbox: BoundingBox
+    scale: int
+    crs: str
+    ts: int
+
+    def __post_init__(self):
+        """ensure that the fields are of the correct type"""
+        if not isinstance(self.satellite, Satellite):
+            self.satellite = Satellite(self.satellite)
+        if not isinstance(self.kind, ImageType):
+            self.kind = ImageType(self.kind)
+        if not isinstance(self.bbox, BoundingBox):
+            self.bbox = BoundingBox(*self.bbox)
+
+
+ExampleDataSetBeaufortSea = DataSet(
+    datetime="2016-07-01T00:00:00Z",
+    wrap="day",
+    satellite=Satellite.terra,
+    kind=ImageType.truecolor,
+    scale=250,
+    bbox=BoundingBox(
+        -2334051,
+        -414387,
+        -1127689,
+        757861,
+    ),
+    crs="EPSG:3413",
+    ts=1683675557694,
+)
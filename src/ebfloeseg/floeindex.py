@@ -0,0 +1,367 @@
+"""A persistent spatial and temporal index of the floes of many outputs.
+
+Finding the floes in a region and date range would otherwise read every
+props table of a batch run. A `FloeIndex` is an SQLite database holding, for
+each floe, its bounding box and centroid in the coordinates of the CRS
+(converted from pixels with the transform of its scene), its date and
+satellite, in an R*Tree over x, y and the day, so that a query only visits
+the floes near the region and dates.
+
+The R*Tree stores coordinates as 32-bit floats, rounded outwards, so it finds
+a few more floes than requested, which are then filtered exactly.
+"""
+
+import datetime
+import os
+import re
+import sqlite3
+from logging import getLogger
+from pathlib import Path
+from typing import Iterable, Literal, Optional
+
+import pandas as pd
+import rasterio
+
+from ebfloeseg.bbox import BoundingBox
+
+logger = getLogger(__name__)
+
+# e.g. 2012-08-01_terra_props.csv, as written by process-batch
+PROPS_NAME = re.compile(
+    r"(?P<date>\d{4}-\d{2}-\d{2})(?:_(?P<satellite>[a-z]+))?_props\.csv$"
+)
+
+# the props copied into the index, in pixels
+PROPS = ["area", "perimeter", "major_axis_length", "minor_axis_length"]
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS scenes (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    satellite TEXT,
+    crs TEXT
+);
+CREATE TABLE IF NOT EXISTS floes (
+    id INTEGER PRIMARY KEY,
+    scene INTEGER NOT NULL REFERENCES scenes(id),
+    label INTEGER NOT NULL,
+    x REAL NOT NULL,
+    y REAL NOT NULL,
+    x1 REAL NOT NULL,
+    y1 REAL NOT NULL,
+    x2 REAL NOT NULL,
+    y2 REAL NOT NULL,
+    {", ".join(f"{prop} REAL" for prop in PROPS)}
+);
+CREATE INDEX IF NOT EXISTS floes_scene ON floes(scene);
+CREATE VIRTUAL TABLE IF NOT EXISTS floe_boxes USING rtree(
+    id, x1, x2, y1, y2, day1, day2
+);
+"""
+
+
+def parse_props_name(path: Path) -> Optional[tuple[datetime.date, Optional[str]]]:
+    """
+    Get the date and satellite of a props table from its name.
+
+    Examples:
+        >>> parse_props_name(Path("out/214/2012-08-01_terra_props.csv"))
+        (datetime.date(2012, 8, 1), 'terra')
+        >>> parse_props_name(Path("out/props.csv")) is None
+        True
+    """
+    match = PROPS_NAME.search(path.name)
+    if match is None:
+        return None
+    return datetime.date.fromisoformat(match["date"]), match["satellite"]
+
+
+def labels_path(props_path: Path) -> Path:
+    """
+    Get the path of the labelled floes written next to a props table.
+
+    Examples:
+        >>> labels_path(Path("out/214/2012-08-01_terra_props.csv")).as_posix()
+        'out/214/2012-08-01_terra_final.tif'
+    """
+    return props_path.with_name(props_path.name.replace("props.csv", "final.tif"))
+
+
+def floe_coordinates(props: pd.DataFrame, transform) -> pd.DataFrame:
+    """
+    Convert the bounding boxes and centroids of floes from pixels to the CRS.
+
+    Args:
+        props (pd.DataFrame): The props table of a scene.
+        transform (affine.Affine): The transform of its labelled floes.
+
+    Returns:
+        pd.DataFrame: The centroids x, y and the bounding boxes x1, y1, x2, y2.
+
+    Examples:
+        >>> from affine import Affine
+        >>> props = pd.DataFrame({"min_row": [0], "min_col": [2], "max_row": [1],
+        ...     "max_col": [4], "row_centroid": [0.0], "col_centroid": [2.5]})
+        >>> floe_coordinates(props, Affine(10, 0, 100, 0, -10, 0))
+               x    y     x1    y1     x2   y2
+        0  130.0 -5.0  120.0 -10.0  140.0  0.0
+    """
+    a, b, c, d, e, f = tuple(transform)[:6]
+
+    def to_crs(col, row):
+        return a * col + b * row + c, d * col + e * row + f
+
+    # pixel (row, col) covers [col, col + 1) x [row, row + 1), and the max_
+    # are exclusive, so that the corners of the box are at min_ and max_
+    cols = props[["min_col", "max_col", "min_col", "max_col"]].to_numpy(float)
+    rows = props[["min_row", "min_row", "max_row", "max_row"]].to_numpy(float)
+    xs, ys = to_crs(cols, rows)
+    x, y = to_crs(
+        props["col_centroid"].to_numpy() + 0.5, props["row_centroid"].to_numpy() + 0.5
+    )
+    return pd.DataFrame(
+        {
+            "x": x,
+            "y": y,
+            "x1": xs.min(axis=1),
+            "y1": ys.min(axis=1),
+            "x2": xs.max(axis=1),
+            "y2": ys.max(axis=1),
+        },
+        index=props.index,
+    )
+
+
+class FloeIndex:
+    """
+    The floes of many props tables, by location and date.
+
+    All scenes of an index must have the same CRS, in which the bounding
+    boxes of the queries are given.
+
+    Examples:
+        >>> import tempfile
+        >>> index = FloeIndex(Path(tempfile.mkdtemp()) / "floes.sqlite")
+        >>> index.update(["tests/expected"])
+        {'added': 2, 'removed': 0, 'unchanged': 0, 'floes': 1285}
+        >>> floes = index.query(
+        ...     BoundingBox(-1500000, -300000, -1400000, -200000),
+        ...     start=datetime.date(2012, 8, 2),
+        ... )
+        >>> len(floes), floes["date"].unique().tolist()
+        (39, ['2012-08-02'])
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._connection = sqlite3.connect(self.path)
+        self._connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> "FloeIndex":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def crs(self) -> Optional[str]:
+        """The CRS of the scenes, or None if the index is empty."""
+        row = self._connection.execute("SELECT crs FROM scenes LIMIT 1").fetchone()
+        return None if row is None else row[0]
+
+    def _remove(self, scene: int) -> None:
+        db = self._connection
+        db.execute(
+            "DELETE FROM floe_boxes WHERE id IN (SELECT id FROM floes WHERE scene = ?)",
+            (scene,),
+        )
+        db.execute("DELETE FROM floes WHERE scene = ?", (scene,))
+        db.execute("DELETE FROM scenes WHERE id = ?", (scene,))
+
+    def add(
+        self,
+        props_path: Path,
+        date: datetime.date,
+        satellite: Optional[str] = None,
+    ) -> int:
+        """
+        Add (or replace) the floes of a props table.
+
+        The transform and CRS are read from the labelled floes next to it.
+
+        Args:
+            props_path (Path): The props table.
+            date (date): The day of the scene.
+            satellite (str, optional): The satellite of the scene.
+
+        Returns:
+            int: The number of floes.
+        """
+        props_path = Path(os.path.abspath(props_path))
+        with rasterio.open(labels_path(props_path)) as labels:
+            transform = labels.transform
+            crs = None if labels.crs is None else labels.crs.to_wkt()
+        current = self.crs
+        if current is not None and crs != current:
+            raise ValueError(
+                "%s has CRS %s, but the index %s" % (props_path, crs, current)
+            )
+
+        props = pd.read_csv(props_path, index_col=0)
+        floes = pd.concat(
+            [props[["label"] + PROPS], floe_coordinates(props, transform)], axis=1
+        )
+        day = date.toordinal()
+
+        db = self._connection
+        with db:
+            row = db.execute(
+                "SELECT id FROM scenes WHERE path = ?", (str(props_path),)
+            ).fetchone()
+            if row is not None:
+                self._remove(row[0])
+            scene = db.execute(
+                "INSERT INTO scenes (path, mtime_ns, date, satellite, crs)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (
+                    str(props_path),
+                    props_path.stat().st_mtime_ns,
+                    date.isoformat(),
+                    satellite,
+                    crs,
+                ),
+            ).lastrowid
+            (last,) = db.execute("SELECT coalesce(max(id), 0) FROM floes").fetchone()
+            floes.insert(0, "id", range(last + 1, last + 1 + len(floes)))
+            floes.insert(1, "scene", scene)
+            floes["label"] = floes["label"].astype(int)
+            db.executemany(
+                "INSERT INTO floes (%s) VALUES (%s)"
+                % (", ".join(floes.columns), ", ".join("?" * len(floes.columns))),
+                floes.itertuples(index=False),
+            )
+            db.executemany(
+                "INSERT INTO floe_boxes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (floe.id, floe.x1, floe.x2, floe.y1, floe.y2, day, day)
+                    for floe in floes.itertuples(index=False)
+                ),
+            )
+        logger.debug("indexed %s floes of %s", len(floes), props_path)
+        return len(floes)
+
+    def update(self, direcs: Iterable[Path]) -> dict[str, int]:
+        """
+        Index the props tables in directories, as written by process-batch.
+
+        Tables which are already indexed and haven't changed since are
+        skipped, and the floes of tables which were deleted are removed.
+        Tables whose name has no date, such as `props.csv`, are skipped.
+
+        Args:
+            direcs (Iterable[Path]): The output directories, searched
+                recursively.
+
+        Returns:
+            dict[str, int]: The numbers of tables added, removed and
+                unchanged, and of floes added.
+        """
+        db = self._connection
+        indexed = {
+            path: (scene, mtime_ns)
+            for scene, path, mtime_ns in db.execute(
+                "SELECT id, path, mtime_ns FROM scenes"
+            )
+        }
+        summary = {"added": 0, "removed": 0, "unchanged": 0, "floes": 0}
+        for direc in direcs:
+            direc = Path(os.path.abspath(direc))
+            found = set()
+            for props_path in sorted(direc.rglob("*props.csv")):
+                parsed = parse_props_name(props_path)
+                if parsed is None:
+                    logger.warning("no date in the name of %s, skipping it", props_path)
+                    continue
+                found.add(str(props_path))
+                scene, mtime_ns = indexed.get(str(props_path), (None, None))
+                if mtime_ns == props_path.stat().st_mtime_ns:
+                    summary["unchanged"] += 1
+                    continue
+                summary["floes"] += self.add(props_path, *parsed)
+                summary["added"] += 1
+
+            for path, (scene, _) in indexed.items():
+                if Path(path).is_relative_to(direc) and path not in found:
+                    with db:
+                        self._remove(scene)
+                    summary["removed"] += 1
+        logger.info("updated %s: %s", self.path, summary)
+        return summary
+
+    def query(
+        self,
+        bbox: BoundingBox,
+        start: Optional[datetime.date] = None,
+        end: Optional[datetime.date] = None,
+        satellite: Optional[str] = None,
+        by: Literal["bbox", "centroid"] = "bbox",
+    ) -> pd.DataFrame:
+        """
+        Find the floes in a region and date range.
+
+        Args:
+            bbox (BoundingBox): The region, in the CRS of the index.
+            start, end (date, optional): The first and last days, inclusive.
+                Defaults to no limit.
+            satellite (str, optional): Only the floes seen by this satellite.
+            by (str): Find the floes whose bounding box overlaps the region
+                ("bbox"), or whose centroid is inside it ("centroid").
+
+        Returns:
+            pd.DataFrame: One row per floe, ordered by date, satellite and
+                label, with its coordinates in the CRS and props in pixels.
+        """
+        if by not in ("bbox", "centroid"):
+            raise ValueError("by must be 'bbox' or 'centroid', not %r" % by)
+        x1, x2 = sorted((bbox.x1, bbox.x2))
+        y1, y2 = sorted((bbox.y1, bbox.y2))
+        day1 = datetime.date.min if start is None else start
+        day2 = datetime.date.max if end is None else end
+        if by == "bbox":
+            exact = "f.x1 <= :x2 AND f.x2 >= :x1 AND f.y1 <= :y2 AND f.y2 >= :y1"
+        else:
+            exact = "f.x BETWEEN :x1 AND :x2 AND f.y BETWEEN :y1 AND :y2"
+        sql = f"""
+            SELECT s.date, s.satellite, f.label, f.x, f.y, f.x1, f.y1, f.x2, f.y2,
+                {", ".join(f"f.{prop}" for prop in PROPS)}, s.path
+            FROM floe_boxes b
+            JOIN floes f ON f.id = b.id
+            JOIN scenes s ON s.id = f.scene
+            WHERE b.x1 <= :x2 AND b.x2 >= :x1 AND b.y1 <= :y2 AND b.y2 >= :y1
+                AND b.day1 <= :day2 AND b.day2 >= :day1
+                AND {exact}
+                AND s.date BETWEEN :start AND :end
+                AND (:satellite IS NULL OR s.satellite = :satellite)
+            ORDER BY s.date, s.satellite, f.label
+        """
+        parameters = {
+            "x1": x1,
+            "x2": x2,
+            "y1": y1,
+            "y2": y2,
+            "day1": day1.toordinal(),
+            "day2": day2.toordinal(),
+            "start": day1.isoformat(),
+            "end": day2.isoformat(),
+            "satellite": satellite,
+        }
+        cursor = self._connection.execute(sql, parameters)
+        columns = [column[0] for column in cursor.description]
+        return pd.DataFrame(cursor.fetchall(), columns=columns).rename(
+            columns={"path": "props_path"}
+        )
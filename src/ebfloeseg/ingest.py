@@ -0,0 +1,55 @@
+from typing import Optional
+
+import numpy as np
+from numpy.typing import NDArray
+from rasterio import DatasetReader
+from rasterio.enums import ColorInterp
+from rasterio.windows import Window
+
+
+def read_rgb(
+    tci: DatasetReader,
+    window: Optional[Window] = None,
+    out: Optional[NDArray] = None,
+) -> NDArray:
+    """
+    Read the red, green and blue bands of a true-color image into one (H, W, 3) array.
+
+    The bands are decoded straight into the interleaved layout expected by cv2,
+    without reading the alpha band or making intermediate copies.
+
+    Args:
+        tci (DatasetReader): The true-color image.
+        window (Window, optional): Only read this part of the image.
+        out (NDArray, optional): A preallocated (H, W, 3) array to read into.
+
+    Returns:
+        NDArray: The RGB image.
+
+    Raises:
+        ValueError: If the bands of the image aren't red, green, blue (and alpha).
+    """
+    match tci.colorinterp:
+        case (ColorInterp.red, ColorInterp.green, ColorInterp.blue):
+            pass
+        case (ColorInterp.red, ColorInterp.green, ColorInterp.blue, _):
+            pass
+        case _:
+            msg = "unknown number of dimensions %s" % tci.colorinterp
+            raise ValueError(msg)
+
+    if window is None:
+        height, width = tci.height, tci.width
+    else:
+        height, width = int(window.height), int(window.width)
+
+    if out is None:
+        out = np.empty((height, width, 3), dtype=tci.dtypes[0])
+
+    # rasterio reads band by band into the (3, H, W) view of `out`
+    bands = np.moveaxis(out, -1, 0)
+    result = tci.read([1, 2, 3], out=bands, window=window)
+    if not np.shares_memory(result, out):
+        bands[...] = result
+
+    return out
@@ -1,31 +1,33 @@
-from dataclasses import dataclass
 import io
 import logging
+import time
 from collections import namedtuple
-from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
 
 import numpy as np
 import rasterio
 import requests
-from rasterio.enums import ColorInterp
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.enums import ColorInterp, Resampling
+from rasterio.io import MemoryFile
+from rasterio.warp import reproject
+from rasterio.windows import Window
 
 from ebfloeseg.bbox import BoundingBox
+from ebfloeseg.dataset import (
+    DataSet,
+    ExampleDataSetBeaufortSea,
+    ImageType,
+    Satellite,
+)
+from ebfloeseg.tilecache import DEFAULT_TILE_SIZE, TileCache, TileKey, grid_window
 
 _logger = logging.getLogger(__name__)
 
 
-class ImageType(str, Enum):
-    truecolor = "truecolor"
-    cloud = "cloud"
-    landmask = "landmask"
-    bands721 = "bands721"
-
-
-class Satellite(str, Enum):
-    terra = "terra"
-    aqua = "aqua"
-
-
 def _rescale(x1: int | float, x2: int | float, scale: int | float) -> int:
     """
 
@@ -110,43 +112,250 @@ def image_can_be_read_without_errors(img: rasterio.DatasetReader):
 
 LoadResult = namedtuple("LoadResult", ["content", "img"])
 
+SNAPSHOT_URL = "https://wvs.earthdata.nasa.gov/api/v1/snapshot"
 
-@dataclass
-class DataSet:
-    datetime: str
-    wrap: str
-    satellite: Satellite
-    kind: ImageType
-    bbox: BoundingBox
-    scale: int
-    crs: str
-    ts: int
-
-    def __post_init__(self):
-        """ensure that the fields are of the correct type"""
-        if not isinstance(self.satellite, Satellite):
-            self.satellite = Satellite(self.satellite)
-        if not isinstance(self.kind, ImageType):
-            self.kind = ImageType(self.kind)
-        if not isinstance(self.bbox, BoundingBox):
-            self.bbox = BoundingBox(*self.bbox)
-
-
-ExampleDataSetBeaufortSea = DataSet(
-    datetime="2016-07-01T00:00:00Z",
-    wrap="day",
-    satellite=Satellite.terra,
-    kind=ImageType.truecolor,
-    scale=250,
-    bbox=BoundingBox(
-        -2334051,
-        -414387,
-        -1127689,
-        757861,
-    ),
-    crs="EPSG:3413",
-    ts=1683675557694,
-)
+# Seconds before the first retry of a failed request, doubled for each retry.
+RETRY_DELAY = 5.0
+
+# The formats tiles can be combined into, and their GDAL drivers.
+MOSAIC_DRIVERS = {"image/tiff": "GTiff", "image/png": "PNG", "image/jpeg": "JPEG"}
+
+
+def _layers(satellite: Satellite, kind: ImageType) -> str:
+    match (satellite, kind):
+        case (Satellite.terra, ImageType.truecolor):
+            return "MODIS_Terra_CorrectedReflectance_TrueColor"
+        case (Satellite.terra, ImageType.cloud):
+            return "MODIS_Terra_Cloud_Fraction_Day"
+        case (Satellite.terra, ImageType.bands721):
+            return "MODIS_Terra_CorrectedReflectance_Bands721"
+        case (Satellite.aqua, ImageType.truecolor):
+            return "MODIS_Aqua_CorrectedReflectance_TrueColor"
+        case (Satellite.aqua, ImageType.cloud):
+            return "MODIS_Aqua_Cloud_Fraction_Day"
+        case (Satellite.aqua, ImageType.bands721):
+            return "MODIS_Aqua_CorrectedReflectance_Bands721"
+        case (_, ImageType.landmask):
+            return "OSM_Land_Mask"
+        case _:
+            msg = "satellite=%s and image kind=%s not supported" % (satellite, kind)
+            raise NotImplementedError(msg)
+
+
+def _get_snapshot(payload: dict, retries: int = 0) -> bytes:
+    """Request a snapshot, retrying failed requests with exponential backoff."""
+    for attempt in range(retries + 1):
+        try:
+            r = requests.get(SNAPSHOT_URL, params=payload, allow_redirects=True)
+            r.raise_for_status()
+            return r.content
+        except requests.RequestException as e:
+            if attempt == retries:
+                raise
+            delay = RETRY_DELAY * 2**attempt
+            _logger.warning(
+                "snapshot of %s failed (%s), retrying in %s s",
+                payload["BBOX"],
+                e,
+                delay,
+            )
+            time.sleep(delay)
+
+
+def _validate(img: rasterio.DatasetReader, kind: ImageType) -> None:
+    assert image_can_be_read_without_errors(img)
+    match (kind):
+        case ImageType.truecolor | ImageType.cloud:
+            assert image_not_empty(img), "image is empty"
+            assert ColorInterp.alpha not in img.colorinterp or alpha_not_empty(
+                img
+            ), "alpha channel is empty"
+        case ImageType.landmask:
+            # An empty landmask is reasonable, nothing to validate here
+            pass
+
+
+def _tiles(width: int, height: int, tile_size: int) -> list[tuple[slice, slice]]:
+    """
+    Split an image into tiles of at most `tile_size` by `tile_size` pixels.
+
+    Examples:
+        >>> _tiles(5, 3, 2)  # doctest: +NORMALIZE_WHITESPACE
+        [(slice(0, 2, None), slice(0, 2, None)), (slice(0, 2, None), slice(2, 4, None)),
+         (slice(0, 2, None), slice(4, 5, None)), (slice(2, 3, None), slice(0, 2, None)),
+         (slice(2, 3, None), slice(2, 4, None)), (slice(2, 3, None), slice(4, 5, None))]
+    """
+    return [
+        (
+            slice(row, min(row + tile_size, height)),
+            slice(col, min(col + tile_size, width)),
+        )
+        for row in range(0, height, tile_size)
+        for col in range(0, width, tile_size)
+    ]
+
+
+def _check_mosaic_format(format: str) -> None:
+    if format not in MOSAIC_DRIVERS:
+        msg = "can't combine tiles into %s, only into %s" % (
+            format,
+            ", ".join(MOSAIC_DRIVERS),
+        )
+        raise ValueError(msg)
+
+
+def mosaic(
+    tiles: list[tuple[rasterio.DatasetReader, slice, slice]],
+    width: int,
+    height: int,
+    transform: Affine,
+    crs: CRS,
+    format: str = "image/tiff",
+) -> LoadResult:
+    """
+    Combine tiles into one image in `format`, held in memory.
+
+    A tile is copied into its rows and columns of the mosaic if it is on the
+    grid of the mosaic already, as the tiles of a snapshot are, and is only
+    reprojected onto the grid otherwise. Tiles without georeferencing, like
+    PNG and JPEG snapshots, are taken to be on the grid. Tiles may extend
+    beyond the mosaic, in which case only the part inside it is used.
+
+    Args:
+        tiles (list): Each tile, with the rows and columns it covers.
+        width (int), height (int): The size of the mosaic, in pixels.
+        transform (Affine): The transform of the mosaic.
+        crs (CRS): The CRS of the mosaic.
+        format (str): One of `MOSAIC_DRIVERS`. Only a GeoTIFF is georeferenced,
+            like the snapshots in the other formats.
+
+    Returns:
+        LoadResult: The encoded image and the opened mosaic.
+    """
+    _check_mosaic_format(format)
+
+    first = tiles[0][0]
+    data = np.zeros((first.count, height, width), dtype=first.dtypes[0])
+    for img, rows, cols in tiles:
+        tile_transform = transform * Affine.translation(cols.start, rows.start)
+        tile_shape = (rows.stop - rows.start, cols.stop - cols.start)
+        # the part of the tile inside the mosaic
+        inside = (
+            slice(max(rows.start, 0), min(rows.stop, height)),
+            slice(max(cols.start, 0), min(cols.stop, width)),
+        )
+        if inside[0].start >= inside[0].stop or inside[1].start >= inside[1].stop:
+            continue
+        if img.crs is None and img.transform.is_identity:
+            on_grid = img.shape == tile_shape
+        else:
+            on_grid = (
+                (img.crs is None or img.crs == crs)
+                and img.shape == tile_shape
+                and img.transform.almost_equals(tile_transform)
+            )
+        if on_grid:
+            window = Window.from_slices(
+                (inside[0].start - rows.start, inside[0].stop - rows.start),
+                (inside[1].start - cols.start, inside[1].stop - cols.start),
+            )
+            img.read(window=window, out=data[:, inside[0], inside[1]])
+        else:
+            _logger.debug("reprojecting the tile at %s, %s", rows, cols)
+            reproject(
+                source=img.read(),
+                destination=data[:, inside[0], inside[1]],
+                src_transform=img.transform,
+                src_crs=img.crs or crs,
+                dst_transform=transform
+                * Affine.translation(inside[1].start, inside[0].start),
+                dst_crs=crs,
+                resampling=Resampling.nearest,
+            )
+
+    driver = MOSAIC_DRIVERS[format]
+    if driver == "GTiff":
+        profile = first.profile
+        for key in ["blockxsize", "blockysize", "tiled"]:
+            profile.pop(key, None)
+    else:
+        # the creation options of the tiles may not apply to the format
+        profile = dict(count=first.count, dtype=first.dtypes[0])
+    profile.update(
+        driver=driver, width=width, height=height, transform=transform, crs=crs
+    )
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as dst:
+            dst.write(data)
+            if driver == "GTiff":
+                dst.colorinterp = first.colorinterp
+        content = memfile.read()
+    return LoadResult(content, rasterio.open(io.BytesIO(content)))
+
+
+def _load_from_cache(
+    cache: TileCache,
+    payload: dict,
+    bbox: BoundingBox,
+    scale: int | float,
+    crs: str,
+    max_workers: int,
+    retries: int,
+) -> LoadResult:
+    """Assemble an image from the tiles of the cache, downloading the missing tiles."""
+    window = grid_window(bbox, scale, cache.tile_size)
+    if window.bbox != bbox:
+        _logger.info("snapped %s to the pixel grid, %s", bbox, window.bbox)
+    size = cache.tile_size
+    missed = []
+
+    def get_tile(row, col):
+        key = TileKey(
+            layer=payload["LAYERS"],
+            datetime=payload["TIME"],
+            wrap=payload["WRAP"],
+            format=payload["FORMAT"],
+            ts=payload["ts"],
+            crs=crs,
+            scale=scale,
+            tile_size=size,
+            row=row,
+            col=col,
+        )
+        content = cache.get(key)
+        if content is None:
+            missed.append(key)
+            tile_payload = dict(
+                payload,
+                BBOX="%s,%s,%s,%s" % key.bbox,
+                WIDTH=size,
+                HEIGHT=size,
+            )
+            content = _get_snapshot(tile_payload, retries)
+            # an error page returned as a success isn't an image, and mustn't be
+            # cached, or it would be used for every later request
+            img = rasterio.open(io.BytesIO(content))
+            cache.put(key, content)
+        else:
+            img = rasterio.open(io.BytesIO(content))
+        rows = slice(row * size - window.row, (row + 1) * size - window.row)
+        cols = slice(col * size - window.col, (col + 1) * size - window.col)
+        return img, rows, cols
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tiles = list(executor.map(lambda tile: get_tile(*tile), window.tiles))
+    _logger.info(
+        "%s of %s tiles were in the cache", len(tiles) - len(missed), len(tiles)
+    )
+    transform = Affine(scale, 0, window.bbox.x1, 0, -scale, window.bbox.y2)
+    return mosaic(
+        tiles,
+        window.width,
+        window.height,
+        transform,
+        CRS.from_user_input(crs),
+        format=payload["FORMAT"],
+    )
 
 
 def load(
@@ -160,32 +369,34 @@ def load(
     ts: int = ExampleDataSetBeaufortSea.ts,
     format: str = "image/tiff",
     validate: bool = True,
+    tile_size: Optional[int] = None,
+    max_workers: int = 8,
+    retries: int = 0,
+    cache_dir: Optional[Path] = None,
 ) -> LoadResult:
-    """Load an image from the NASA Worldview Snapshots API"""
+    """Load an image from the NASA Worldview Snapshots API
+
+    If the image is wider or higher than `tile_size` pixels, it is requested as
+    a grid of tiles of up to `tile_size` by `tile_size` pixels, by up to
+    `max_workers` requests at a time, and the tiles are combined into one
+    GeoTIFF. Each request is tried again up to `retries` times.
+
+    With `cache_dir`, the image is assembled from the tiles of a `TileCache`
+    in that directory instead, with tiles of `tile_size` pixels (512 by
+    default), and only the tiles which aren't in the cache are downloaded.
+    The bounding box is then snapped outwards to the pixel grid of the cache,
+    whose pixels are `scale` wide and start at the origin of the CRS.
+
+    Tiles are combined into an image in the same `format` as a single request
+    would return, which must be one of `MOSAIC_DRIVERS`; only a GeoTIFF is
+    georeferenced.
+    """
 
-    match (satellite, kind):
-        case (Satellite.terra, ImageType.truecolor):
-            layers = "MODIS_Terra_CorrectedReflectance_TrueColor"
-        case (Satellite.terra, ImageType.cloud):
-            layers = "MODIS_Terra_Cloud_Fraction_Day"
-        case (Satellite.terra, ImageType.bands721):
-            layers = "MODIS_Terra_CorrectedReflectance_Bands721"
-        case (Satellite.aqua, ImageType.truecolor):
-            layers = "MODIS_Aqua_CorrectedReflectance_TrueColor"
-        case (Satellite.aqua, ImageType.cloud):
-            layers = "MODIS_Aqua_Cloud_Fraction_Day"
-        case (Satellite.aqua, ImageType.bands721):
-            layers = "MODIS_Aqua_CorrectedReflectance_Bands721"
-        case (_, ImageType.landmask):
-            layers = "OSM_Land_Mask"
-        case _:
-            msg = "satellite=%s and image kind=%s not supported" % (satellite, kind)
-            raise NotImplementedError(msg)
+    layers = _layers(satellite, kind)
 
     width, height = _get_width_height(bbox, scale)
     _logger.info("Width: %s Height: %s" % (width, height))
 
-    url = f"https://wvs.earthdata.nasa.gov/api/v1/snapshot"
     payload = {
         "REQUEST": "GetSnapshot",
         "TIME": datetime,
@@ -198,24 +409,103 @@ def load(
         "HEIGHT": height,
         "ts": ts,
     }
-    r = requests.get(url, params=payload, allow_redirects=True)
-    r.raise_for_status()
 
-    img = rasterio.open(io.BytesIO(r.content))
+    tiled = tile_size is not None and (width > tile_size or height > tile_size)
+    if cache_dir is not None or tiled:
+        _check_mosaic_format(format)
+
+    if cache_dir is not None:
+        cache = TileCache(cache_dir, tile_size or DEFAULT_TILE_SIZE)
+        result = _load_from_cache(
+            cache, payload, bbox, scale, crs, max_workers, retries
+        )
+    elif not tiled:
+        content = _get_snapshot(payload, retries)
+        result = LoadResult(content, rasterio.open(io.BytesIO(content)))
+    else:
+        # the tiles share the pixel grid of the whole image, whose pixels
+        # may be slightly larger or smaller than `scale`
+        x_res = (bbox.x2 - bbox.x1) / width
+        y_res = (bbox.y2 - bbox.y1) / height
+
+        def get_tile(rows, cols):
+            x1, x2 = bbox.x1 + cols.start * x_res, bbox.x1 + cols.stop * x_res
+            y1, y2 = bbox.y2 - rows.stop * y_res, bbox.y2 - rows.start * y_res
+            tile_payload = dict(
+                payload,
+                BBOX=f"{x1},{y1},{x2},{y2}",
+                WIDTH=cols.stop - cols.start,
+                HEIGHT=rows.stop - rows.start,
+            )
+            content = _get_snapshot(tile_payload, retries)
+            return rasterio.open(io.BytesIO(content)), rows, cols
+
+        tiles = _tiles(width, height, tile_size)
+        _logger.info("requesting %s tiles", len(tiles))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            fetched = list(executor.map(lambda tile: get_tile(*tile), tiles))
+        transform = Affine(x_res, 0, bbox.x1, 0, -y_res, bbox.y2)
+        result = mosaic(
+            fetched, width, height, transform, CRS.from_user_input(crs), format=format
+        )
 
     if validate:
-        assert image_can_be_read_without_errors(img)
-        match (kind):
-            case ImageType.truecolor | ImageType.cloud:
-                assert image_not_empty(img), "image is empty"
-                assert ColorInterp.alpha not in img.colorinterp | alpha_not_empty(
-                    img
-                ), "alpha channel is empty"
-            case ImageType.landmask:
-                # An empty landmask is reasonable, nothing to validate here
-                pass
-
-    return LoadResult(r.content, img)
+        _validate(result.img, kind)
+
+    return result
+
+
+def load_scene(
+    datetime: str = ExampleDataSetBeaufortSea.datetime,
+    wrap: str = ExampleDataSetBeaufortSea.wrap,
+    satellite: Satellite = ExampleDataSetBeaufortSea.satellite,
+    bbox: BoundingBox = ExampleDataSetBeaufortSea.bbox,
+    scale: int = ExampleDataSetBeaufortSea.scale,
+    crs: str = ExampleDataSetBeaufortSea.crs,
+    ts: int = ExampleDataSetBeaufortSea.ts,
+    validate: bool = True,
+    tile_size: Optional[int] = None,
+    retries: int = 0,
+    cache_dir: Optional[Path] = None,
+) -> dict[ImageType, LoadResult]:
+    """
+    Load the true-color, cloud and land mask images of a scene at the same time.
+
+    The images are downloaded concurrently and kept in memory. Like `fsdproc
+    load --no-validate`, the land mask isn't validated, as it may be empty.
+    Large images are requested in tiles of up to `tile_size` pixels, or taken
+    from the tile cache in `cache_dir`, see `load`.
+
+    Returns:
+        dict[ImageType, LoadResult]: The images, by their kind.
+    """
+    kinds = [ImageType.truecolor, ImageType.cloud, ImageType.landmask]
+    with ThreadPoolExecutor(max_workers=len(kinds)) as executor:
+        futures = {
+            kind: executor.submit(
+                load,
+                datetime=datetime,
+                wrap=wrap,
+                satellite=satellite,
+                kind=kind,
+                bbox=bbox,
+                scale=scale,
+                crs=crs,
+                ts=ts,
+                validate=validate and kind != ImageType.landmask,
+                tile_size=tile_size,
+                retries=retries,
+                cache_dir=cache_dir,
+            )
+            for kind in kinds
+        }
+        images = {kind: future.result() for kind, future in futures.items()}
+
+    shapes = {kind: image.img.shape for kind, image in images.items()}
+    if len(set(shapes.values())) > 1:
+        msg = "the images of the scene have different shapes %s" % shapes
+        raise ValueError(msg)
+    return images
 
 
 if __name__ == "__main__":
@@ -1,9 +1,22 @@
 from pathlib import Path
+from typing import Optional
 
+import cv2
 import numpy as np
 from numpy.typing import NDArray
 import rasterio
 
+from ebfloeseg.window import SceneWindow
+
+# floes within this many pixels (taxicab distance) of land or clouds are removed
+MASK_DILATION_RADIUS = 10
+
+# values of the land and cloud pixels in the land mask and cloud images
+LAND_VALUE = 75
+CLOUD_VALUE = 255
+
+_CROSS = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+
 
 def mask_image(img: NDArray, mask: NDArray, val=0) -> NDArray:
     """
@@ -21,12 +34,15 @@ def mask_image(img: NDArray, mask: NDArray, val=0) -> NDArray:
     return img
 
 
-def create_land_mask(lmfile: Path, val: int = 75) -> NDArray[np.bool_]:
+def create_land_mask(
+    lmfile: Path, val: int = LAND_VALUE, window: Optional[SceneWindow] = None
+) -> NDArray[np.bool_]:
     """
     Create a land mask from a raster file.
 
     Parameters:
     lmfile (str): The path to the raster file.
+    window (SceneWindow, optional): Only read this part of the raster.
 
     Returns:
     NDArray[np.bool_]: The land mask as a boolean NumPy array.
@@ -35,31 +51,105 @@ def create_land_mask(lmfile: Path, val: int = 75) -> NDArray[np.bool_]:
         s = rasterio.open(lmfile)
     except rasterio._err.CPLE_OpenFailedError:
         raise FileNotFoundError(f"Could not open file {lmfile}")
-    land_mask = (s.read()[0]) == val
-    return land_mask
+    return read_mask(s, val, window)
 
 
-def create_cloud_mask(cloud_file: Path, val: int = 255) -> NDArray[np.bool_]:
+def read_mask(
+    dataset: rasterio.DatasetReader, val: int, window: Optional[SceneWindow] = None
+) -> NDArray[np.bool_]:
+    """
+    Get the pixels of the first band of an open raster which are `val`.
+
+    Args:
+        dataset (DatasetReader): The raster, e.g. a land mask or cloud image.
+        val (int): The value of the masked pixels, e.g. LAND_VALUE or CLOUD_VALUE.
+        window (SceneWindow, optional): Only read this part of the raster.
+
+    Returns:
+        NDArray[np.bool_]: The mask.
+    """
+    window = None if window is None else window.to_window(dataset)
+    return dataset.read(1, window=window) == val
+
+
+def create_cloud_mask(
+    cloud_file: Path, val: int = CLOUD_VALUE, window: Optional[SceneWindow] = None
+) -> NDArray[np.bool_]:
     """
     Create cloud mask from cloud file.
 
     Args:
         cloud_file (Path): path to cloud (raster) file
+        window (SceneWindow, optional): only read this part of the raster
 
     Returns:
         NDArray[np.bool_]: cloud mask
     """
-    cloud_mask = create_land_mask(cloud_file, val)
+    cloud_mask = create_land_mask(cloud_file, val, window)
     return cloud_mask
 
 
 def maskrgb(rgb: NDArray, mask: NDArray) -> None:
     """
-    Apply (inplace) a mask to each channel of an RGB image.
+    Apply (inplace) a mask to all channels of an RGB image in a single pass.
 
     Args:
         rgb (numpy.ndarray): The RGB image to be masked.
         mask (numpy.ndarray): The mask to be applied.
     """
-    for i in range(rgb.shape[2]):
-        mask_image(rgb[:, :, i], mask)
+    mask_image(rgb, mask)
+
+
+def dilate_mask(mask: NDArray, radius: int = MASK_DILATION_RADIUS) -> NDArray[np.bool_]:
+    """
+    Dilate a mask by a diamond of the given radius.
+
+    The result is exactly that of `skimage.morphology.binary_dilation(mask,
+    diamond(radius))`, i.e. every pixel within a taxicab distance of `radius` of
+    the mask, but much faster: the diamond is the `radius`-fold dilation of a 3x3
+    cross, which cv2 applies in a few vectorized passes.
+
+    Args:
+        mask (NDArray): The mask.
+        radius (int): The radius of the diamond.
+
+    Returns:
+        NDArray[np.bool_]: The dilated mask.
+
+    Examples:
+        >>> mask = np.zeros((5, 5), dtype=bool)
+        >>> mask[2, 2] = True
+        >>> dilate_mask(mask, 1).astype(int)
+        array([[0, 0, 0, 0, 0],
+               [0, 0, 1, 0, 0],
+               [0, 1, 1, 1, 0],
+               [0, 0, 1, 0, 0],
+               [0, 0, 0, 0, 0]])
+    """
+    mask = np.ascontiguousarray(mask, dtype=np.bool_)
+    if radius == 0:
+        return mask.copy()
+    dilated = cv2.dilate(mask.view(np.uint8), _CROSS, iterations=radius)
+    return dilated.view(np.bool_)
+
+
+class MaskDilation:
+    """
+    Dilates the land and cloud masks of scenes sharing the same land mask.
+
+    As dilation distributes over unions, the dilated land and cloud mask is the
+    union of the dilated land mask, which is computed once, and the dilated
+    cloud mask of the scene.
+
+    Args:
+        land_mask (NDArray): The land mask shared by the scenes.
+        radius (int): The radius of the diamond to dilate by.
+    """
+
+    def __init__(self, land_mask: NDArray, radius: int = MASK_DILATION_RADIUS):
+        self.radius = radius
+        self.land_mask_dilated = dilate_mask(land_mask, radius)
+
+    def dilate(self, cloud_mask: NDArray) -> NDArray[np.bool_]:
+        """Get the dilated union of the land mask and `cloud_mask`."""
+        return self.land_mask_dilated | dilate_mask(cloud_mask, self.radius)
@@ -1,25 +1,44 @@
 import datetime
+from dataclasses import dataclass
+from functools import lru_cache
 from logging import getLogger
-from typing import Optional
+from pathlib import Path
+from typing import Callable, Optional
 
 import numpy as np
 import pandas as pd
+from numpy.typing import NDArray
 import cv2
 from scipy import ndimage
 import skimage
 from skimage.filters import threshold_local
 from skimage.morphology import diamond, opening
 import rasterio
-from rasterio.enums import ColorInterp
 
-from ebfloeseg.masking import create_land_mask, maskrgb, mask_image, create_cloud_mask
+from ebfloeseg.ingest import read_rgb
+from ebfloeseg.masking import (
+    MaskDilation,
+    create_land_mask,
+    maskrgb,
+    mask_image,
+    create_cloud_mask,
+)
+from ebfloeseg.quicklook import quicklook, write_quicklook
 from ebfloeseg.savefigs import imsave, save_ice_mask_hist
+from ebfloeseg.stack import MASK_CLOUD, MASK_LAND, SceneStack, scene_key
+from ebfloeseg.triage import Triage, TriageThresholds, triage
+from ebfloeseg.window import SceneWindow
 from ebfloeseg.utils import (
-    write_mask_values,
-    get_wcuts,
+    RED_BINS,
+    SceneStats,
+    count_values,
+    write_mask_sums,
+    get_scene_stats,
+    get_wcuts_from_histogram,
     getmeta,
     getres,
     get_region_properties,
+    ice_floor,
     smallest_dtype,
 )
 
@@ -43,6 +62,7 @@ def get_remove_small_mask(watershed, it):
     return mask
 
 
+@lru_cache(maxsize=None)
 def get_erosion_kernel(erosion_kernel_type="diamond", erosion_kernel_size=1):
     if erosion_kernel_type == "diamond":
         erosion_kernel = diamond(erosion_kernel_size)
@@ -56,205 +76,423 @@ def get_erosion_kernel(erosion_kernel_type="diamond", erosion_kernel_size=1):
 logger = getLogger(__name__)
 
 
-def _preprocess(
-    ftci,
-    fcloud,
-    land_mask,
-    itmax,
-    itmin,
-    step,
-    erosion_kernel_type,
-    erosion_kernel_size,
-    save_figs,
-    save_direc,
-    doy="",
-    year="",
-    sat="",
-    res="",
-    fname_prefix="",
-):
-    tci = rasterio.open(ftci)
+@dataclass
+class SegmentationParams:
+    """Parameters of `segment`.
 
-    save_direc.mkdir(exist_ok=True, parents=True)
+    Attributes:
+        itmax: Erosion iterations of the first round of floe identification.
+        itmin: Erosion iterations of the last round.
+        step: Change of the erosion iterations between rounds.
+        erosion_kernel_type: "diamond" or "ellipse".
+        erosion_kernel_size: Size of the erosion kernel.
+        hist_stride: The histogram used for the ice thresholds is computed from
+            every `hist_stride`th row and column, which is faster for very
+            large scenes.
+        coarse_block_size: If set, a coarse pass over blocks of this many
+            pixels finds the parts of the scene which can't contain ice, and
+            the ice threshold is only computed for the others, see
+            `classify_blocks`. The result is the same, but faster for scenes
+            with little ice.
+        triage: If set, scenes which fail these thresholds are skipped before
+            the expensive steps, see `ebfloeseg.triage`.
+    """
 
-    cloud_mask = create_cloud_mask(fcloud)
+    itmax: int = 8
+    itmin: int = 3
+    step: int = -1
+    erosion_kernel_type: str = "diamond"
+    erosion_kernel_size: int = 1
+    hist_stride: int = 1
+    coarse_block_size: Optional[int] = None
+    triage: Optional[TriageThresholds] = None
 
-    match tci.colorinterp:
-        case (ColorInterp.red, ColorInterp.green, ColorInterp.blue):
-            red_c, green_c, blue_c = tci.read()
-            assert tci.colorinterp[0] is ColorInterp.red
-        case (ColorInterp.red, ColorInterp.green, ColorInterp.blue, _):
-            red_c, green_c, blue_c, _ = tci.read()
-        case _:
-            msg = "unknown number of dimensions %s" % tci.colorinterp
-            raise ValueError(msg)
 
-    rgb_masked = np.dstack([red_c, green_c, blue_c])  # masked below
+@dataclass
+class SegmentationResult:
+    """The outputs of `segment` for one scene.
 
-    maskrgb(rgb_masked, cloud_mask)
-    if save_figs:
-        fname = f"{fname_prefix}cloud_mask_on_rgb.tif"
-        imsave(tci, rgb_masked, save_direc, fname)
+    Attributes:
+        labels: The labelled floes, 0 where there is no floe.
+        ice_mask: The ice mask, before the floes were identified.
+        props: The properties of the floes, one row per label.
+        stats: Statistics of the red channel of the scene outside the masks.
+        ow_cut_min, ow_cut_max: The limits of the adaptive ice threshold.
+        triage: The triage of the scene, if it was triaged.
+    """
 
-    maskrgb(rgb_masked, land_mask)
-    if save_figs:
-        fname = f"{fname_prefix}land_cloud_mask_on_rgb.tif"
-        imsave(tci, rgb_masked, save_direc, fname)
+    labels: NDArray
+    ice_mask: NDArray[np.bool_]
+    props: pd.DataFrame
+    stats: SceneStats
+    ow_cut_min: float
+    ow_cut_max: float
+    triage: Optional[Triage] = None
 
-    ## adaptive threshold for ice mask
-    red_masked = rgb_masked[:, :, 0]
-    thresh_adaptive = threshold_local(red_c, block_size=399)
+    @property
+    def skipped(self) -> Optional[str]:
+        """Why the scene was skipped by the triage, or None if it was segmented."""
+        return None if self.triage is None else self.triage.reason
 
-    # here just determining the min and max values for the adaptive threshold
-    ow_cut_min, ow_cut_max, bins = get_wcuts(red_masked)
+    @property
+    def ice_area(self) -> int:
+        """Number of pixels in the ice mask."""
+        return int(np.count_nonzero(self.ice_mask))
+
+    @property
+    def unmasked(self) -> int:
+        """Number of pixels not covered by land or clouds."""
+        return self.stats.unmasked
 
-    if save_figs:
-        save_ice_mask_hist(
-            red_masked=red_masked,
-            bins=bins,
-            mincut=ow_cut_min,
-            maxcut=ow_cut_max,
-            target_dir=save_direc,
-            fname=f"{fname_prefix}ice_mask_hist.png",
-        )
 
+# Block size of the adaptive ice threshold, and how far (in pixels) its
+# Gaussian filter reaches, with the default truncation of scipy.ndimage.
+THRESHOLD_BLOCK_SIZE = 399
+THRESHOLD_REACH = int(4.0 * (THRESHOLD_BLOCK_SIZE - 1) / 6.0 + 0.5)
+
+# classes of the blocks of the coarse pass
+BLOCK_MASKED = 0  # covered by land or clouds
+BLOCK_EMPTY = 1  # no pixel is bright enough to be ice
+BLOCK_ICE = 2  # may contain ice
+
+
+def _ice_mask(red_c, red_masked, ow_cut_min, ow_cut_max):
+    thresh_adaptive = threshold_local(red_c, block_size=THRESHOLD_BLOCK_SIZE)
     thresh_adaptive = np.clip(thresh_adaptive, ow_cut_min, ow_cut_max)
+    return red_masked > thresh_adaptive
 
-    ice_mask = red_masked > thresh_adaptive
 
-    # a simple text file with columns: 'doy','ice_area','unmasked','sic'
-    write_mask_values(
-        lmd=land_mask + cloud_mask,
-        ice_mask=ice_mask,
-        doy=doy,
-        save_direc=save_direc,
-        fname=f"{fname_prefix}mask_values.txt",
-    )
+def _block_reduce(img: NDArray, block_size: int, fill, fn) -> NDArray:
+    """Apply `fn` to the blocks of `img`, padding it with `fill` to whole blocks."""
+    height, width = img.shape
+    rows, cols = -(-height // block_size), -(-width // block_size)
+    padded = np.full((rows * block_size, cols * block_size), fill, dtype=img.dtype)
+    padded[:height, :width] = img
+    return fn(padded.reshape(rows, block_size, cols, block_size), axis=(1, 3))
 
-    # saving ice mask
-    fname = f"{fname_prefix}ice_mask_bw.tif"
-    if save_figs:
-        imsave(
-            tci=tci,
-            img=ice_mask,
-            save_direc=save_direc,
-            fname=fname,
-            count=1,
-            rollaxis=False,
-            dtype=np.bool_,
-            res=res,
-        )
 
-    # here dilating the land and cloud mask so any floes that are adjacent to the mask can be removed later
-    land_cloud_mask = (land_mask + cloud_mask).astype(int)
-    land_cloud_mask_dilated = skimage.morphology.binary_dilation(
-        land_cloud_mask, diamond(10)
-    )
+def classify_blocks(
+    red_masked: NDArray[np.uint8],
+    land_cloud_mask: NDArray[np.bool_],
+    floor: float,
+    block_size: int,
+) -> NDArray[np.uint8]:
+    """
+    Classify the blocks of a scene for the coarse pass of `segment`.
 
-    # setting up different kernel for erosion-expansion algo
-    erosion_kernel = get_erosion_kernel(erosion_kernel_type, erosion_kernel_size)
+    The ice threshold is never below `floor`, so a block without a pixel
+    brighter than that contains no ice. Only the blocks which may contain ice
+    need to be segmented.
 
-    # TODO: clarify this block
-    inp = ice_mask
-    input_no = ice_mask
-    output = np.zeros((np.shape(ice_mask)), dtype=np.int16)
-    itmax = itmax
-    itmin = itmin
-    step = step
-    highest_label_so_far = 0
+    Args:
+        red_masked (NDArray[np.uint8]): The red channel, 0 where it is masked.
+        land_cloud_mask (NDArray[np.bool_]): The land and cloud mask.
+        floor (float): The lowest possible ice threshold, see `ice_floor`.
+        block_size (int): The size of the blocks, in pixels.
 
-    for r, it in enumerate(range(itmax, itmin - 1, step)):
-        # erode a lot at first, decrease number of iterations each time
-        eroded_ice_mask = cv2.erode(inp.astype(np.uint8), erosion_kernel, iterations=it)
-        eroded_ice_mask = ndimage.binary_fill_holes(eroded_ice_mask.astype(np.uint8))
+    Returns:
+        NDArray[np.uint8]: BLOCK_MASKED, BLOCK_EMPTY or BLOCK_ICE for each block.
 
-        dilated_ice_mask = cv2.dilate(
-            inp.astype(np.uint8), erosion_kernel, iterations=it
-        )
+    Examples:
+        >>> red = np.array([[0, 0, 10, 10], [0, 0, 10, 200]], dtype=np.uint8)
+        >>> classify_blocks(red, red == 0, 50, 2)
+        array([[0, 2]], dtype=uint8)
+        >>> classify_blocks(red, red == 0, 200, 2)
+        array([[0, 1]], dtype=uint8)
+    """
+    masked = _block_reduce(land_cloud_mask, block_size, True, np.all)
+    brightest = _block_reduce(red_masked, block_size, 0, np.max)
+    blocks = np.where(brightest > floor, BLOCK_ICE, BLOCK_EMPTY)
+    blocks[masked] = BLOCK_MASKED
+    return blocks.astype(np.uint8)
 
-        # label floes remaining after erosion
-        n, markers, _, _ = cv2.connectedComponentsWithStats(
-            eroded_ice_mask.astype(np.uint8)
-        )
 
-        # Add one to all labels so that sure background is not 0, but 1
-        markers = markers + 1
+def _coarse_ice_mask(
+    red_c, red_masked, land_cloud_mask, ow_cut_min, ow_cut_max, block_size
+):
+    """
+    Compute the ice mask only around the blocks which may contain ice.
+
+    The threshold is computed for the bounding boxes of groups of these
+    blocks, padded by the reach of its filter, so that it is exactly the same
+    as for the whole scene where it is used.
+    """
+    height, width = red_masked.shape
+    blocks = classify_blocks(
+        red_masked, land_cloud_mask, ice_floor(ow_cut_min, ow_cut_max), block_size
+    )
+    logger.debug(
+        "coarse pass: %s masked, %s empty and %s blocks with ice",
+        *np.bincount(blocks.ravel(), minlength=3),
+    )
+    ice_mask = np.zeros(red_masked.shape, dtype=bool)
+    if not (blocks == BLOCK_ICE).any():
+        return ice_mask
 
-        unknown = cv2.subtract(
-            dilated_ice_mask.astype(np.uint8), eroded_ice_mask.astype(np.uint8)
+    # the blocks with ice, padded by the reach of the threshold filter, and
+    # the bounding boxes of the connected parts of that
+    reach = -(-THRESHOLD_REACH // block_size)
+    padded = cv2.dilate(
+        (blocks == BLOCK_ICE).view(np.uint8), np.ones((2 * reach + 1,) * 2, np.uint8)
+    )
+    _, _, stats, _ = cv2.connectedComponentsWithStats(padded)
+    crops = [
+        (
+            slice(top * block_size, min((top + h) * block_size, height)),
+            slice(left * block_size, min((left + w) * block_size, width)),
         )
+        for left, top, w, h, _ in stats[1:]
+    ]
+    covered = sum((c[0].stop - c[0].start) * (c[1].stop - c[1].start) for c in crops)
+    if covered >= height * width:
+        return _ice_mask(red_c, red_masked, ow_cut_min, ow_cut_max)
 
-        # Now, mark the region of unknown with zero
-        # markers[unknown == 255] = 0
-        mask_image(markers, unknown == 255, 0)
+    for crop in crops:
+        # the threshold is exact from the reach of the filter onwards, and at
+        # the edges of the scene, and the blocks with ice are within that
+        inner = tuple(
+            slice(
+                0 if c.start == 0 else THRESHOLD_REACH,
+                (c.stop - c.start) - (0 if c.stop == size else THRESHOLD_REACH),
+            )
+            for c, size in zip(crop, (height, width))
+        )
+        ice_mask[crop][inner] = _ice_mask(
+            red_c[crop], red_masked[crop], ow_cut_min, ow_cut_max
+        )[inner]
+    return ice_mask
 
-        # dilate each marker
-        for a in np.arange(0, it + 1, 1):
-            markers = skimage.morphology.dilation(markers, erosion_kernel)
 
-        # rewatershed
-        watershed = cv2.watershed(rgb_masked, markers)
+def segment(
+    rgb: NDArray[np.uint8],
+    cloud_mask: NDArray[np.bool_],
+    land_mask: NDArray[np.bool_],
+    params: Optional[SegmentationParams] = None,
+    mask_dilation: Optional[MaskDilation] = None,
+    on_round: Optional[Callable[[int, NDArray], None]] = None,
+    overwrite_rgb: bool = False,
+) -> SegmentationResult:
+    """
+    Identify the floes in a scene held in memory, without reading or writing files.
 
-        # get rid of floes that intersect the dilated land mask
-        watershed[
-            np.isin(
-                watershed,
-                np.unique(watershed[land_cloud_mask_dilated & (watershed > 1)]),
+    Args:
+        rgb (NDArray[np.uint8]): The true-color image, of shape (H, W, 3).
+        cloud_mask (NDArray[np.bool_]): The cloud mask, of shape (H, W).
+        land_mask (NDArray[np.bool_]): The land mask, of shape (H, W).
+        params (SegmentationParams, optional): Defaults to `SegmentationParams()`.
+        mask_dilation (MaskDilation, optional): The dilated land mask, if it is
+            the same for many scenes. Defaults to dilating `land_mask`.
+        on_round (Callable, optional): Called with each round of floe
+            identification and its watershed, see `identify_floes`.
+        overwrite_rgb (bool): Mask `rgb` in place, rather than a copy of it,
+            which saves memory if the caller doesn't need it any more.
+
+    Returns:
+        SegmentationResult: The floes, ice mask, floe properties and scene stats.
+    """
+    if params is None:
+        params = SegmentationParams()
+    if rgb.ndim != 3 or rgb.shape[2] != 3:
+        raise ValueError("rgb must have shape (H, W, 3), not %s" % (rgb.shape,))
+    for name, mask in [("cloud_mask", cloud_mask), ("land_mask", land_mask)]:
+        if mask.shape != rgb.shape[:2]:
+            msg = "%s has shape %s, but rgb has shape %s" % (
+                name,
+                mask.shape,
+                rgb.shape,
             )
-        ] = 1
+            raise ValueError(msg)
 
-        # set the open water and already identified floes to no
-        # watershed[~input_no] = 1
-        mask_image(watershed, ~input_no, 1)
+    scene_triage = None
+    if params.triage is not None:
+        scene_triage = triage(rgb[:, :, 0], cloud_mask, land_mask, params.triage)
+        if not scene_triage.usable:
+            logger.info("skipping the scene: %s", scene_triage.reason)
+            return _skipped_result(
+                rgb[:, :, 0], cloud_mask, land_mask, scene_triage, params.triage.stride
+            )
+
+    if overwrite_rgb:
+        # keep a copy of the unmasked red channel
+        red_c = rgb[:, :, 0].copy()
+        rgb_masked = rgb
+    else:
+        red_c = rgb[:, :, 0]
+        rgb_masked = rgb.copy()
 
-        # get rid of ones that are too small
-        area_lim = (it) ** 4
-        props = skimage.measure.regionprops_table(
-            watershed, properties=["label", "area"]
+    land_cloud_mask = land_mask | cloud_mask
+    maskrgb(rgb_masked, land_cloud_mask)
+
+    red_masked = rgb_masked[:, :, 0]
+
+    # one pass over the red channel gives the histogram for the thresholds,
+    # the figure and the mask values
+    stats = get_scene_stats(red_masked, land_cloud_mask, stride=params.hist_stride)
+
+    # here just determining the min and max values for the adaptive threshold
+    ow_cut_min, ow_cut_max = get_wcuts_from_histogram(
+        stats.histogram(RED_BINS), RED_BINS
+    )
+
+    ## adaptive threshold for ice mask
+    if params.coarse_block_size:
+        ice_mask = _coarse_ice_mask(
+            red_c,
+            red_masked,
+            land_cloud_mask,
+            ow_cut_min,
+            ow_cut_max,
+            params.coarse_block_size,
         )
-        df = pd.DataFrame.from_dict(props)
-        watershed[np.isin(watershed, df[df.area < area_lim].label.values)] = 1
-
-        if save_figs:
-            fname = f"{fname_prefix}identification_round_{r}.tif"
-            imsave(
-                tci=tci,
-                img=watershed,
-                save_direc=save_direc,
-                fname=fname,
-                count=1,
-                rollaxis=False,
-                dtype=np.uint8,
-                res=res,
-            )
+    else:
+        ice_mask = _ice_mask(red_c, red_masked, ow_cut_min, ow_cut_max)
 
-        input_no = ice_mask + inp
-        inp = (watershed == 1) & (inp == 1) & ice_mask
-        watershed[watershed < 2] = 0
-        new_label_mask = watershed > 0
-        output[new_label_mask] = watershed[new_label_mask] + highest_label_so_far
-        highest_label_so_far = np.max(output)
+    # here dilating the land and cloud mask so any floes that are adjacent to the mask can be removed later
+    if mask_dilation is None:
+        mask_dilation = MaskDilation(land_mask)
+    land_cloud_mask_dilated = mask_dilation.dilate(cloud_mask)
+
+    # setting up different kernel for erosion-expansion algo
+    erosion_kernel = get_erosion_kernel(
+        params.erosion_kernel_type, params.erosion_kernel_size
+    )
+
+    output = identify_floes(
+        ice_mask=ice_mask,
+        rgb_masked=rgb_masked,
+        land_cloud_mask_dilated=land_cloud_mask_dilated,
+        itmax=params.itmax,
+        itmin=params.itmin,
+        step=params.step,
+        erosion_kernel=erosion_kernel,
+        on_round=on_round,
+    )
 
     # Clean the final props
     output = opening(output)
     output = clean_labels_with_multiple_blobs(output)
+    assert (
+        output.min() >= 0
+    ), "negative values found, but values should never be smaller than zero"
+
+    props = pd.DataFrame.from_dict(get_region_properties(output, red_c))
+
+    return SegmentationResult(
+        labels=output,
+        ice_mask=ice_mask,
+        props=props,
+        stats=stats,
+        ow_cut_min=ow_cut_min,
+        ow_cut_max=ow_cut_max,
+        triage=scene_triage,
+    )
+
+
+def _skipped_result(red, cloud_mask, land_mask, scene_triage: Triage, stride: int):
+    """The empty outputs of a scene which was skipped by the triage."""
+    land_cloud_mask = land_mask | cloud_mask
+    sample = np.where(land_cloud_mask[::stride, ::stride], 0, red[::stride, ::stride])
+    no_labels = np.zeros((1, 1), dtype=np.int16)
+    return SegmentationResult(
+        labels=np.zeros(red.shape, dtype=np.int16),
+        ice_mask=np.zeros(red.shape, dtype=bool),
+        props=pd.DataFrame.from_dict(get_region_properties(no_labels, no_labels)),
+        stats=SceneStats(
+            red_counts=count_values(sample),
+            unmasked=land_cloud_mask.size - np.count_nonzero(land_cloud_mask),
+            stride=stride,
+        ),
+        ow_cut_min=(
+            np.nan if scene_triage.ow_cut_min is None else scene_triage.ow_cut_min
+        ),
+        ow_cut_max=(
+            np.nan if scene_triage.ow_cut_max is None else scene_triage.ow_cut_max
+        ),
+        triage=scene_triage,
+    )
+
+
+def write_segmentation(
+    result: SegmentationResult,
+    tci,
+    save_direc: Path,
+    save_figs: bool = False,
+    doy="",
+    sat="",
+    res="",
+    fname_prefix="",
+    window=None,
+) -> None:
+    """
+    Write the outputs of `segment` next to each other, georeferenced like `tci`.
+
+    Always writes the mask values, the props table and the labelled floes, and
+    with `save_figs` also the ice mask and the histogram of the red channel.
+    The triage of a triaged scene is written to `triage.json`; the outputs of
+    a scene it skipped are empty.
+
+    Args:
+        result (SegmentationResult): The outputs of `segment`.
+        tci (DatasetReader): The true-color raster the scene was read from.
+        save_direc (Path): Directory for the files.
+        save_figs (bool): Whether to write the figures too.
+        doy, sat, res, fname_prefix: Used in the names and contents of the files.
+        window (rasterio.windows.Window, optional): The part of `tci` which was
+            segmented.
+    """
+    save_direc.mkdir(exist_ok=True, parents=True)
+
+    if result.triage is not None:
+        result.triage.write(save_direc / f"{fname_prefix}triage.json")
+
+    # the thresholds of a skipped scene may be unknown
+    if save_figs and not result.skipped:
+        save_ice_mask_hist(
+            hist=result.stats.histogram(RED_BINS),
+            bins=RED_BINS,
+            mincut=result.ow_cut_min,
+            maxcut=result.ow_cut_max,
+            target_dir=save_direc,
+            fname=f"{fname_prefix}ice_mask_hist.png",
+        )
 
-    # saving the props table
     fname_infix = ""
     if sat:
         fname_infix = f"{sat}_{fname_infix}"
     if res:
         fname_infix = f"{res}_{fname_infix}"
 
-    extract_features(
-        output, red_c, save_direc, fname=f"{fname_prefix}{fname_infix}props.csv"
+    # a simple text file with columns: 'doy','ice_area','unmasked','sic'
+    # the scenes of a batch have their own file, named like their props table,
+    # which processing the scene again replaces; single scenes append to theirs
+    write_mask_sums(
+        ice_mask_sum=result.ice_area,
+        land_cloud_mask_sum=result.unmasked,
+        doy=doy,
+        save_direc=save_direc,
+        fname=f"{fname_prefix}{fname_infix}mask_values.txt",
+        replace=bool(sat),
     )
 
+    # saving ice mask
+    if save_figs:
+        imsave(
+            tci=tci,
+            img=result.ice_mask,
+            save_direc=save_direc,
+            fname=f"{fname_prefix}ice_mask_bw.tif",
+            count=1,
+            rollaxis=False,
+            dtype=np.bool_,
+            res=res,
+            window=window,
+        )
+
+    # saving the props table
+    result.props.to_csv(save_direc / f"{fname_prefix}{fname_infix}props.csv")
+
     # saving the label floes tif
     fname = "final.tif"
-    assert (
-        output.min() >= 0
-    ), "negative values found, but values should never be smaller than zero"
     if sat:
         fname = f"{sat}_{fname}"
     if fname_prefix:
@@ -262,16 +500,466 @@ def _preprocess(
 
     imsave(
         tci=tci,
-        img=output,
+        img=result.labels,
         save_direc=save_direc,
         fname=fname,
         count=1,
         rollaxis=False,
-        dtype=smallest_dtype(output),
+        dtype=smallest_dtype(result.labels),
+        res=res,
+        window=window,
+    )
+
+
+def segment_and_write(
+    tci,
+    rgb: NDArray[np.uint8],
+    cloud_mask: NDArray[np.bool_],
+    land_mask: NDArray[np.bool_],
+    params: SegmentationParams,
+    save_figs: bool,
+    save_direc: Path,
+    doy="",
+    sat="",
+    res="",
+    fname_prefix="",
+    window=None,
+    mask_dilation: Optional[MaskDilation] = None,
+    quicklook_factor: Optional[int] = None,
+    stack: Optional[SceneStack] = None,
+    stack_key: Optional[str] = None,
+) -> SegmentationResult:
+    """
+    Segment a scene with `segment` and write the outputs with `write_segmentation`.
+
+    With `save_figs`, the masked true-color images and the watershed of each
+    round are written too. With `quicklook_factor`, a small preview of the
+    scene is written to `quicklook.png`, see `ebfloeseg.quicklook`. With
+    `stack`, the labels, the ice mask and the land and cloud mask are also
+    appended to it as `stack_key`. `rgb` is masked in place.
+
+    Args:
+        tci (DatasetReader): The true-color raster `rgb` was read from, whose
+            georeferencing the outputs get. It may be held in memory.
+        window (rasterio.windows.Window, optional): The part of `tci` in `rgb`.
+        quicklook_factor (int, optional): Decimation factor of the preview.
+        stack (SceneStack, optional), stack_key (str): See `SceneStack.append`.
+        Others: see `segment` and `write_segmentation`.
+
+    Returns:
+        SegmentationResult: The outputs.
+    """
+    save_direc.mkdir(exist_ok=True, parents=True)
+
+    if save_figs:
+        rgb_masked = rgb.copy()
+        maskrgb(rgb_masked, cloud_mask)
+        fname = f"{fname_prefix}cloud_mask_on_rgb.tif"
+        imsave(tci, rgb_masked, save_direc, fname, window=window)
+        maskrgb(rgb_masked, land_mask)
+        fname = f"{fname_prefix}land_cloud_mask_on_rgb.tif"
+        imsave(tci, rgb_masked, save_direc, fname, window=window)
+        del rgb_masked
+
+    def save_round(r, watershed):
+        fname = f"{fname_prefix}identification_round_{r}.tif"
+        imsave(
+            tci=tci,
+            img=watershed,
+            save_direc=save_direc,
+            fname=fname,
+            count=1,
+            rollaxis=False,
+            dtype=np.uint8,
+            res=res,
+            window=window,
+        )
+
+    result = segment(
+        rgb,
+        cloud_mask,
+        land_mask,
+        params,
+        mask_dilation=mask_dilation,
+        on_round=save_round if save_figs else None,
+        overwrite_rgb=True,
+    )
+
+    write_segmentation(
+        result,
+        tci,
+        save_direc,
+        save_figs=save_figs,
+        doy=doy,
+        sat=sat,
+        res=res,
+        fname_prefix=fname_prefix,
+        window=window,
+    )
+
+    if quicklook_factor:
+        if result.skipped:
+            # segment returns before masking the image of a skipped scene
+            maskrgb(rgb, land_mask | cloud_mask)
+        write_quicklook(
+            save_direc / f"{fname_prefix}quicklook.png",
+            quicklook(rgb, result.ice_mask, result.labels, quicklook_factor),
+        )
+
+    if stack is not None:
+        mask = land_mask.astype(np.uint8) * MASK_LAND
+        mask |= cloud_mask.astype(np.uint8) * MASK_CLOUD
+        stack.append(
+            stack_key,
+            {"labels": result.labels, "ice_mask": result.ice_mask, "mask": mask},
+            transform=tci.transform if window is None else tci.window_transform(window),
+            crs=None if tci.crs is None else tci.crs.to_wkt(),
+            ice_area=result.ice_area,
+            unmasked=result.unmasked,
+            skipped=result.skipped,
+        )
+    return result
+
+
+def _preprocess(
+    ftci,
+    fcloud,
+    land_mask,
+    itmax,
+    itmin,
+    step,
+    erosion_kernel_type,
+    erosion_kernel_size,
+    save_figs,
+    save_direc,
+    doy="",
+    year="",
+    sat="",
+    res="",
+    fname_prefix="",
+    window: Optional[SceneWindow] = None,
+    hist_stride: int = 1,
+    mask_dilation: Optional[MaskDilation] = None,
+    coarse_block_size: Optional[int] = None,
+    triage: Optional[TriageThresholds] = None,
+    quicklook_factor: Optional[int] = None,
+    stack: Optional[SceneStack] = None,
+):
+    tci = rasterio.open(ftci)
+
+    # only the pixels of the tci covered by the window are read
+    tci_window = None if window is None else window.to_window(tci)
+
+    cloud_mask = create_cloud_mask(fcloud, window=window)
+
+    # decode the red, green and blue bands straight into the (H, W, 3) buffer
+    # used by cv2, which is then masked in place
+    rgb = read_rgb(tci, window=tci_window)
+
+    stack_key = None
+    if stack is not None:
+        if not year or not doy:
+            raise ValueError("a scene needs a date to be appended to a stack")
+        date = datetime.date(int(year), 1, 1) + datetime.timedelta(days=int(doy) - 1)
+        stack_key = scene_key(date, sat)
+
+    segment_and_write(
+        tci,
+        rgb,
+        cloud_mask,
+        land_mask,
+        SegmentationParams(
+            itmax=itmax,
+            itmin=itmin,
+            step=step,
+            erosion_kernel_type=erosion_kernel_type,
+            erosion_kernel_size=erosion_kernel_size,
+            hist_stride=hist_stride,
+            coarse_block_size=coarse_block_size,
+            triage=triage,
+        ),
+        save_figs=save_figs,
+        save_direc=save_direc,
+        doy=doy,
+        sat=sat,
         res=res,
+        fname_prefix=fname_prefix,
+        window=tci_window,
+        mask_dilation=mask_dilation,
+        quicklook_factor=quicklook_factor,
+        stack=stack,
+        stack_key=stack_key,
     )
 
 
+# Rough cost of processing one more region of interest separately, in pixels of
+# a round over the whole image. Regions are only used while they save work.
+ROI_OVERHEAD_PIXELS = 4096
+
+# Overlapping regions of interest are merged on a grid of cells of this size.
+ROI_GRID = 16
+
+
+def _regions_of_interest(inp, reach):
+    """
+    Group the components of `inp` into boxes which can be processed separately.
+
+    The bounding box of each component is padded by `reach` pixels, the furthest
+    its erosion, dilation and markers extend, and overlapping boxes are merged
+    until no two boxes overlap. Components nested in the holes of another one
+    are in the same box, as hole filling joins them.
+
+    Returns:
+        tuple: the labels of the components of `inp`, the index of the box of
+            each label (-1 for the background), and the boxes as slices.
+    """
+    height, width = inp.shape
+    n, labels, stats, _ = cv2.connectedComponentsWithStats(inp.view(np.uint8))
+    x0 = np.maximum(stats[1:, cv2.CC_STAT_LEFT] - reach, 0)
+    y0 = np.maximum(stats[1:, cv2.CC_STAT_TOP] - reach, 0)
+    x1 = np.minimum(
+        stats[1:, cv2.CC_STAT_LEFT] + stats[1:, cv2.CC_STAT_WIDTH] + reach, width
+    )
+    y1 = np.minimum(
+        stats[1:, cv2.CC_STAT_TOP] + stats[1:, cv2.CC_STAT_HEIGHT] + reach, height
+    )
+
+    # merge overlapping boxes, by drawing them on a coarse grid and taking the
+    # bounding boxes of the connected areas, until no more boxes are merged
+    boxes = np.stack([y0, y1, x0, x1], axis=1)
+    box_of_label = np.concatenate([[-1], np.arange(n - 1)])
+    grid = (-(-height // ROI_GRID) + 1, -(-width // ROI_GRID) + 1)
+    while True:
+        # draw all boxes at once, as the cumulative sum of their corners
+        top, left = boxes[:, 0] // ROI_GRID, boxes[:, 2] // ROI_GRID
+        bottom, right = -(-boxes[:, 1] // ROI_GRID), -(-boxes[:, 3] // ROI_GRID)
+        corners = np.zeros(grid, dtype=np.int32)
+        np.add.at(corners, (top, left), 1)
+        np.add.at(corners, (top, right), -1)
+        np.add.at(corners, (bottom, left), -1)
+        np.add.at(corners, (bottom, right), 1)
+        canvas = (corners.cumsum(axis=0).cumsum(axis=1) > 0).astype(np.uint8)
+        m, areas = cv2.connectedComponents(canvas)
+        area_of_box = areas[top, left] - 1
+        if m - 1 == len(boxes):
+            break
+        merged = np.empty((m - 1, 4), dtype=boxes.dtype)
+        merged[:, [0, 2]] = max(height, width)
+        merged[:, [1, 3]] = 0
+        np.minimum.at(merged[:, 0], area_of_box, boxes[:, 0])
+        np.maximum.at(merged[:, 1], area_of_box, boxes[:, 1])
+        np.minimum.at(merged[:, 2], area_of_box, boxes[:, 2])
+        np.maximum.at(merged[:, 3], area_of_box, boxes[:, 3])
+        box_of_label[1:] = area_of_box[box_of_label[1:]]
+        boxes = merged
+
+    return (
+        labels,
+        box_of_label,
+        [
+            (slice(top, bottom), slice(left, right))
+            for top, bottom, left, right in boxes
+        ],
+    )
+
+
+def fill_holes(mask: NDArray) -> NDArray[np.bool_]:
+    """
+    Fill the holes of a binary mask, as `ndimage.binary_fill_holes` does.
+
+    A hole is a part of the background which isn't 4-connected to the edge of
+    the image. SciPy finds them by dilating the background from the edge
+    until it stops changing, which takes as many passes as the widest ice
+    area; here the background is flooded from the edge in a single pass.
+
+    Args:
+        mask (NDArray): The mask, nonzero where it is set.
+
+    Returns:
+        NDArray[np.bool_]: The mask with its holes filled.
+
+    Examples:
+        >>> mask = np.array([[1, 1, 1, 0],
+        ...                  [1, 0, 1, 0],
+        ...                  [1, 1, 1, 0],
+        ...                  [0, 1, 0, 1]], dtype=np.uint8)
+        >>> fill_holes(mask).astype(int)
+        array([[1, 1, 1, 0],
+               [1, 1, 1, 0],
+               [1, 1, 1, 0],
+               [0, 1, 0, 1]])
+    """
+    height, width = mask.shape
+    # a frame of background joins all the background on the edge of the mask
+    flooded = np.zeros((height + 2, width + 2), dtype=np.uint8)
+    flooded[1:-1, 1:-1] = mask != 0
+    cv2.floodFill(flooded, None, (0, 0), 2, flags=4)
+    return flooded[1:-1, 1:-1] != 2
+
+
+def identify_floes(
+    ice_mask,
+    rgb_masked,
+    land_cloud_mask_dilated,
+    itmax,
+    itmin,
+    step,
+    erosion_kernel,
+    on_round=None,
+):
+    """
+    Identify the floes in the ice mask in rounds of erosion, expansion and watershed.
+
+    Each round erodes the ice which is still unresolved a bit less, labels the
+    eroded floes, grows them back and keeps the labels of the floes which are
+    large enough and clear of land and clouds.
+
+    After the first rounds only a little ice is unresolved. Each round is
+    therefore run separately on boxes around the remaining ice, padded by how
+    far the round reaches, unless the boxes cover too much of the scene. The
+    eroded floes are still labelled over the whole scene, in a single fast
+    pass, so that the labels are the same as for a round over the whole scene.
+    The rounds stop once no ice is left to resolve.
+
+    Args:
+        ice_mask (NDArray[np.bool_]): The ice mask.
+        rgb_masked (NDArray): The masked RGB image, for the watershed.
+        land_cloud_mask_dilated (NDArray[np.bool_]): Floes touching this are removed.
+        itmax (int): Erosion iterations of the first round.
+        itmin (int): Erosion iterations of the last round.
+        step (int): Change of the erosion iterations between rounds.
+        erosion_kernel (NDArray): The erosion kernel.
+        on_round (Callable, optional): Called with the round and the watershed
+            of the whole scene after each round, e.g. to save it.
+
+    Returns:
+        NDArray[np.int16]: The labelled floes.
+    """
+    height, width = ice_mask.shape
+    whole = (slice(0, height), slice(0, width))
+    kernel_reach = max(np.shape(erosion_kernel)) // 2
+
+    # the unresolved ice is always part of the ice mask, so the pixels outside
+    # the ice mask are the ones which are set to no in each round
+    inp = ice_mask.copy()
+    output = np.zeros((np.shape(ice_mask)), dtype=np.int16)
+    highest_label_so_far = 0
+    eroded = np.zeros(ice_mask.shape, dtype=np.uint8)
+
+    for r, it in enumerate(range(itmax, itmin - 1, step)):
+        if not inp.any():
+            # nothing is left to segment, so the other rounds wouldn't add floes
+            break
+
+        labels, box_of_label, boxes = _regions_of_interest(inp, (it + 1) * kernel_reach)
+        covered = sum(
+            (b[0].stop - b[0].start) * (b[1].stop - b[1].start) for b in boxes
+        )
+        if covered + ROI_OVERHEAD_PIXELS * len(boxes) >= height * width:
+            regions = [(whole, whole, whole, inp)]
+        else:
+            regions = []
+            for i, box in enumerate(boxes):
+                # a margin of one pixel keeps the edges of the crop away from
+                # the box, as the watershed marks the edges of its image
+                crop = tuple(
+                    slice(max(b.start - 1, 0), min(b.stop + 1, size))
+                    for b, size in zip(box, (height, width))
+                )
+                in_crop = tuple(
+                    slice(b.start - c.start, b.stop - c.start)
+                    for b, c in zip(box, crop)
+                )
+                # only the components of this box, the others are far enough away
+                region_inp = box_of_label[labels[crop]] == i
+                regions.append((box, crop, in_crop, region_inp))
+
+        # erode a lot at first, decrease number of iterations each time
+        eroded[...] = 0
+        for _, crop, in_crop, region_inp in regions:
+            eroded_ice_mask = cv2.erode(
+                region_inp.astype(np.uint8), erosion_kernel, iterations=it
+            )
+            eroded_ice_mask = fill_holes(eroded_ice_mask)
+            eroded[crop][in_crop] = eroded_ice_mask[in_crop]
+
+        # label floes remaining after erosion
+        n, markers_all, _, _ = cv2.connectedComponentsWithStats(eroded)
+
+        watershed_all = None
+        if on_round is not None:
+            # outside the regions, the watershed marks the edges of the image,
+            # and pixels outside the ice mask are set to no
+            watershed_all = np.ones(ice_mask.shape, dtype=np.int32)
+            edges = np.zeros(ice_mask.shape, dtype=np.bool_)
+            edges[[0, -1], :] = edges[:, [0, -1]] = True
+            watershed_all[edges & ice_mask] = -1
+
+        for box, crop, in_crop, region_inp in regions:
+            dilated_ice_mask = cv2.dilate(
+                region_inp.astype(np.uint8), erosion_kernel, iterations=it
+            )
+
+            # Add one to all labels so that sure background is not 0, but 1
+            markers = np.ones(region_inp.shape, dtype=np.int32)
+            markers[in_crop] = markers_all[crop][in_crop] + 1
+            eroded_ice_mask = eroded[crop]
+
+            unknown = cv2.subtract(
+                dilated_ice_mask.astype(np.uint8), eroded_ice_mask.astype(np.uint8)
+            )
+
+            # Now, mark the region of unknown with zero
+            # markers[unknown == 255] = 0
+            mask_image(markers, unknown == 255, 0)
+
+            # dilate each marker
+            for a in np.arange(0, it + 1, 1):
+                markers = skimage.morphology.dilation(markers, erosion_kernel)
+
+            # rewatershed
+            watershed = cv2.watershed(rgb_masked[crop], markers)[in_crop]
+
+            # get rid of floes that intersect the dilated land mask
+            watershed[
+                np.isin(
+                    watershed,
+                    np.unique(
+                        watershed[land_cloud_mask_dilated[box] & (watershed > 1)]
+                    ),
+                )
+            ] = 1
+
+            # set the open water and already identified floes to no
+            # watershed[~input_no] = 1
+            mask_image(watershed, ~ice_mask[box], 1)
+
+            # get rid of ones that are too small
+            area_lim = (it) ** 4
+            lowest = min(watershed.min(), 0)
+            areas = np.bincount((watershed - lowest).ravel())
+            too_small = areas < area_lim
+            too_small[: 1 - lowest] = False  # not a floe
+            watershed[too_small[watershed - lowest]] = 1
+
+            if watershed_all is not None:
+                watershed_all[box] = watershed
+
+            inp[box] = (watershed == 1) & inp[box]
+            watershed[watershed < 2] = 0
+            new_label_mask = watershed > 0
+            output[box][new_label_mask] = (
+                watershed[new_label_mask] + highest_label_so_far
+            )
+
+        if on_round is not None:
+            on_round(r, watershed_all)
+
+        highest_label_so_far = np.max(output)
+
+    return output
+
+
 def count_blobs(mask):
     _, count = skimage.measure.label(mask, return_num=True)
     return count
@@ -287,11 +975,14 @@ def count_blobs_per_label(label_array):
 
 def clean_labels_with_multiple_blobs(label_array, factor_threshold=5):
     label_array_ = np.copy(label_array)
-    blobs_per_label = count_blobs_per_label(label_array_)
-    for row in blobs_per_label.query("label > 0 & count > 1").itertuples():
-        mask = label_array_ == row.label
+    # each label is only looked at within its bounding box
+    for label, box in enumerate(ndimage.find_objects(label_array_), start=1):
+        if box is None:
+            continue
+        mask = label_array_[box] == label
         relabeled, count = skimage.measure.label(mask, return_num=True)
-        assert count > 1
+        if count < 2:
+            continue
         relabeled_props = pd.DataFrame(
             skimage.measure.regionprops_table(relabeled, properties=["label", "area"])
         )
@@ -318,7 +1009,7 @@ def clean_labels_with_multiple_blobs(label_array, factor_threshold=5):
                     % (blob.label, blob.area, factor_threshold, largest_blob.area)
                 )
             blob_mask = relabeled == blob.label
-            label_array_[blob_mask] = 0
+            label_array_[box][blob_mask] = 0
     return label_array_
 
 
@@ -333,9 +1024,16 @@ def preprocess(
     erosion_kernel_size,
     save_figs,
     save_direc,
+    window: Optional[SceneWindow] = None,
+    hist_stride: int = 1,
+    mask_dilation: Optional[MaskDilation] = None,
+    coarse_block_size: Optional[int] = None,
+    triage: Optional[TriageThresholds] = None,
+    quicklook_factor: Optional[int] = None,
+    stack: Optional[SceneStack] = None,
 ):
     try:
-        doy, year, sat = getmeta(fcloud)
+        doy, year, sat = getmeta(Path(fcloud).name)
         res = getres(doy, year)
         save_direc = save_direc / doy
         fname_prefix = ""
@@ -356,6 +1054,13 @@ def preprocess(
             sat=sat,
             res=res,
             fname_prefix=fname_prefix,
+            window=window,
+            hist_stride=hist_stride,
+            mask_dilation=mask_dilation,
+            coarse_block_size=coarse_block_size,
+            triage=triage,
+            quicklook_factor=quicklook_factor,
+            stack=stack,
         )
     except Exception as e:
         logger.exception(f"Error processing {fcloud} and {ftci}: {e}")
@@ -375,7 +1080,30 @@ def preprocess_b(
     save_direc,
     fname_prefix,
     date: Optional[datetime.datetime],
+    land_mask: Optional[np.ndarray] = None,
+    window: Optional[SceneWindow] = None,
+    hist_stride: int = 1,
+    mask_dilation: Optional[MaskDilation] = None,
+    coarse_block_size: Optional[int] = None,
+    triage: Optional[TriageThresholds] = None,
+    quicklook_factor: Optional[int] = None,
+    stack: Optional[SceneStack] = None,
 ):
+    """Process a single scene.
+
+    If `land_mask` is given it is used instead of reading `fland`, which lets
+    long-running callers load the land mask once and reuse it. It must already
+    cover only the `window`, if one is given. Likewise `mask_dilation` can
+    hold the dilated land mask, if it is the same for many scenes.
+
+    The histogram used for the ice thresholds is computed from every
+    `hist_stride`th row and column, which is faster for very large scenes.
+    If `coarse_block_size` is set, the ice threshold is skipped for blocks
+    without ice, and if `triage` is set, unusable scenes are skipped, see
+    `SegmentationParams`. With `quicklook_factor`, a preview decimated by that
+    factor is written, and with `stack` the rasters are appended to it, see
+    `segment_and_write`.
+    """
     try:
         if date is not None:
             doy = date.timetuple().tm_yday
@@ -386,7 +1114,11 @@ def preprocess_b(
         _preprocess(
             ftci=ftci,
             fcloud=fcloud,
-            land_mask=create_land_mask(fland),
+            land_mask=(
+                create_land_mask(fland, window=window)
+                if land_mask is None
+                else land_mask
+            ),
             itmax=itmax,
             itmin=itmin,
             step=step,
@@ -399,6 +1131,13 @@ def preprocess_b(
             sat=None,
             res=None,
             fname_prefix=fname_prefix,
+            window=window,
+            hist_stride=hist_stride,
+            mask_dilation=mask_dilation,
+            coarse_block_size=coarse_block_size,
+            triage=triage,
+            quicklook_factor=quicklook_factor,
+            stack=stack,
         )
     except Exception as e:
         logger.exception(f"Error processing {fcloud} and {ftci}: {e}")
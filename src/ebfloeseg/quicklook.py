@@ -0,0 +1,88 @@
+"""Small previews of the segmentation of a scene, for visual checks.
+
+The figures written with `save_figs` are full-resolution GeoTIFFs, which can
+take more space and time than the outputs themselves. A quick-look is one
+PNG of the masked true-color image, the ice mask and the floes side by side,
+decimated by a factor, which is cheap enough to write for every scene.
+"""
+
+from logging import getLogger
+from pathlib import Path
+
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+
+logger = getLogger(__name__)
+
+GAP = 4  # pixels between the panels
+
+
+def label_colors(labels: NDArray, seed: int = 0) -> NDArray[np.uint8]:
+    """
+    Color each label, with the same color for the same label in every scene.
+
+    Args:
+        labels (NDArray): The labelled floes, 0 where there is no floe.
+        seed (int): Seed of the colors.
+
+    Returns:
+        NDArray[np.uint8]: The colors, of shape (*labels.shape, 3), black for 0.
+
+    Examples:
+        >>> colors = label_colors(np.array([[0, 1], [2, 2]]))
+        >>> colors[0, 0].tolist(), (colors[1, 0] == colors[1, 1]).all()
+        ([0, 0, 0], True)
+    """
+    rng = np.random.default_rng(seed)
+    palette = rng.integers(64, 256, (int(labels.max()) + 1, 3), dtype=np.uint8)
+    palette[0] = 0
+    return palette[labels]
+
+
+def quicklook(
+    rgb_masked: NDArray[np.uint8],
+    ice_mask: NDArray[np.bool_],
+    labels: NDArray,
+    factor: int = 8,
+) -> NDArray[np.uint8]:
+    """
+    Put the masked true-color image, the ice mask and the floes side by side.
+
+    Every `factor`th row and column of each is kept, and the floes are drawn
+    over the true-color image.
+
+    Args:
+        rgb_masked (NDArray[np.uint8]): The true-color image of shape
+            (H, W, 3), with land and clouds masked.
+        ice_mask (NDArray[np.bool_]): The ice mask.
+        labels (NDArray): The labelled floes.
+        factor (int): The decimation factor.
+
+    Returns:
+        NDArray[np.uint8]: The RGB image of the three panels.
+
+    Examples:
+        >>> rgb = np.zeros((100, 50, 3), dtype=np.uint8)
+        >>> quicklook(rgb, rgb[:, :, 0] > 0, rgb[:, :, 0], factor=10).shape
+        (10, 23, 3)
+    """
+    rgb = rgb_masked[::factor, ::factor]
+    ice = ice_mask[::factor, ::factor]
+    floes = labels[::factor, ::factor]
+
+    height, width = ice.shape
+    panels = np.full((height, 3 * width + 2 * GAP, 3), 255, dtype=np.uint8)
+    panels[:, :width] = rgb
+    panels[:, width + GAP : 2 * width + GAP] = np.where(ice, 255, 0)[:, :, None]
+    overlay = panels[:, 2 * (width + GAP) :]
+    overlay[:] = rgb
+    has_floe = floes > 0
+    overlay[has_floe] = rgb[has_floe] // 2 + label_colors(floes)[has_floe] // 2
+    return panels
+
+
+def write_quicklook(path: Path, image: NDArray[np.uint8]) -> None:
+    """Write an RGB image as PNG, or as JPEG if `path` ends with .jpg."""
+    if not cv2.imwrite(str(path), np.ascontiguousarray(image[:, :, ::-1])):
+        raise OSError("could not write %s" % path)
@@ -0,0 +1,125 @@
+"""Downloading and processing a scene in one step, without temporary files.
+
+`fsdproc load` writes each image to disk and `fsdproc process` reads them back.
+`run_scene` instead downloads the three images concurrently into memory and
+segments them straight away, so that a scene takes about as long as its
+slowest download plus its processing.
+"""
+
+import datetime as dt
+import time
+from logging import getLogger
+from pathlib import Path
+from typing import Optional
+
+from ebfloeseg.bbox import BoundingBox
+from ebfloeseg.dataset import ExampleDataSetBeaufortSea, ImageType, Satellite
+from ebfloeseg.ingest import read_rgb
+from ebfloeseg.load import load_scene
+from ebfloeseg.masking import CLOUD_VALUE, LAND_VALUE, read_mask
+from ebfloeseg.preprocess import (
+    SegmentationParams,
+    SegmentationResult,
+    segment_and_write,
+)
+from ebfloeseg.stack import SceneStack, scene_key
+
+logger = getLogger(__name__)
+
+
+def run_scene(
+    date: dt.date,
+    save_direc: Path,
+    satellite: Satellite = ExampleDataSetBeaufortSea.satellite,
+    bbox: BoundingBox = ExampleDataSetBeaufortSea.bbox,
+    scale: int = ExampleDataSetBeaufortSea.scale,
+    crs: str = ExampleDataSetBeaufortSea.crs,
+    wrap: str = ExampleDataSetBeaufortSea.wrap,
+    ts: int = ExampleDataSetBeaufortSea.ts,
+    params: Optional[SegmentationParams] = None,
+    save_figs: bool = False,
+    save_inputs: bool = False,
+    fname_prefix: str = "",
+    validate: bool = True,
+    tile_size: Optional[int] = None,
+    retries: int = 0,
+    cache_dir: Optional[Path] = None,
+    quicklook_factor: Optional[int] = None,
+    stack: Optional[SceneStack] = None,
+) -> SegmentationResult:
+    """
+    Download the images of a satellite-day and segment them in memory.
+
+    Only the mask values, the props table and the labelled floes are written,
+    unless `save_figs` or `save_inputs` is set.
+
+    Args:
+        date (date): The day of the scene.
+        save_direc (Path): Directory for the outputs.
+        satellite, bbox, scale, crs, wrap, ts: The scene, see `load`.
+        params (SegmentationParams, optional): Defaults to `SegmentationParams()`.
+        save_figs (bool): Also write the figures, as `fsdproc process` does.
+        save_inputs (bool): Also write the downloaded images, as
+            `{fname_prefix}truecolor.tiff`, `cloud.tiff` and `land.tiff`.
+        fname_prefix (str): String to prepend to the file names.
+        validate (bool): Check that the true-color and cloud images aren't empty.
+        tile_size (int, optional), retries (int), cache_dir (Path, optional):
+            See `load`.
+        quicklook_factor (int, optional): Also write a preview decimated by
+            this factor, see `segment_and_write`.
+        stack (SceneStack, optional): Also append the rasters to this stack,
+            as DATE_SATELLITE.
+
+    Returns:
+        SegmentationResult: The outputs of the segmentation.
+    """
+    start = time.perf_counter()
+    images = load_scene(
+        datetime=date.isoformat(),
+        wrap=wrap,
+        satellite=satellite,
+        bbox=bbox,
+        scale=scale,
+        crs=crs,
+        ts=ts,
+        validate=validate,
+        tile_size=tile_size,
+        retries=retries,
+        cache_dir=cache_dir,
+    )
+    downloaded = time.perf_counter()
+
+    if save_inputs:
+        save_direc.mkdir(exist_ok=True, parents=True)
+        names = {
+            ImageType.truecolor: "truecolor",
+            ImageType.cloud: "cloud",
+            ImageType.landmask: "land",
+        }
+        for kind, image in images.items():
+            with open(save_direc / f"{fname_prefix}{names[kind]}.tiff", "wb") as f:
+                f.write(image.content)
+
+    tci = images[ImageType.truecolor].img
+    result = segment_and_write(
+        tci,
+        read_rgb(tci),
+        read_mask(images[ImageType.cloud].img, CLOUD_VALUE),
+        read_mask(images[ImageType.landmask].img, LAND_VALUE),
+        params or SegmentationParams(),
+        save_figs=save_figs,
+        save_direc=save_direc,
+        doy=date.timetuple().tm_yday,
+        fname_prefix=fname_prefix,
+        quicklook_factor=quicklook_factor,
+        stack=stack,
+        stack_key=scene_key(date, satellite.value),
+    )
+    logger.info(
+        "downloaded %s %s in %.1f s, processed it in %.1f s",
+        satellite.value,
+        date,
+        downloaded - start,
+        time.perf_counter() - downloaded,
+    )
+    return result
@@ -5,8 +5,8 @@ import logging
 import numpy as np
 import rasterio
 from rasterio import DatasetReader
+from rasterio.windows import Window
 from numpy.typing import NDArray
-from matplotlib import pyplot as plt
 
 _logger = logging.getLogger(__name__)
 
@@ -21,9 +21,17 @@ def imsave(
     rollaxis: bool = True,
     dtype: Optional[np.dtype] = None,
     res=None,
+    window: Optional[Window] = None,
 ) -> None:
     profile = tci.profile
 
+    if window is not None:  # georeference the output for the window
+        profile.update(
+            height=window.height,
+            width=window.width,
+            transform=tci.window_transform(window),
+        )
+
     profile.update(
         dtype=dtype,
         count=count,
@@ -64,7 +72,7 @@ def imsave(
 
 
 def save_ice_mask_hist(
-    red_masked,
+    hist,
     bins,
     mincut,
     maxcut,
@@ -73,9 +81,15 @@ def save_ice_mask_hist(
     color="r",
     figsize=(6, 2),
 ):
-    fig, ax = plt.subplots(1, 1, figsize=figsize)
-    plt.hist(red_masked.flatten(), bins=bins, color=color)
-    plt.axvline(mincut)
-    plt.axvline(maxcut)
-    plt.savefig(target_dir / fname)
+    # a Figure of its own rather than pyplot's, so that it isn't kept by
+    # pyplot's list of open figures, and matplotlib is only imported here
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=figsize)
+    ax = fig.subplots(1, 1)
+    # `hist` is already binned, so each bin is drawn with its count as weight
+    ax.hist(bins[:-1], bins=bins, weights=hist, color=color)
+    ax.axvline(mincut)
+    ax.axvline(maxcut)
+    fig.savefig(target_dir / fname)
     return ax
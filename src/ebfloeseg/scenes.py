@@ -0,0 +1,202 @@
+import datetime
+from dataclasses import dataclass
+from logging import getLogger
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import rasterio
+import rasterio.errors
+
+from ebfloeseg.utils import getmeta
+from ebfloeseg.window import SceneWindow
+
+logger = getLogger(__name__)
+
+# Red values above this are counted as (possibly) ice when estimating costs.
+# It matches the default lower cut used by `get_wcuts`.
+ICE_RED_THRESHOLD = 100
+
+# Rough relative cost of an ice pixel compared to any other pixel: the erosion,
+# watershed and property rounds are dominated by the ice in the scene.
+ICE_COST_FACTOR = 4.0
+
+
+@dataclass
+class Scene:
+    """A pair of true-color and cloud images of the same day and satellite."""
+
+    ftci: Path
+    fcloud: Path
+    doy: str
+    year: str
+    sat: str
+    pixels: int = 0  # number of pixels processed
+    ice_fraction: float = 0.0  # estimated fraction of clear ice pixels
+
+    @property
+    def key(self) -> tuple[str, str, str]:
+        return self.year, self.doy, self.sat
+
+    @property
+    def estimated_cost(self) -> float:
+        """Relative processing cost, used to order the scenes."""
+        return self.pixels * (1 + ICE_COST_FACTOR * self.ice_fraction)
+
+
+def _index_directory(direc: Path) -> dict[tuple[str, str, str], Path]:
+    index = {}
+    for fname in sorted(Path(direc).iterdir()):
+        if fname.name.startswith("."):
+            continue
+        try:
+            doy, year, sat = getmeta(fname.name)
+        except (IndexError, ValueError):
+            logger.warning("skipping %s, can't parse its name", fname)
+            continue
+        key = (year, doy, sat)
+        if key in index:
+            msg = "%s and %s are both for year=%s doy=%s satellite=%s" % (
+                index[key],
+                fname,
+                *key,
+            )
+            raise ValueError(msg)
+        index[key] = fname
+    return index
+
+
+def estimate_scene(
+    scene: Scene, window: Optional[SceneWindow] = None, decimation: int = 16
+) -> Scene:
+    """
+    Estimate the size and clear ice fraction of a scene, in place.
+
+    Only band 1 of each image is read, at 1/`decimation` of its resolution.
+
+    Args:
+        scene (Scene): The scene.
+        window (SceneWindow, optional): Only the window of the scene is processed.
+        decimation (int): Read every `decimation`th row and column.
+
+    Returns:
+        Scene: The same scene.
+    """
+    with rasterio.open(scene.ftci) as tci, rasterio.open(scene.fcloud) as cloud:
+        tci_window = None if window is None else window.to_window(tci)
+        cloud_window = None if window is None else window.to_window(cloud)
+        height = tci.height if window is None else int(tci_window.height)
+        width = tci.width if window is None else int(tci_window.width)
+        out_shape = (max(1, height // decimation), max(1, width // decimation))
+        red = tci.read(1, window=tci_window, out_shape=out_shape)
+        cloudy = cloud.read(1, window=cloud_window, out_shape=out_shape) == 255
+
+    scene.pixels = height * width
+    scene.ice_fraction = float(np.mean((red > ICE_RED_THRESHOLD) & ~cloudy))
+    return scene
+
+
+def index_scenes(
+    data_direc: Path,
+    window: Optional[SceneWindow] = None,
+    estimate: bool = True,
+) -> list[Scene]:
+    """
+    Find the pairs of true-color and cloud images in `data_direc`.
+
+    Images are paired by the day of year, year and satellite in their names, as
+    parsed by `getmeta`, rather than by their order. Images without a partner are
+    skipped with a warning.
+
+    Args:
+        data_direc (Path): Directory containing the folders `tci` and `cloud`.
+        window (SceneWindow, optional): Only the window of each scene is processed.
+        estimate (bool): Whether to estimate the cost of each scene.
+
+    Returns:
+        list[Scene]: The scenes, sorted by year, day of year and satellite.
+    """
+    tcis = _index_directory(Path(data_direc) / "tci")
+    clouds = _index_directory(Path(data_direc) / "cloud")
+
+    for key in sorted(tcis.keys() - clouds.keys()):
+        logger.warning("skipping %s, no matching cloud image", tcis[key])
+    for key in sorted(clouds.keys() - tcis.keys()):
+        logger.warning("skipping %s, no matching true-color image", clouds[key])
+
+    scenes = []
+    for key in sorted(tcis.keys() & clouds.keys()):
+        year, doy, sat = key
+        scene = Scene(ftci=tcis[key], fcloud=clouds[key], doy=doy, year=year, sat=sat)
+        if estimate:
+            try:
+                estimate_scene(scene, window=window)
+            except (rasterio.errors.RasterioError, ValueError) as e:
+                # the scene is still processed, and its failure reported there
+                logger.warning("can't estimate the cost of %s: %s", scene.ftci, e)
+        scenes.append(scene)
+    return scenes
+
+
+def longest_first(scenes: list[Scene]) -> list[Scene]:
+    """
+    Order scenes by decreasing estimated cost.
+
+    Submitting the scenes to a pool of workers in this order (longest processing
+    time first) avoids a few expensive scenes starting last, while the other
+    workers are idle.
+
+    Examples:
+        >>> scenes = [
+        ...     Scene("a", "a", "001", "2020", "terra", pixels=10),
+        ...     Scene("b", "b", "002", "2020", "terra", pixels=10, ice_fraction=0.5),
+        ...     Scene("c", "c", "003", "2020", "terra", pixels=20),
+        ... ]
+        >>> [scene.doy for scene in longest_first(scenes)]
+        ['002', '003', '001']
+    """
+    return sorted(scenes, key=lambda scene: scene.estimated_cost, reverse=True)
+
+
+def shard_of_day(year: str, doy: str, count: int) -> int:
+    """
+    Get the shard, out of `count`, which processes the scenes of a day.
+
+    Consecutive days go to consecutive shards, so a season is divided evenly.
+
+    Examples:
+        >>> days = [("2020", "365"), ("2020", "366"), ("2021", "001"), ("2021", "002")]
+        >>> [shard_of_day(year, doy, 3) for year, doy in days]
+        [2, 0, 1, 2]
+    """
+    day = datetime.date(int(year), 1, 1) + datetime.timedelta(days=int(doy) - 1)
+    return day.toordinal() % count
+
+
+def shard_scenes(scenes: list[Scene], index: int, count: int) -> list[Scene]:
+    """
+    Get the scenes of shard `index` out of `count` disjoint shards.
+
+    The scenes of each day are kept together, as they are written to the same
+    directory. The shard of a day only depends on its date, see `shard_of_day`,
+    so every shard agrees on it without any coordination, even if the shards
+    estimated different costs for the scenes, or if scenes were added to the
+    data directory while the shards were starting. As the costs of neighbouring
+    days are similar, the shards of a season take about the same time.
+
+    Examples:
+        >>> scenes = [
+        ...     Scene("a", "a", "001", "2020", "terra"),
+        ...     Scene("b", "b", "001", "2020", "aqua"),
+        ...     Scene("c", "c", "002", "2020", "terra"),
+        ...     Scene("d", "d", "003", "2020", "terra"),
+        ...     Scene("e", "e", "004", "2020", "terra"),
+        ... ]
+        >>> [scene.ftci for scene in shard_scenes(scenes, 0, 2)]
+        ['c', 'e']
+        >>> [scene.ftci for scene in shard_scenes(scenes, 1, 2)]
+        ['a', 'b', 'd']
+    """
+    return [
+        scene for scene in scenes if shard_of_day(scene.year, scene.doy, count) == index
+    ]
@@ -0,0 +1,403 @@
+"""A local job server with warm workers.
+
+Starting `fsdproc` pays for interpreter startup, importing the numerical stack
+and reading the land mask before any real work happens. The server keeps a pool
+of worker processes alive which have already paid those costs, and runs `process`
+and `load` jobs submitted to it over HTTP on a Unix socket. By default the
+socket is in a directory which only the user can access, so no other user of
+the machine can run jobs with their permissions, or pose as the server. The
+socket itself is only readable and writable by the user, and clients check that
+the server runs as the same user.
+
+Jobs are described by the same command-line arguments as the corresponding
+`fsdproc` command, so
+
+    fsdproc submit process tci.tiff cloud.tiff land.tiff out/ --itmax 5
+
+behaves like `fsdproc process ...`, only without the startup cost.
+"""
+
+import json
+import logging
+import os
+import socket
+import stat
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path
+from socketserver import ThreadingUnixStreamServer
+from typing import Optional
+
+from ebfloeseg.window import SceneWindow
+
+_logger = logging.getLogger(__name__)
+
+JOB_COMMANDS = ("process", "load")
+
+
+def private_directory(path: Path) -> Path:
+    """Create the directory `path` for the current user only, or check that it is.
+
+    Raises:
+        PermissionError: If `path` isn't a directory owned by the user, which
+            the group and others can't access.
+    """
+    path = Path(path)
+    try:
+        path.mkdir(mode=0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise PermissionError("%s isn't a directory owned by the user" % path)
+    if st.st_mode & 0o077:
+        raise PermissionError(
+            "%s is accessible by other users, its mode is %o"
+            % (path, stat.S_IMODE(st.st_mode))
+        )
+    return path
+
+
+def default_socket_path() -> Path:
+    """Return the socket of the current user's server.
+
+    It is in the directory `fsdproc-UID`, which only the user can access, in
+    `$XDG_RUNTIME_DIR` if set, or else in the temporary directory.
+    """
+    base = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    directory = private_directory(Path(base) / f"fsdproc-{os.getuid()}")
+    return directory / "serve.sock"
+
+
+@lru_cache(maxsize=8)
+def _cached_land_mask(path: str, mtime_ns: int, window: Optional[SceneWindow]):
+    from ebfloeseg.masking import create_land_mask
+
+    _logger.info("reading land mask %s", path)
+    return create_land_mask(path, window=window)
+
+
+def get_land_mask(path: Path, window: Optional[SceneWindow] = None):
+    """Return the land mask for `path`, reading the file only if it has changed."""
+    path = Path(path).resolve()
+    return _cached_land_mask(str(path), path.stat().st_mtime_ns, window)
+
+
+@lru_cache(maxsize=8)
+def _cached_mask_dilation(path: str, mtime_ns: int, window: Optional[SceneWindow]):
+    from ebfloeseg.masking import MaskDilation
+
+    return MaskDilation(_cached_land_mask(path, mtime_ns, window))
+
+
+def get_mask_dilation(path: Path, window: Optional[SceneWindow] = None):
+    """Return the dilation of the land mask for `path`, computed once per file."""
+    path = Path(path).resolve()
+    return _cached_mask_dilation(str(path), path.stat().st_mtime_ns, window)
+
+
+def _warm_up(threads: Optional[int] = None) -> None:
+    """Import the numerical stack once, when the worker starts."""
+    if threads is not None:
+        from ebfloeseg.threads import set_thread_budget
+
+        set_thread_budget(threads)
+
+    import ebfloeseg.preprocess  # noqa: F401
+    import ebfloeseg.load  # noqa: F401
+
+
+def _get_click_command(command: str):
+    import typer
+
+    from ebfloeseg.app import app
+
+    group = typer.main.get_command(app)
+    return group.get_command(None, command)
+
+
+def run_job(command: str, args: list[str], cwd: str) -> None:
+    """Run the `fsdproc` `command` with command-line `args` relative to `cwd`.
+
+    This is executed in a worker process. Each worker handles one job at a time,
+    so changing the working directory is safe.
+    """
+    if command not in JOB_COMMANDS:
+        msg = "unsupported command %s, expected one of %s" % (command, JOB_COMMANDS)
+        raise ValueError(msg)
+
+    os.chdir(cwd)
+    click_command = _get_click_command(command)
+    ctx = click_command.make_context(command, list(args))
+
+    match command:
+        case "process":
+            from ebfloeseg.app import run_process
+
+            run_process(**ctx.params, cached_masks=True)
+        case "load":
+            with ctx:
+                click_command.invoke(ctx)
+
+
+def _ping() -> None:
+    pass
+
+
+def _refuses_jobs(executor: ProcessPoolExecutor) -> bool:
+    # once the executor has noticed that a worker died, it refuses every job
+    try:
+        executor.submit(_ping)
+    except BrokenProcessPool:
+        return True
+    return False
+
+
+def _remove_stale_socket(path: Path) -> None:
+    """Remove the socket left behind by a server which didn't shut down cleanly."""
+    if not path.is_socket():
+        return
+    if path.stat().st_uid != os.getuid():
+        raise PermissionError("%s belongs to another user" % path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(str(path))
+        except ConnectionRefusedError:
+            _logger.info("removing stale socket %s", path)
+            path.unlink()
+            return
+    raise OSError("a server is already listening on %s" % path)
+
+
+class JobServer(ThreadingUnixStreamServer):
+    """HTTP server on a Unix socket which hands the jobs it receives to a pool of
+    warm workers."""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        socket_path: Path,
+        max_workers: Optional[int] = None,
+        threads_per_worker: Optional[int] = None,
+    ):
+        self.socket_path = Path(socket_path)
+        _remove_stale_socket(self.socket_path)
+        super().__init__(str(self.socket_path), _JobHandler)
+        self.max_workers = max_workers
+        self.threads_per_worker = threads_per_worker
+        self._executor_lock = threading.Lock()
+        self.executor = self._new_executor()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            initializer=_warm_up,
+            initargs=(self.threads_per_worker,),
+        )
+
+    def pool_broken(self) -> bool:
+        """Whether a worker has died, after which the pool refuses all jobs."""
+        with self._executor_lock:
+            return _refuses_jobs(self.executor)
+
+    def _replace_executor(self) -> None:
+        _logger.warning("a worker died, starting a new pool of workers")
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = self._new_executor()
+
+    def replace_broken_executor(self) -> None:
+        """Replace the pool of workers if it is broken."""
+        with self._executor_lock:
+            if _refuses_jobs(self.executor):
+                self._replace_executor()
+
+    def submit_job(self, command: str, args: list[str], cwd: str) -> Future:
+        """Run a job in a worker, replacing the pool first if it is broken."""
+        with self._executor_lock:
+            try:
+                return self.executor.submit(run_job, command, args, cwd)
+            except BrokenProcessPool:
+                self._replace_executor()
+                return self.executor.submit(run_job, command, args, cwd)
+
+    def server_bind(self):
+        super().server_bind()
+        os.chmod(self.server_address, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        self.socket_path.unlink(missing_ok=True)
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class _JobHandler(BaseHTTPRequestHandler):
+    server: JobServer
+
+    def _reply(self, code: int, body: dict) -> None:
+        content = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._reply(404, {"status": "error", "error": "not found"})
+            return
+        if self.server.pool_broken():
+            msg = "a worker died, the pool will be replaced before the next job"
+            self._reply(503, {"status": "broken", "error": msg})
+            return
+        self._reply(200, {"status": "ok"})
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            self._reply(404, {"status": "error", "error": "not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = json.loads(self.rfile.read(length))
+            command, args, cwd = job["command"], job["args"], job["cwd"]
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {"status": "error", "error": "malformed job: %r" % e})
+            return
+
+        if command not in JOB_COMMANDS:
+            msg = "unsupported command %s, expected one of %s" % (command, JOB_COMMANDS)
+            self._reply(400, {"status": "error", "error": msg})
+            return
+
+        _logger.info("running %s %s", command, args)
+        start = time.perf_counter()
+        future = self.server.submit_job(command, args, cwd)
+        try:
+            future.result()
+        except Exception as e:
+            _logger.warning("job %s %s failed: %r", command, args, e)
+            if isinstance(e, BrokenProcessPool):
+                self.server.replace_broken_executor()
+            self._reply(
+                500,
+                {
+                    "status": "failed",
+                    "error": repr(e),
+                    "duration": time.perf_counter() - start,
+                },
+            )
+            return
+        self._reply(
+            200, {"status": "succeeded", "duration": time.perf_counter() - start}
+        )
+
+    def log_message(self, format, *args):
+        _logger.debug(format, *args)
+
+
+def serve(
+    socket_path: Optional[Path] = None,
+    max_workers: Optional[int] = None,
+    threads_per_worker: Optional[int] = None,
+) -> None:
+    """Run a job server on `socket_path` until interrupted.
+
+    The socket defaults to `default_socket_path()`.
+    """
+    socket_path = default_socket_path() if socket_path is None else socket_path
+    with JobServer(
+        socket_path, max_workers=max_workers, threads_per_worker=threads_per_worker
+    ) as server:
+        _logger.warning("serving on %s", server.socket_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+class _UnixHTTPConnection(HTTPConnection):
+    """HTTP connection to a server listening on a Unix socket."""
+
+    def __init__(self, socket_path: Path, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(str(self.socket_path))
+        _check_peer(self.sock, self.socket_path)
+
+
+def _check_peer(sock: socket.socket, socket_path: Path) -> None:
+    """Check that the server on the other end of `sock` runs as the current user,
+    so that jobs and their replies aren't exchanged with another user's process."""
+    if hasattr(socket, "SO_PEERCRED"):
+        ucred = sock.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+        )
+        _, uid, _ = struct.unpack("3i", ucred)
+    else:
+        uid = os.stat(socket_path).st_uid
+    if uid != os.getuid():
+        sock.close()
+        raise PermissionError(
+            "the server on %s runs as user %s, not as the current user"
+            % (socket_path, uid)
+        )
+
+
+def _request(
+    method: str,
+    url: str,
+    body: Optional[dict] = None,
+    socket_path: Optional[Path] = None,
+    timeout: Optional[float] = None,
+) -> dict:
+    socket_path = default_socket_path() if socket_path is None else socket_path
+    connection = _UnixHTTPConnection(socket_path, timeout=timeout)
+    try:
+        if body is None:
+            connection.request(method, url)
+        else:
+            connection.request(
+                method,
+                url,
+                body=json.dumps(body).encode(),
+                headers={"Content-Type": "application/json"},
+            )
+        return json.load(connection.getresponse())
+    finally:
+        connection.close()
+
+
+def health(socket_path: Optional[Path] = None, timeout: Optional[float] = None) -> dict:
+    """Return the state of a running server, whose "status" is "ok" or "broken"."""
+    return _request("GET", "/health", socket_path=socket_path, timeout=timeout)
+
+
+def submit(
+    command: str,
+    args: list[str],
+    socket_path: Optional[Path] = None,
+    cwd: Optional[Path] = None,
+    timeout: Optional[float] = None,
+) -> dict:
+    """Submit a job to a running server and block until it has finished.
+
+    Returns the server's response, whose "status" is "succeeded" or "failed".
+    """
+    job = {
+        "command": command,
+        "args": list(args),
+        "cwd": str(Path.cwd() if cwd is None else Path(cwd).resolve()),
+    }
+    return _request("POST", "/jobs", job, socket_path=socket_path, timeout=timeout)
@@ -0,0 +1,169 @@
+"""Splitting a batch of scenes between independent jobs, and merging their outputs.
+
+With `fsdproc process-batch --shard I/N`, each of N jobs (e.g. the tasks of an
+HPC array job) processes a disjoint part of the scenes and writes its own
+report. `fsdproc merge` then combines the outputs of all the shards into the
+layout of a single `process-batch` run.
+"""
+
+import json
+import re
+import shutil
+from logging import getLogger
+from pathlib import Path
+from typing import NamedTuple
+
+import click
+
+from ebfloeseg.batch import make_report
+
+logger = getLogger(__name__)
+
+SHARD_REPORT_GLOB = "batch_report.shard-*-of-*.json"
+
+
+class Shard(NamedTuple):
+    index: int  # from 0 to count - 1
+    count: int
+
+    @property
+    def report_name(self) -> str:
+        """
+        Name of the report written by this shard.
+
+        Examples:
+            >>> Shard(2, 16).report_name
+            'batch_report.shard-0002-of-0016.json'
+        """
+        return "batch_report.shard-%04d-of-%04d.json" % self
+
+
+class ShardParser(click.ParamType):
+    name = "I/N"
+
+    @classmethod
+    def convert(self, value: str | Shard, param=None, ctx=None):
+        """
+        Convert a string like "I/N" into a Shard, where 0 <= I < N.
+
+        Examples:
+            >>> ShardParser.convert("0/4")
+            Shard(index=0, count=4)
+
+            >>> ShardParser.convert(" 3 / 4 ")
+            Shard(index=3, count=4)
+
+            >>> ShardParser.convert(Shard(1, 2))
+            Shard(index=1, count=2)
+
+            >>> ShardParser.convert("4/4")
+            Traceback (most recent call last):
+            ...
+            click.exceptions.BadParameter: shard index 4 is not in 0..3
+
+            >>> ShardParser.convert("a/4")
+            Traceback (most recent call last):
+            ...
+            click.exceptions.BadParameter: 'a/4' is not of the form I/N
+        """
+        if isinstance(value, Shard):
+            return value
+        match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", value)
+        if match is None:
+            raise click.BadParameter("%r is not of the form I/N" % value, ctx, param)
+        index, count = map(int, match.groups())
+        if not 0 <= index < count:
+            raise click.BadParameter(
+                "shard index %s is not in 0..%s" % (index, count - 1), ctx, param
+            )
+        return Shard(index, count)
+
+
+def _task_key(task: dict) -> tuple:
+    info = task.get("info", {})
+    return (
+        str(info.get("year", "")),
+        str(info.get("doy", "")),
+        str(info.get("satellite", "")),
+        task["name"],
+    )
+
+
+def merge_shards(shard_direcs: list[Path], save_direc: Path) -> dict:
+    """
+    Combine the outputs of the shards of a batch into `save_direc`.
+
+    The files of each shard directory are copied into `save_direc`, unless the
+    shards wrote there already, and the shard reports are merged into
+    `batch_report.json`, with the scenes sorted by year, day of year and
+    satellite. The result doesn't depend on the order of `shard_direcs`.
+
+    Args:
+        shard_direcs (list[Path]): The save directories of the shards.
+        save_direc (Path): Directory for the merged outputs.
+
+    Returns:
+        dict: The merged report.
+
+    Raises:
+        ValueError: If shard reports are missing or duplicated, the shards are
+            from batches with different numbers of shards, or a file is
+            written by more than one shard.
+    """
+    save_direc = Path(save_direc)
+    reports = {}
+    for direc in map(Path, shard_direcs):
+        for path in sorted(direc.glob(SHARD_REPORT_GLOB)):
+            with open(path) as f:
+                report = json.load(f)
+            shard = Shard(**report["shard"])
+            if shard in reports:
+                msg = "%s and %s are both reports of shard %s/%s" % (
+                    reports[shard][0],
+                    path,
+                    *shard,
+                )
+                raise ValueError(msg)
+            reports[shard] = (path, report)
+
+    if not reports:
+        raise ValueError(
+            "no shard reports found in %s" % ", ".join(map(str, shard_direcs))
+        )
+    counts = {shard.count for shard in reports}
+    if len(counts) > 1:
+        raise ValueError("shards are from batches of %s shards" % sorted(counts))
+    (count,) = counts
+    missing = sorted(set(range(count)) - {shard.index for shard in reports})
+    if missing:
+        msg = "missing the reports of shards %s of %s" % (missing, count)
+        raise ValueError(msg)
+
+    # find all the files to copy first, so that nothing is copied on conflicts
+    sources: dict[Path, Path] = {}
+    for direc in sorted({Path(d).resolve() for d in shard_direcs}):
+        if direc == save_direc.resolve():
+            continue
+        for path in sorted(direc.rglob("*")):
+            if path.is_dir() or path.match(SHARD_REPORT_GLOB):
+                continue
+            relative = path.relative_to(direc)
+            if relative in sources:
+                msg = "%s is in both %s and %s" % (relative, sources[relative], path)
+                raise ValueError(msg)
+            if (save_direc / relative).exists():
+                msg = "%s already exists, from %s" % (save_direc / relative, path)
+                raise ValueError(msg)
+            sources[relative] = path
+
+    for relative, path in sources.items():
+        logger.debug("copying %s", path)
+        (save_direc / relative).parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(path, save_direc / relative)
+
+    tasks = [task for _, report in reports.values() for task in report["tasks"]]
+    merged = make_report(sorted(tasks, key=_task_key))
+    save_direc.mkdir(parents=True, exist_ok=True)
+    with open(save_direc / "batch_report.json", "w") as f:
+        json.dump(merged, f, indent=2, default=str)
+    return merged
@@ -0,0 +1,340 @@
+"""A chunked store of the daily rasters of one location, as time x y x x cubes.
+
+Analyses over many days of the same grid, such as the persistence of ice in
+each pixel or tracking floes, would otherwise open thousands of GeoTIFFs.
+A `SceneStack` keeps each variable (e.g. the labels, the ice mask and the
+land and cloud mask) of every scene in square chunks of `chunk_size` pixels,
+compressed with zlib, so that reading the time series of a small area only
+reads the chunks covering it. The files are
+
+    DIR/stack.json               the grid, CRS and variables
+    DIR/VARIABLE/TIME.chunks     the chunks of one scene
+    DIR/times/TIME.json          written last, when the scene is complete
+
+A `.chunks` file starts with the offset and length of each chunk, in rows of
+chunks, followed by the compressed chunks. Chunks without any nonzero pixel
+have a length of 0 and take no space. Keeping all chunks of a scene in one
+file saves opening (and storing) a file per chunk.
+
+Every file is written in one step, and each scene (TIME) only writes files of
+its own, so many processes can append to the same stack at the same time.
+A scene is only read once its `times` entry exists.
+"""
+
+import datetime
+import json
+import os
+import re
+import uuid
+import zlib
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+import numpy as np
+from numpy.typing import NDArray
+
+logger = getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 128  # pixels
+COMPRESSION_LEVEL = 4  # of zlib, from 1 (fastest) to 9 (smallest)
+
+# values of the "mask" variable written by `segment_and_write`
+MASK_LAND = 1
+MASK_CLOUD = 2
+
+
+def _write_atomic(path: Path, content: bytes) -> None:
+    tmp = path.with_name(".%s.%s.tmp" % (path.name, uuid.uuid4().hex))
+    tmp.write_bytes(content)
+    os.replace(tmp, path)
+
+
+def scene_key(date: datetime.date, satellite: Optional[str] = None) -> str:
+    """
+    The key of a scene in a stack, which orders the scenes by date.
+
+    Examples:
+        >>> scene_key(datetime.date(2012, 8, 1), "terra")
+        '2012-08-01_terra'
+    """
+    return date.isoformat() if not satellite else f"{date.isoformat()}_{satellite}"
+
+
+def _check_key(key: str) -> str:
+    if not re.fullmatch(r"[\w.-]+", key):
+        raise ValueError("invalid time key %r, use letters, digits, _, . or -" % key)
+    return key
+
+
+class SceneStack:
+    """
+    The time x y x x cubes of the scenes of one location, on a fixed grid.
+
+    The grid (shape, transform and CRS), the chunk size and the variables and
+    their data types are set by the first scene appended, and every later
+    scene must match them.
+
+    Examples:
+        >>> import tempfile
+        >>> stack = SceneStack(tempfile.mkdtemp(), chunk_size=2)
+        >>> labels = np.array([[0, 0, 0], [0, 1, 1], [0, 0, 2]], dtype=np.int16)
+        >>> stack.append("2012-08-01", {"labels": labels}, (1, 0, 0, 0, -1, 0))
+        >>> stack.append("2012-08-02", {"labels": labels + 1})
+        >>> stack.times()
+        ['2012-08-01', '2012-08-02']
+        >>> stack.read("labels", rows=slice(1, 3), cols=slice(2, 3))[:, :, 0]
+        array([[1, 2],
+               [2, 3]], dtype=int16)
+    """
+
+    def __init__(self, direc: Path, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.direc = Path(direc)
+        self._chunk_size = chunk_size  # of a new stack
+        self._metadata: Optional[dict] = None
+
+    @property
+    def metadata(self) -> dict:
+        """The grid and variables of the stack, see `append`."""
+        if self._metadata is None:
+            try:
+                text = (self.direc / "stack.json").read_text()
+            except FileNotFoundError:
+                raise FileNotFoundError("no stack in %s" % self.direc) from None
+            self._metadata = json.loads(text)
+        return self._metadata
+
+    @property
+    def chunk_size(self) -> int:
+        if (self.direc / "stack.json").exists():
+            return self.metadata["chunk_size"]
+        return self._chunk_size
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return tuple(self.metadata["shape"])
+
+    @property
+    def transform(self) -> Optional[tuple]:
+        transform = self.metadata["transform"]
+        return None if transform is None else tuple(transform)
+
+    @property
+    def crs(self) -> Optional[str]:
+        return self.metadata["crs"]
+
+    @property
+    def variables(self) -> dict[str, np.dtype]:
+        return {
+            name: np.dtype(dtype) for name, dtype in self.metadata["variables"].items()
+        }
+
+    def _create(self, metadata: dict) -> None:
+        """Write the metadata of a new stack, unless another process did first."""
+        self.direc.mkdir(parents=True, exist_ok=True)
+        path = self.direc / "stack.json"
+        tmp = path.with_name(".stack.json.%s.tmp" % uuid.uuid4().hex)
+        tmp.write_text(json.dumps(metadata, indent=2))
+        try:
+            os.link(tmp, path)  # fails if the stack exists
+        except FileExistsError:
+            pass
+        finally:
+            tmp.unlink()
+        self._metadata = None
+
+    def _check(self, shape, transform, crs, arrays: dict[str, NDArray]) -> None:
+        metadata = self.metadata
+        if list(shape) != metadata["shape"]:
+            msg = "the scene has shape %s, but the stack %s" % (
+                shape,
+                metadata["shape"],
+            )
+            raise ValueError(msg)
+        for name, value in [("transform", transform), ("crs", crs)]:
+            if value is not None and value != metadata[name]:
+                raise ValueError(
+                    "the scene has %s %s, but the stack %s"
+                    % (name, value, metadata[name])
+                )
+        variables = self.variables
+        for name, array in arrays.items():
+            if name not in variables:
+                raise ValueError(
+                    "the stack has no variable %r, only %s" % (name, list(variables))
+                )
+            if not np.can_cast(array.dtype, variables[name]):
+                raise ValueError(
+                    "%s of type %s can't be stored as %s"
+                    % (name, array.dtype, variables[name])
+                )
+        missing = [name for name in variables if name not in arrays]
+        if missing:
+            raise ValueError(
+                "the scene has no %s, every scene needs %s" % (missing, list(variables))
+            )
+
+    def path(self, variable: str, key: str) -> Path:
+        return self.direc / variable / f"{key}.chunks"
+
+    def _grid(self) -> tuple[int, int]:
+        """The number of rows and columns of chunks."""
+        height, width = self.shape
+        return -(-height // self.chunk_size), -(-width // self.chunk_size)
+
+    def _chunks(self, rows: slice, cols: slice) -> Iterable[tuple[int, int]]:
+        """The rows and columns of the chunks overlapping a part of the grid."""
+        size = self.chunk_size
+        for row in range(rows.start // size, -(-rows.stop // size)):
+            for col in range(cols.start // size, -(-cols.stop // size)):
+                yield row, col
+
+    def append(
+        self,
+        key: str,
+        arrays: dict[str, NDArray],
+        transform: Optional[tuple] = None,
+        crs: Optional[str] = None,
+        **attrs: Any,
+    ) -> None:
+        """
+        Add (or replace) the rasters of one scene.
+
+        Args:
+            key (str): The time of the scene, e.g. "2012-08-01_terra". The
+                scenes are ordered by their keys.
+            arrays (dict[str, NDArray]): The rasters of the scene by variable,
+                all of the same shape. Every scene has the variables of the
+                first one.
+            transform (tuple, optional): The affine transform of the grid, as
+                its first six coefficients.
+            crs (str, optional): The CRS of the grid, e.g. as WKT.
+            attrs: Anything else to record with the scene, e.g. its date.
+        """
+        _check_key(key)
+        if not arrays:
+            raise ValueError("no arrays to append")
+        shapes = {array.shape for array in arrays.values()}
+        if len(shapes) != 1:
+            raise ValueError("the arrays have different shapes %s" % shapes)
+        (shape,) = shapes
+        if transform is not None:
+            transform = [float(c) for c in tuple(transform)[:6]]
+        if not (self.direc / "stack.json").exists():
+            self._create(
+                {
+                    "shape": list(shape),
+                    "chunk_size": self._chunk_size,
+                    "transform": transform,
+                    "crs": crs,
+                    "variables": {
+                        name: array.dtype.str for name, array in arrays.items()
+                    },
+                }
+            )
+        self._check(shape, transform, crs, arrays)
+
+        # the scene is incomplete until its chunks are written
+        marker = self.direc / "times" / f"{key}.json"
+        marker.unlink(missing_ok=True)
+
+        size = self.chunk_size
+        variables = self.variables
+        for name, array in arrays.items():
+            array = array.astype(variables[name], copy=False)
+            chunks = []
+            for row, col in self._chunks(slice(0, shape[0]), slice(0, shape[1])):
+                chunk = array[
+                    row * size : (row + 1) * size, col * size : (col + 1) * size
+                ]
+                chunks.append(
+                    zlib.compress(chunk.tobytes(), COMPRESSION_LEVEL)
+                    if chunk.any()
+                    else b""
+                )
+            index = np.zeros((len(chunks), 2), dtype="<u8")
+            index[:, 1] = [len(chunk) for chunk in chunks]
+            index[:, 0] = index.nbytes + np.cumsum(index[:, 1]) - index[:, 1]
+            path = self.path(name, key)
+            path.parent.mkdir(exist_ok=True)
+            _write_atomic(path, index.tobytes() + b"".join(chunks))
+
+        marker.parent.mkdir(exist_ok=True)
+        _write_atomic(
+            marker,
+            json.dumps({"key": key, **attrs}, default=str).encode(),
+        )
+        logger.debug("appended %s to %s", key, self.direc)
+
+    def times(self) -> list[str]:
+        """The keys of the complete scenes, in order."""
+        return sorted(path.stem for path in (self.direc / "times").glob("*.json"))
+
+    def attrs(self, key: str) -> dict:
+        """The attributes the scene was appended with."""
+        return json.loads(
+            (self.direc / "times" / f"{_check_key(key)}.json").read_text()
+        )
+
+    def read(
+        self,
+        variable: str,
+        rows: slice = slice(None),
+        cols: slice = slice(None),
+        times: Optional[list[str]] = None,
+    ) -> NDArray:
+        """
+        Read the time series of a variable over a part of the grid.
+
+        Only the chunks overlapping the part are read.
+
+        Args:
+            variable (str): The name of the variable.
+            rows, cols (slice): The part of the grid, without steps.
+            times (list[str], optional): The keys of the scenes. Defaults to
+                all complete scenes, see `times`.
+
+        Returns:
+            NDArray: The rasters, of shape (len(times), rows, cols).
+        """
+        if times is None:
+            times = self.times()
+        dtype = self.variables[variable]
+        height, width = self.shape
+        rows = slice(*rows.indices(height)[:2])
+        cols = slice(*cols.indices(width)[:2])
+        out = np.zeros(
+            (
+                len(times),
+                max(rows.stop - rows.start, 0),
+                max(cols.stop - cols.start, 0),
+            ),
+            dtype=dtype,
+        )
+        if out.size == 0:
+            return out
+
+        size = self.chunk_size
+        _, grid_cols = self._grid()
+        for t, key in enumerate(times):
+            with open(self.path(variable, key), "rb") as f:
+                for row, col in self._chunks(rows, cols):
+                    f.seek(16 * (row * grid_cols + col))
+                    offset, length = np.frombuffer(f.read(16), dtype="<u8")
+                    if length == 0:
+                        continue  # empty
+                    f.seek(int(offset))
+                    top, left = row * size, col * size
+                    chunk = np.frombuffer(
+                        zlib.decompress(f.read(int(length))), dtype=dtype
+                    ).reshape(min(size, height - top), min(size, width - left))
+                    r0 = max(rows.start, top)
+                    r1 = min(rows.stop, top + chunk.shape[0])
+                    c0 = max(cols.start, left)
+                    c1 = min(cols.stop, left + chunk.shape[1])
+                    out[
+                        t,
+                        r0 - rows.start : r1 - rows.start,
+                        c0 - cols.start : c1 - cols.start,
+                    ] = chunk[r0 - top : r1 - top, c0 - left : c1 - left]
+        return out
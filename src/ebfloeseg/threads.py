@@ -0,0 +1,97 @@
+import os
+from contextlib import contextmanager
+from logging import getLogger
+from typing import Iterator, Optional
+
+logger = getLogger(__name__)
+
+# Environment variables read by OpenMP and the BLAS libraries used by numpy and
+# scipy. They only take effect if set before those libraries are loaded.
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+
+def split_cores(
+    workers: Optional[int] = None,
+    threads: Optional[int] = None,
+    cpus: Optional[int] = None,
+) -> tuple[int, int]:
+    """
+    Split the cores between worker processes and threads within each worker.
+
+    Whatever isn't given is chosen so that workers * threads is the number of
+    cores. If neither is given, each core gets a single-threaded worker, which
+    avoids oversubscribing the node.
+
+    Examples:
+        >>> split_cores(cpus=64)
+        (64, 1)
+        >>> split_cores(threads=4, cpus=64)
+        (16, 4)
+        >>> split_cores(workers=8, cpus=64)
+        (8, 8)
+        >>> split_cores(workers=8, threads=2, cpus=64)
+        (8, 2)
+        >>> split_cores(threads=128, cpus=64)
+        (1, 128)
+    """
+    cpus = cpus or os.cpu_count() or 1
+    if workers is None and threads is None:
+        threads = 1
+    if workers is None:
+        workers = max(1, cpus // threads)
+    if threads is None:
+        threads = max(1, cpus // workers)
+    return workers, threads
+
+
+def set_thread_budget(threads: int) -> None:
+    """
+    Limit the threads used by OpenCV, OpenMP, BLAS and GDAL in this process.
+
+    OpenCV and GDAL are limited immediately. The OpenMP and BLAS limits are set
+    through environment variables, so they only apply to libraries which haven't
+    been loaded yet, and to processes started from this one.
+    """
+    logger.debug("limiting to %s threads", threads)
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+    os.environ["GDAL_NUM_THREADS"] = str(threads)
+
+    import cv2
+
+    cv2.setNumThreads(threads)
+
+
+@contextmanager
+def thread_budget(threads: Optional[int]) -> Iterator[None]:
+    """
+    Apply `set_thread_budget` within a block, and restore the previous limits.
+
+    Used by the warm workers of `fsdproc serve`, so that the `--threads` of
+    one job doesn't apply to the next ones. Does nothing if `threads` is None.
+    """
+    if threads is None:
+        yield
+        return
+
+    import cv2
+
+    variables = (*THREAD_ENV_VARS, "GDAL_NUM_THREADS")
+    previous = {var: os.environ.get(var) for var in variables}
+    previous_cv2 = cv2.getNumThreads()
+    set_thread_budget(threads)
+    try:
+        yield
+    finally:
+        for var, value in previous.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+        cv2.setNumThreads(previous_cv2)
@@ -0,0 +1,145 @@
+"""A cache of snapshot tiles on a fixed grid, shared by overlapping requests.
+
+The grid is anchored at the origin of the CRS, so that the tiles of any two
+bounding boxes at the same scale line up, and a tile downloaded for one
+location is reused for every other location which overlaps it on the same
+day. Tiles are stored in the format they were requested in, at
+
+    DIR/LAYER/DATETIME/WRAP/CRS/SCALE-TILE_SIZE/TS/ROW_COL.EXTENSION
+
+where TS is the `ts` parameter of the requests, and EXTENSION is derived from
+their `FORMAT`, e.g. `tiff` for "image/tiff".
+"""
+
+import math
+import os
+import re
+import uuid
+from logging import getLogger
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from ebfloeseg.bbox import BoundingBox
+
+logger = getLogger(__name__)
+
+DEFAULT_TILE_SIZE = 512  # pixels
+
+
+class TileKey(NamedTuple):
+    layer: str
+    datetime: str
+    wrap: str
+    format: str  # media type, e.g. "image/tiff"
+    ts: int
+    crs: str
+    scale: int | float
+    tile_size: int
+    row: int  # counting down from y = 0
+    col: int  # counting right from x = 0
+
+    @property
+    def extension(self) -> str:
+        """
+        The file extension of the tile.
+
+        Examples:
+            >>> key = TileKey("L", "2020-01-01", "day", "image/tiff", 0, "", 1, 1, 0, 0)
+            >>> key.extension, key._replace(format="image/jpeg").extension
+            ('tiff', 'jpeg')
+        """
+        return _safe(self.format.rpartition("/")[2])
+
+    @property
+    def bbox(self) -> BoundingBox:
+        """
+        The bounding box of the tile.
+
+        Examples:
+            >>> TileKey("L", "", "day", "image/tiff", 0, "", 250, 512, 0, -1).bbox
+            BoundingBox(x1=-128000, y1=-128000, x2=0, y2=0)
+        """
+        size = self.tile_size * self.scale
+        return BoundingBox(
+            self.col * size,
+            -(self.row + 1) * size,
+            (self.col + 1) * size,
+            -self.row * size,
+        )
+
+
+class GridWindow(NamedTuple):
+    """A bounding box snapped to the pixel grid, and the tiles covering it."""
+
+    bbox: BoundingBox
+    row: int  # of the top left pixel, counting down from y = 0
+    col: int  # of the top left pixel, counting right from x = 0
+    height: int
+    width: int
+    tiles: list[tuple[int, int]]  # rows and columns of the tiles
+
+
+def grid_window(bbox: BoundingBox, scale: int | float, tile_size: int) -> GridWindow:
+    """
+    Snap a bounding box outwards to the pixels of the grid, and find its tiles.
+
+    Examples:
+        >>> w = grid_window(BoundingBox(-300, -100, 900, 250), 100, 4)
+        >>> w.bbox, (w.row, w.col, w.height, w.width)
+        (BoundingBox(x1=-300, y1=-100, x2=900, y2=300), (-3, -3, 4, 12))
+        >>> w.tiles
+        [(-1, -1), (-1, 0), (-1, 1), (-1, 2), (0, -1), (0, 0), (0, 1), (0, 2)]
+    """
+    col0 = math.floor(bbox.x1 / scale)
+    col1 = math.ceil(bbox.x2 / scale)
+    row0 = math.floor(-bbox.y2 / scale)
+    row1 = math.ceil(-bbox.y1 / scale)
+    tiles = [
+        (row, col)
+        for row in range(row0 // tile_size, (row1 - 1) // tile_size + 1)
+        for col in range(col0 // tile_size, (col1 - 1) // tile_size + 1)
+    ]
+    snapped = BoundingBox(col0 * scale, -row1 * scale, col1 * scale, -row0 * scale)
+    return GridWindow(snapped, row0, col0, row1 - row0, col1 - col0, tiles)
+
+
+def _safe(part) -> str:
+    return re.sub(r"[^\w.-]", "_", str(part))
+
+
+class TileCache:
+    """
+    Snapshot tiles in a directory, which may be shared by many processes.
+
+    Tiles are written in one step, so a process never reads a partial tile.
+    Two processes which miss the same tile at the same time both download it.
+    """
+
+    def __init__(self, direc: Path, tile_size: int = DEFAULT_TILE_SIZE):
+        self.direc = Path(direc)
+        self.tile_size = tile_size
+
+    def path(self, key: TileKey) -> Path:
+        return (
+            self.direc
+            / _safe(key.layer)
+            / _safe(key.datetime)
+            / _safe(key.wrap)
+            / _safe(key.crs)
+            / _safe(f"{key.scale}-{key.tile_size}")
+            / _safe(key.ts)
+            / f"{key.row}_{key.col}.{key.extension}"
+        )
+
+    def get(self, key: TileKey) -> Optional[bytes]:
+        try:
+            return self.path(key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: TileKey, content: bytes) -> None:
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(".%s.%s.tmp" % (path.name, uuid.uuid4().hex))
+        tmp.write_bytes(content)
+        os.replace(tmp, path)
@@ -0,0 +1,172 @@
+"""A cheap check of a scene before it is segmented.
+
+Many scenes are almost fully clouded, or have too few clear pixels bright
+enough to be ice to yield any floes. `triage` estimates the cloud, land and
+clear fractions and the ice thresholds from a strided sample of the scene,
+so that `segment` can skip such scenes before the adaptive threshold and the
+erosion rounds, which take almost all of its time.
+"""
+
+import json
+from dataclasses import asdict, dataclass
+from logging import getLogger
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from numpy.typing import NDArray
+
+from ebfloeseg.utils import (
+    RED_BINS,
+    bin_counts,
+    count_values,
+    get_wcuts_from_histogram,
+    ice_floor,
+)
+
+logger = getLogger(__name__)
+
+
+@dataclass
+class TriageThresholds:
+    """The limits below which a scene is skipped.
+
+    Attributes:
+        min_clear_fraction: Smallest fraction of the scene not covered by land
+            or clouds.
+        max_cloud_fraction: Largest fraction of the pixels which aren't land
+            that may be covered by clouds.
+        min_ice_pixels: Smallest (estimated) number of clear pixels which are
+            bright enough to be ice.
+        stride: Only every `stride`th row and column is sampled.
+    """
+
+    min_clear_fraction: float = 0.01
+    max_cloud_fraction: float = 0.99
+    min_ice_pixels: int = 100
+    stride: int = 4
+
+
+@dataclass
+class Triage:
+    """The outcome of `triage` for one scene.
+
+    Attributes:
+        land_fraction: Fraction of the scene covered by land.
+        cloud_fraction: Fraction of the pixels which aren't land covered by
+            clouds.
+        clear_fraction: Fraction of the scene covered by neither.
+        ice_pixels: Estimated number of clear pixels brighter than the
+            lowest possible ice threshold, the lower of the two cuts (see
+            `ice_floor`).
+        ow_cut_min, ow_cut_max: The limits of the ice threshold estimated from
+            the sample, or None if its histogram has no ice peak.
+        reason: Why the scene should be skipped, or None if it is usable.
+    """
+
+    land_fraction: float
+    cloud_fraction: float
+    clear_fraction: float
+    ice_pixels: int
+    ow_cut_min: Optional[float]
+    ow_cut_max: Optional[float]
+    reason: Optional[str]
+
+    @property
+    def usable(self) -> bool:
+        return self.reason is None
+
+    def write(self, path: Path) -> None:
+        """Write the triage as JSON."""
+        with open(path, "w") as f:
+            json.dump(asdict(self), f, indent=2, default=float)
+
+
+def _fraction(count, total) -> float:
+    return float(count / total) if total else 0.0
+
+
+def triage(
+    red: NDArray[np.uint8],
+    cloud_mask: NDArray[np.bool_],
+    land_mask: NDArray[np.bool_],
+    thresholds: Optional[TriageThresholds] = None,
+) -> Triage:
+    """
+    Decide from a strided sample whether a scene is worth segmenting.
+
+    A scene is skipped if too little of it is clear, too much of its sea is
+    clouded, the histogram of its clear pixels has no ice peak (so that the
+    ice thresholds can't be determined), or too few clear pixels are
+    brighter than the lowest possible ice threshold.
+
+    Args:
+        red (NDArray[np.uint8]): The red channel of the scene, unmasked.
+        cloud_mask (NDArray[np.bool_]): The cloud mask.
+        land_mask (NDArray[np.bool_]): The land mask.
+        thresholds (TriageThresholds, optional): Defaults to
+            `TriageThresholds()`.
+
+    Returns:
+        Triage: The fractions, thresholds and the reason to skip the scene.
+
+    Examples:
+        >>> red = np.full((40, 40), 30, dtype=np.uint8)
+        >>> clouds = np.zeros((40, 40), dtype=bool)
+        >>> clouds[:, 1:] = True
+        >>> thresholds = TriageThresholds(max_cloud_fraction=0.8)
+        >>> t = triage(red, clouds, np.zeros_like(clouds), thresholds)
+        >>> t.clear_fraction, t.cloud_fraction, t.reason
+        (0.1, 0.9, 'cloud fraction 0.9 > 0.8')
+    """
+    if thresholds is None:
+        thresholds = TriageThresholds()
+    stride = thresholds.stride
+    red, cloud, land = (a[::stride, ::stride] for a in (red, cloud_mask, land_mask))
+
+    land_count = np.count_nonzero(land)
+    masked = cloud | land
+    clear = masked.size - np.count_nonzero(masked)
+    land_fraction = _fraction(land_count, land.size)
+    cloud_fraction = _fraction(masked.size - land_count - clear, land.size - land_count)
+    clear_fraction = _fraction(clear, masked.size)
+
+    # the histogram of the masked red channel, as `segment` computes it
+    red_counts = count_values(np.where(masked, 0, red))
+    try:
+        ow_cut_min, ow_cut_max = get_wcuts_from_histogram(
+            bin_counts(red_counts, RED_BINS), RED_BINS
+        )
+    except (IndexError, ValueError):  # no peaks, or an empty histogram
+        ow_cut_min = ow_cut_max = None
+        ice_pixels = 0
+    else:
+        floor = ice_floor(ow_cut_min, ow_cut_max)
+        ice_pixels = int(red_counts[int(floor) + 1 :].sum()) * stride**2
+
+    if clear_fraction < thresholds.min_clear_fraction:
+        reason = "clear fraction %.3g < %.3g" % (
+            clear_fraction,
+            thresholds.min_clear_fraction,
+        )
+    elif cloud_fraction > thresholds.max_cloud_fraction:
+        reason = "cloud fraction %.3g > %.3g" % (
+            cloud_fraction,
+            thresholds.max_cloud_fraction,
+        )
+    elif ow_cut_min is None:
+        reason = "no ice peak in the histogram"
+    elif ice_pixels < thresholds.min_ice_pixels:
+        reason = "about %s ice pixels < %s" % (ice_pixels, thresholds.min_ice_pixels)
+    else:
+        reason = None
+
+    return Triage(
+        land_fraction=land_fraction,
+        cloud_fraction=cloud_fraction,
+        clear_fraction=clear_fraction,
+        ice_pixels=ice_pixels,
+        ow_cut_min=ow_cut_min,
+        ow_cut_max=ow_cut_max,
+        reason=reason,
+    )
@@ -1,15 +1,19 @@
+import os
+import uuid
+from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
 
-import matplotlib.pyplot as plt
 import numpy as np
 import skimage
-from numpy.typing import ArrayLike
+from numpy.typing import ArrayLike, NDArray
 
 from ebfloeseg.peakdet import peakdet
 
 
 def imshow(img: ArrayLike, cmap: str = "gray", show: bool = True) -> None:
+    import matplotlib.pyplot as plt  # interactive use only
+
     plt.imshow(img, cmap=cmap)
     plt.axis("off")
     if show:
@@ -17,6 +21,8 @@ def imshow(img: ArrayLike, cmap: str = "gray", show: bool = True) -> None:
 
 
 def imopen(path: str) -> None:
+    import matplotlib.pyplot as plt
+
     return plt.imread(path)
 
 
@@ -112,10 +118,44 @@ def write_mask_values(
     """
     land_cloud_mask_sum = sum(sum(~(lmd)))
     ice_mask_sum = sum(sum(ice_mask))
-    ratio = ice_mask_sum / land_cloud_mask_sum
+    write_mask_sums(ice_mask_sum, land_cloud_mask_sum, doy, save_direc, fname)
+
+
+def write_mask_sums(
+    ice_mask_sum: int,
+    land_cloud_mask_sum: int,
+    doy: str,
+    save_direc: str,
+    fname: str,
+    replace: bool = False,
+) -> None:
+    """
+    Write already computed mask values to a text file.
+
+    Args:
+        ice_mask_sum (int): Number of ice pixels.
+        land_cloud_mask_sum (int): Number of pixels not covered by land or clouds.
+        doy (int): Day of year.
+        save_direc (str): Directory to save the text file.
+        replace (bool): Whether the file holds only this scene, and is replaced
+            by its row. Otherwise the row is appended, as the file is shared by
+            several scenes.
+
+    Returns:
+        None
+    """
+    ratio = np.divide(ice_mask_sum, land_cloud_mask_sum)
     towrite = f"{doy}\t{ice_mask_sum}\t{land_cloud_mask_sum}\t{ratio}\n"
-    with open(save_direc / fname, "a") as f:
-        f.write(towrite)
+    path = Path(save_direc) / fname
+    if not replace:
+        with open(path, "a") as f:
+            f.write(towrite)
+        return
+
+    # replaced in one step, so that readers never see a partial file
+    tmp = path.with_name(".%s.%s.tmp" % (path.name, uuid.uuid4().hex))
+    tmp.write_text(towrite)
+    os.replace(tmp, path)
 
 
 def get_region_properties(img: ArrayLike, red_c: ArrayLike) -> dict[str, ArrayLike]:
@@ -170,9 +210,110 @@ def get_region_properties(img: ArrayLike, red_c: ArrayLike) -> dict[str, ArrayLi
     return props_renamed
 
 
+RED_BINS = np.arange(1, 256, 5)
+
+
+def count_values(
+    img: NDArray[np.uint8], stride: int = 1, rows_per_chunk: int = 1024
+) -> NDArray[np.int64]:
+    """
+    Count the number of pixels with each value 0...255 in a uint8 image.
+
+    The image is counted with `np.bincount` in chunks of rows, so that no
+    full-size temporary arrays are needed.
+
+    Args:
+        img: The image.
+        stride: Only count every `stride`th row and column, to speed up very
+            large images.
+        rows_per_chunk: Number of rows counted at once.
+
+    Returns:
+        NDArray: The 256 counts.
+    """
+    sample = img[::stride, ::stride]
+    counts = np.zeros(256, dtype=np.int64)
+    for start in range(0, sample.shape[0], rows_per_chunk):
+        chunk = sample[start : start + rows_per_chunk]
+        counts += np.bincount(chunk.ravel(), minlength=256)
+    return counts
+
+
+def bin_counts(counts: NDArray[np.int64], bins: ArrayLike) -> NDArray[np.int64]:
+    """
+    Sum the counts of each value into the histogram with integer `bins`.
+
+    This is identical to `np.histogram(img, bins)[0]`, where the last bin
+    includes its right edge.
+
+    Examples:
+        >>> img = np.array([[0, 1, 5, 6], [250, 251, 252, 255]], dtype=np.uint8)
+        >>> bin_counts(count_values(img), RED_BINS)[[0, 1, -1]]
+        array([2, 1, 2])
+        >>> np.histogram(img, bins=RED_BINS)[0][[0, 1, -1]]
+        array([2, 1, 2])
+    """
+    bins = np.asarray(bins)
+    cumulative = np.concatenate([[0], np.cumsum(counts)])
+    hist = cumulative[bins[1:]] - cumulative[bins[:-1]]
+    hist[-1] += counts[bins[-1]]
+    return hist
+
+
+@dataclass
+class SceneStats:
+    """Statistics of a scene, gathered in a single pass over its red channel.
+
+    Attributes:
+        red_counts: number of pixels with each value 0...255 in the masked red
+            channel (or in the strided sample of it).
+        unmasked: number of pixels not covered by the land and cloud masks.
+        stride: the red channel was sampled every `stride` rows and columns.
+    """
+
+    red_counts: NDArray[np.int64]
+    unmasked: int
+    stride: int = 1
+
+    def histogram(self, bins: ArrayLike = RED_BINS) -> NDArray[np.int64]:
+        """Get the histogram of the masked red channel for integer `bins`."""
+        return bin_counts(self.red_counts, bins)
+
+
+def get_scene_stats(
+    red_masked: NDArray[np.uint8],
+    land_cloud_mask: NDArray[np.bool_],
+    stride: int = 1,
+) -> SceneStats:
+    """
+    Gather the statistics of a scene used for thresholding and reporting.
+
+    Args:
+        red_masked: The red channel, with masked pixels set to zero.
+        land_cloud_mask: The combined land and cloud mask.
+        stride: Only count every `stride`th row and column of the red channel,
+            to speed up very large scenes. The histogram is then approximate,
+            but the number of unmasked pixels is always exact.
+
+    Returns:
+        SceneStats: The statistics.
+    """
+    red_counts = count_values(red_masked, stride=stride)
+    unmasked = land_cloud_mask.size - np.count_nonzero(land_cloud_mask)
+    return SceneStats(red_counts=red_counts, unmasked=unmasked, stride=stride)
+
+
 def get_wcuts(red_masked):
-    bins = np.arange(1, 256, 5)
-    rn, rbins = np.histogram(red_masked.flatten(), bins=bins)
+    bins = RED_BINS
+    if red_masked.dtype == np.uint8:
+        rn = bin_counts(count_values(red_masked), bins)
+    else:
+        rn, _ = np.histogram(red_masked.flatten(), bins=bins)
+    ow_cut_min, ow_cut_max = get_wcuts_from_histogram(rn, bins)
+    return ow_cut_min, ow_cut_max, bins
+
+
+def get_wcuts_from_histogram(rn, rbins):
     dx = 0.01 * np.mean(rn)
     rmaxtab, rmintab = peakdet(rn, dx)
     rmax_n = rbins[rmaxtab[-1, 0]]
@@ -190,7 +331,22 @@ def get_wcuts(red_masked):
     else:
         ow_cut_max = rmax_n - 10
 
-    return ow_cut_min, ow_cut_max, bins
+    return ow_cut_min, ow_cut_max
+
+
+def ice_floor(ow_cut_min: float, ow_cut_max: float) -> float:
+    """
+    The lowest value the adaptive ice threshold, clipped to the cuts, can take.
+
+    The cuts of `get_wcuts_from_histogram` may be inverted, e.g. when the
+    histogram has a single peak, and then `np.clip` sets the threshold to
+    `ow_cut_max` everywhere.
+
+    Examples:
+        >>> ice_floor(41, 51), ice_floor(100, 51)
+        (41, 51)
+    """
+    return min(ow_cut_min, ow_cut_max)
 
 
 def smallest_dtype(arr: np.array):
@@ -0,0 +1,58 @@
+from dataclasses import dataclass
+from enum import Enum
+
+from ebfloeseg.bbox import BoundingBox
+
+
+class WindowUnits(str, Enum):
+    crs = "crs"
+    pixel = "pixel"
+
+
+@dataclass(frozen=True)
+class SceneWindow:
+    """A sub-region of a scene, to be read without reading the whole raster.
+
+    With `units=WindowUnits.crs` the bounding box is (left, bottom, right, top) in
+    the coordinate reference system of the rasters, like the `--bbox` of `load`.
+    With `units=WindowUnits.pixel` it is (first column, first row, last column,
+    last row), where the last column and row are excluded.
+    """
+
+    bbox: BoundingBox
+    units: WindowUnits = WindowUnits.crs
+
+    def __post_init__(self):
+        """ensure that the fields are of the correct type"""
+        if not isinstance(self.bbox, BoundingBox):
+            object.__setattr__(self, "bbox", BoundingBox(*self.bbox))
+        if not isinstance(self.units, WindowUnits):
+            object.__setattr__(self, "units", WindowUnits(self.units))
+
+    def to_window(self, dataset):
+        """Get the rasterio Window of `dataset` covered by this window.
+
+        The window is snapped to whole pixels and clipped to the extent of the
+        dataset. A rasterio WindowError is raised if they don't overlap.
+        """
+        from rasterio.windows import Window, from_bounds
+
+        x1, y1, x2, y2 = self.bbox
+        match self.units:
+            case WindowUnits.crs:
+                window = from_bounds(
+                    min(x1, x2),
+                    min(y1, y2),
+                    max(x1, x2),
+                    max(y1, y2),
+                    transform=dataset.transform,
+                )
+                window = window.round_offsets().round_lengths()
+            case WindowUnits.pixel:
+                window = Window(
+                    col_off=min(x1, x2),
+                    row_off=min(y1, y2),
+                    width=abs(x2 - x1),
+                    height=abs(y2 - y1),
+                )
+        return window.intersection(Window(0, 0, dataset.width, dataset.height))
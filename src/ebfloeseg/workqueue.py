@@ -0,0 +1,349 @@
+"""A queue of scenes on a shared filesystem, for batches spread over many nodes.
+
+Any number of `fsdproc process-batch --queue-dir DIR` processes, on any number
+of nodes, add the scenes to the queue and take them from it until every scene
+has been processed. The shared filesystem is the only means of coordination:
+
+- `DIR/tasks/KEY.json` describes a scene. It is published with `os.link`, which
+  fails if the file exists already, so every scene is added once.
+- `DIR/leases/KEY` is created exclusively (`O_CREAT | O_EXCL`) by the process
+  which claims the scene, and holds the name of that process. The process
+  touches its leases regularly; a lease which hasn't been touched for
+  `lease_duration` seconds belongs to a process which has died. It is taken
+  over by replacing it with a lease naming the new owner, while holding
+  `DIR/leases/.KEY.takeover`, which is also created exclusively, so that only
+  one process takes over a lease and the lease never disappears meanwhile.
+- `DIR/done/KEY.json` holds the result of a scene, once it has finished.
+
+Lease expiry is judged from modification times, so `lease_duration` should be
+well above the clock differences between the nodes. A process which is merely
+slow, rather than dead, notices that its lease was taken over when it next
+renews it or completes the scene, and gives up the scene without recording a
+result. The new owner writes the outputs of the scene again, replacing those of
+the slow process.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from dataclasses import asdict
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from ebfloeseg.batch import Task, TaskResult, make_report, run_tasks
+
+logger = getLogger(__name__)
+
+DEFAULT_LEASE_DURATION = 600.0  # seconds
+
+
+def _write_json_exclusive(path: Path, obj: Any) -> bool:
+    """Publish `obj` at `path` in one step, unless `path` exists. Returns whether it did."""
+    tmp = path.with_name(".%s.%s.tmp" % (path.name, uuid.uuid4().hex))
+    with open(tmp, "w") as f:
+        json.dump(obj, f, default=str)
+    try:
+        os.link(tmp, path)
+    except FileExistsError:
+        return False
+    finally:
+        tmp.unlink()
+    return True
+
+
+def _write_json_atomic(path: Path, obj: Any) -> None:
+    """Write `obj` to `path` in one step, replacing any existing file."""
+    tmp = path.with_name(".%s.%s.tmp" % (path.name, uuid.uuid4().hex))
+    with open(tmp, "w") as f:
+        json.dump(obj, f, indent=2, default=str)
+    os.replace(tmp, path)
+
+
+class WorkQueue:
+    """
+    A queue of items on a shared filesystem, see the module documentation.
+
+    Args:
+        direc (Path): Directory of the queue, shared by all processes using it.
+        lease_duration (float): Seconds after which the claim of a process which
+            stopped renewing its leases expires.
+        owner (str, optional): Name of this process in the leases. Defaults to
+            the host name, process id and a random suffix.
+    """
+
+    def __init__(
+        self,
+        direc: Path,
+        lease_duration: float = DEFAULT_LEASE_DURATION,
+        owner: Optional[str] = None,
+    ):
+        self.direc = Path(direc)
+        self.tasks_direc = self.direc / "tasks"
+        self.leases_direc = self.direc / "leases"
+        self.done_direc = self.direc / "done"
+        for direc in (self.tasks_direc, self.leases_direc, self.done_direc):
+            direc.mkdir(parents=True, exist_ok=True)
+        self.lease_duration = lease_duration
+        self.owner = owner or "%s-%s-%s" % (
+            socket.gethostname(),
+            os.getpid(),
+            uuid.uuid4().hex[:8],
+        )
+        self.held: set[str] = set()
+        self._items: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def add(self, key: str, item: dict) -> bool:
+        """Add an item, unless an item with the same key was added before."""
+        added = _write_json_exclusive(self.tasks_direc / f"{key}.json", item)
+        if added:
+            logger.debug("added %s to %s", key, self.direc)
+        return added
+
+    def items(self) -> dict[str, dict]:
+        """Get all the items added to the queue so far, by key."""
+        for path in self.tasks_direc.glob("*.json"):
+            key = path.stem
+            if key not in self._items:
+                with open(path) as f:
+                    self._items[key] = json.load(f)
+        return self._items
+
+    def is_done(self, key: str) -> bool:
+        return (self.done_direc / f"{key}.json").exists()
+
+    def results(self) -> dict[str, dict]:
+        """Get the results of the finished items, by key."""
+        results = {}
+        for path in sorted(self.done_direc.glob("*.json")):
+            with open(path) as f:
+                results[path.stem] = json.load(f)
+        return results
+
+    def remaining(self) -> list[str]:
+        """Get the keys of the items which haven't finished."""
+        return sorted(key for key in self.items() if not self.is_done(key))
+
+    def _lease_expired(self, lease: Path) -> bool:
+        try:
+            return time.time() - lease.stat().st_mtime > self.lease_duration
+        except FileNotFoundError:
+            return True
+
+    def _lease_owner(self, key: str) -> Optional[str]:
+        try:
+            return (self.leases_direc / key).read_text()
+        except FileNotFoundError:
+            return None
+
+    def _hold(self, key: str) -> None:
+        with self._lock:
+            self.held.add(key)
+
+    def _check_held(self, key: str) -> bool:
+        """Check that this process still owns the lease of `key`, or drop the claim."""
+        owner = self._lease_owner(key)
+        if owner == self.owner:
+            return True
+        if owner is None:
+            logger.warning("lease of %s was lost", key)
+        else:
+            logger.warning("lease of %s was taken over by %s", key, owner)
+        with self._lock:
+            self.held.discard(key)
+        return False
+
+    def _acquire(self, key: str) -> bool:
+        lease = self.leases_direc / key
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not self._lease_expired(lease):
+                return False
+            return self._take_over(key)
+        with os.fdopen(fd, "w") as f:
+            f.write(self.owner)
+        self._hold(key)
+        return True
+
+    def _take_over(self, key: str) -> bool:
+        lease = self.leases_direc / key
+        takeover = self.leases_direc / f".{key}.takeover"
+        try:
+            os.close(os.open(takeover, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            if self._lease_expired(takeover):
+                # left behind by a process which died while taking over
+                takeover.unlink(missing_ok=True)
+            return False
+        try:
+            # another process may have taken the lease over since it was checked,
+            # or its owner released it, in which case it is claimed as usual
+            if not lease.exists() or not self._lease_expired(lease):
+                return False
+            logger.warning(
+                "lease of %s held by %s expired, taking it over",
+                key,
+                self._lease_owner(key),
+            )
+            tmp = lease.with_name(".%s.%s.tmp" % (key, self.owner))
+            tmp.write_text(self.owner)
+            os.replace(tmp, lease)
+        finally:
+            takeover.unlink()
+        self._hold(key)
+        return True
+
+    def claim(self, order=None) -> Optional[tuple[str, dict]]:
+        """
+        Claim the next unfinished item which no live process has claimed.
+
+        Args:
+            order (Callable, optional): Key function for the order in which the
+                items are tried, given the key and the item. Defaults to the keys.
+
+        Returns:
+            tuple[str, dict] or None: The key and item, or None if there is none.
+        """
+        items = self.items()
+        keys = sorted(items)
+        if order is not None:
+            keys.sort(key=lambda key: order(key, items[key]))
+        for key in keys:
+            if key in self.held or self.is_done(key):
+                continue
+            if not self._acquire(key):
+                continue
+            if self.is_done(key):  # finished by its previous owner meanwhile
+                self.release(key)
+                continue
+            logger.info("claimed %s", key)
+            return key, items[key]
+        return None
+
+    def release(self, key: str) -> None:
+        """Give up the claim of an item, e.g. so another process can take it."""
+        lease = self.leases_direc / key
+        with self._lock:
+            self.held.discard(key)
+        try:
+            if lease.read_text() == self.owner:
+                lease.unlink()
+        except FileNotFoundError:
+            pass
+
+    def complete(self, key: str, result: dict) -> bool:
+        """
+        Record the result of an item and release it.
+
+        Returns:
+            bool: Whether the result was recorded. It isn't if the lease of the
+                item was taken over by another process, which records its own.
+        """
+        if not self._check_held(key):
+            return False
+        _write_json_atomic(self.done_direc / f"{key}.json", result)
+        self.release(key)
+        return True
+
+    def renew(self) -> None:
+        """Touch the leases held by this process, so that they don't expire.
+
+        Leases which were taken over by another process are dropped.
+        """
+        with self._lock:
+            held = list(self.held)
+        for key in held:
+            if not self._check_held(key):
+                continue
+            try:
+                os.utime(self.leases_direc / key)
+            except FileNotFoundError:
+                self._check_held(key)
+
+    def __enter__(self):
+        """Renew the leases in a background thread while in the context."""
+        self._stop = threading.Event()
+
+        def heartbeat():
+            while not self._stop.wait(self.lease_duration / 4):
+                self.renew()
+
+        self._heartbeat = threading.Thread(target=heartbeat, daemon=True)
+        self._heartbeat.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._heartbeat.join()
+        for key in list(self.held):
+            self.release(key)
+
+
+def process_queue(
+    queue: WorkQueue,
+    make_task: Callable[[dict], Task],
+    poll_interval: Optional[float] = None,
+    **kwargs,
+) -> list[TaskResult]:
+    """
+    Process items of the queue with `run_tasks` until all of them have finished.
+
+    Items are claimed in decreasing order of their "cost", whenever a worker is
+    free. Once there is nothing left to claim, this waits for the items claimed
+    by other processes, taking them over if those processes die.
+
+    Args:
+        queue (WorkQueue): The queue.
+        make_task (Callable): Makes the task to run for an item.
+        poll_interval (float, optional): Seconds between checks of the queue
+            while other processes hold all the remaining items. Defaults to a
+            quarter of the lease duration, or 10 seconds if that is shorter.
+        **kwargs: Passed on to `run_tasks`.
+
+    Returns:
+        list[TaskResult]: The outcome of the tasks run by this process.
+    """
+    if poll_interval is None:
+        poll_interval = min(10.0, queue.lease_duration / 4)
+    keys: dict[int, str] = {}
+
+    def claim() -> Optional[Task]:
+        claimed = queue.claim(order=lambda key, item: -item.get("cost", 0))
+        if claimed is None:
+            return None
+        key, item = claimed
+        task = make_task(item)
+        keys[id(task)] = key
+        return task
+
+    def on_result(task: Task, result: TaskResult) -> None:
+        key = keys.pop(id(task))
+        if result.status == "cancelled":
+            queue.release(key)
+        else:
+            queue.complete(key, asdict(result))
+
+    results: list[TaskResult] = []
+    with queue:
+        while True:
+            results += run_tasks([], claim=claim, on_result=on_result, **kwargs)
+            if any(result.status == "cancelled" for result in results):
+                break  # stopped after a failure
+            remaining = queue.remaining()
+            if not remaining:
+                break
+            logger.info("waiting for %s scenes claimed elsewhere", len(remaining))
+            time.sleep(poll_interval)
+    return results
+
+
+def write_queue_report(queue: WorkQueue, path: Path) -> dict:
+    """Write the results of all the finished items of the queue, sorted by key."""
+    report = make_report(list(queue.results().values()))
+    _write_json_atomic(Path(path), report)
+    return report
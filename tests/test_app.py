@@ -1,6 +1,8 @@
 from pathlib import Path
 import subprocess
 import filecmp
+import sys
+import time
 
 import pytest
 import pandas as pd
@@ -8,6 +10,8 @@ import rasterio
 import numpy as np
 
 from ebfloeseg.app import parse_config_file
+from ebfloeseg.bbox import BoundingBox
+from ebfloeseg.window import SceneWindow, WindowUnits
 
 
 def getdirs(p: Path):
@@ -55,8 +59,7 @@ def _test_output(tmpdir):
 @pytest.mark.slow
 def test_fsdproc(tmpdir):
     config_file = tmpdir.join("config.toml")
-    config_file.write(
-        f"""
+    config_file.write(f"""
         data_direc = "tests/input"
         save_figs = true
         save_direc = "{tmpdir}"
@@ -67,8 +70,7 @@ def test_fsdproc(tmpdir):
         step = -1
         kernel_type = "diamond"
         kernel_size = 1
-        """
-    )
+        """)
 
     result = subprocess.run(
         [
@@ -89,8 +91,7 @@ def test_fsdproc(tmpdir):
 
 def test_parse_config_file(tmpdir):
     config_file = tmpdir.join("config.toml")
-    config_file.write(
-        """
+    config_file.write("""
         data_direc = "/path/to/data"
         save_figs = true
         save_direc = "/path/to/save"
@@ -101,8 +102,7 @@ def test_parse_config_file(tmpdir):
         step = 2
         kernel_type = "ellipse"
         kernel_size = 3
-        """
-    )
+        """)
 
     params = parse_config_file(config_file)
 
@@ -115,3 +115,93 @@ def test_parse_config_file(tmpdir):
     assert params.step == 2
     assert params.kernel_type == "ellipse"
     assert params.kernel_size == 3
+    assert params.window is None
+
+
+def test_parse_config_file_with_window(tmpdir):
+    config_file = tmpdir.join("config.toml")
+    config_file.write("""
+        data_direc = "/path/to/data"
+        save_direc = "/path/to/save"
+        land = "/path/to/landfile"
+        window = [100, 50, 400, 250]
+        window_units = "pixel"
+        [erosion]
+        """)
+
+    params = parse_config_file(config_file)
+
+    assert params.window == SceneWindow(
+        BoundingBox(100, 50, 400, 250), WindowUnits.pixel
+    )
+
+
+def test_parse_config_file_with_triage(tmpdir):
+    config_file = tmpdir.join("config.toml")
+    config_file.write("""
+        data_direc = "/path/to/data"
+        save_direc = "/path/to/save"
+        land = "/path/to/landfile"
+        [erosion]
+        [triage]
+        max_cloud_fraction = 0.9
+        """)
+
+    assert parse_config_file(config_file).triage == {"max_cloud_fraction": 0.9}
+
+
+def test_parse_config_file_with_coarse_block_size(tmpdir):
+    config_file = tmpdir.join("config.toml")
+    config_file.write("""
+        data_direc = "/path/to/data"
+        save_direc = "/path/to/save"
+        land = "/path/to/landfile"
+        coarse_block_size = 64
+        [erosion]
+        """)
+
+    assert parse_config_file(config_file).coarse_block_size == 64
+
+
+HEAVY_DEPENDENCIES = ["cv2", "scipy", "skimage", "rasterio", "pandas", "matplotlib"]
+
+
+def test_app_import_does_not_load_heavy_dependencies():
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, ebfloeseg.app; "
+            f"print(' '.join(m for m in {HEAVY_DEPENDENCIES!r} if m in sys.modules))",
+        ],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == ""
+
+
+# Generous budget: the CLI used to take well over a second to print its help
+# because it imported the whole numerical stack at module load.
+STARTUP_BUDGET_SECONDS = 1.0
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["--help"],
+        ["get-bbox", "--help"],
+        ["load", "--help"],
+        ["process", "--help"],
+    ],
+)
+def test_cli_startup_time(args):
+    timings = []
+    for _ in range(3):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-m", "ebfloeseg.app", *args], capture_output=True
+        )
+        timings.append(time.perf_counter() - start)
+        assert result.returncode == 0, result.stderr
+    assert min(timings) < STARTUP_BUDGET_SECONDS, f"{args}: {timings}"
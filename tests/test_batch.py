@@ -0,0 +1,144 @@
+import json
+import os
+import time
+
+import pytest
+
+from ebfloeseg.batch import Task, run_tasks, write_report
+
+
+def succeed(path):
+    path.write_text("done")
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+def hang():
+    time.sleep(60)
+
+
+def crash():
+    os._exit(3)
+
+
+def fail_first_time(path):
+    if not path.exists():
+        path.write_text("tried")
+        raise RuntimeError("first attempt")
+
+
+def test_run_tasks(tmp_path):
+    tasks = [Task(f"task{i}", succeed, (tmp_path / f"{i}",)) for i in range(5)]
+    results = run_tasks(tasks, max_workers=2)
+    assert [result.status for result in results] == ["succeeded"] * 5
+    assert [result.name for result in results] == [task.name for task in tasks]
+    assert all((tmp_path / f"{i}").exists() for i in range(5))
+
+
+def test_run_tasks_continue_on_error(tmp_path):
+    tasks = [
+        Task("fail", fail, ("broken scene",)),
+        Task("crash", crash),
+        Task("ok", succeed, (tmp_path / "ok",)),
+    ]
+    results = run_tasks(tasks, max_workers=1, continue_on_error=True)
+    assert [result.status for result in results] == ["failed", "failed", "succeeded"]
+    assert results[0].error == "ValueError('broken scene')"
+    assert "broken scene" in results[0].traceback
+    assert "exited with code 3" in results[1].error
+
+
+def test_run_tasks_stops_after_first_failure(tmp_path):
+    tasks = [
+        Task("fail", fail, ("broken scene",)),
+        Task("ok", succeed, (tmp_path / "ok",)),
+    ]
+    results = run_tasks(tasks, max_workers=1)
+    assert [result.status for result in results] == ["failed", "cancelled"]
+    assert not (tmp_path / "ok").exists()
+
+
+def test_run_tasks_timeout(tmp_path):
+    tasks = [
+        Task("hang", hang),
+        Task("ok", succeed, (tmp_path / "ok",)),
+    ]
+    start = time.monotonic()
+    results = run_tasks(tasks, max_workers=1, timeout=1, continue_on_error=True)
+    assert time.monotonic() - start < 30
+    assert [result.status for result in results] == ["timed_out", "succeeded"]
+    assert results[0].duration == pytest.approx(1, abs=0.5)
+
+
+def test_run_tasks_retries(tmp_path):
+    tasks = [Task("flaky", fail_first_time, (tmp_path / "flaky",))]
+    assert run_tasks(tasks, max_workers=1)[0].status == "failed"
+    (tmp_path / "flaky").unlink()
+    results = run_tasks(tasks, max_workers=1, retries=1)
+    assert results[0].status == "succeeded"
+    assert results[0].attempts == 2
+
+
+def test_write_report(tmp_path):
+    tasks = [
+        Task("fail", fail, ("broken scene",), info={"doy": "214"}),
+        Task("ok", succeed, (tmp_path / "ok",), info={"doy": "215"}),
+    ]
+    results = run_tasks(tasks, max_workers=2, continue_on_error=True)
+    write_report(results, tmp_path / "report.json")
+
+    report = json.loads((tmp_path / "report.json").read_text())
+    assert report["summary"] == {
+        "succeeded": 1,
+        "failed": 1,
+        "timed_out": 0,
+        "cancelled": 0,
+    }
+    assert [task["info"]["doy"] for task in report["tasks"]] == ["214", "215"]
+    assert report["tasks"][0]["error"] == "ValueError('broken scene')"
+
+
+def record(path, seconds=0.0):
+    start = time.time()
+    time.sleep(seconds)
+    with open(path, "a") as f:
+        f.write(f"{os.getpid()} {start} {time.time()}\n")
+
+
+def read_records(path):
+    records = [line.split() for line in path.read_text().splitlines()]
+    return [(int(pid), float(start), float(end)) for pid, start, end in records]
+
+
+def test_run_tasks_without_recycling_reuses_workers(tmp_path):
+    tasks = [Task(f"task{i}", record, (tmp_path / "log",)) for i in range(3)]
+    run_tasks(tasks, max_workers=1)
+    assert len({pid for pid, _, _ in read_records(tmp_path / "log")}) == 1
+
+
+def test_run_tasks_recycles_workers_after_max_tasks(tmp_path):
+    tasks = [Task(f"task{i}", record, (tmp_path / "log",)) for i in range(4)]
+    results = run_tasks(tasks, max_workers=1, max_tasks_per_worker=2)
+    assert all(result.status == "succeeded" for result in results)
+    assert all(result.peak_memory > 0 for result in results)
+    assert len({pid for pid, _, _ in read_records(tmp_path / "log")}) == 2
+
+
+def test_run_tasks_recycles_workers_above_max_memory(tmp_path):
+    tasks = [Task(f"task{i}", record, (tmp_path / "log",)) for i in range(3)]
+    run_tasks(tasks, max_workers=1, max_worker_memory=1)
+    assert len({pid for pid, _, _ in read_records(tmp_path / "log")}) == 3
+
+
+@pytest.mark.parametrize("memory_budget,overlapping", [(None, True), (150, False)])
+def test_run_tasks_memory_budget(tmp_path, memory_budget, overlapping):
+    tasks = [
+        Task(f"task{i}", record, (tmp_path / "log", 1.0), size=10) for i in range(2)
+    ]
+    run_tasks(tasks, max_workers=2, memory_budget=memory_budget, bytes_per_unit=10)
+    (_, start1, end1), (_, start2, end2) = sorted(
+        read_records(tmp_path / "log"), key=lambda record: record[1]
+    )
+    assert (start2 < end1) == overlapping
@@ -0,0 +1,136 @@
+import json
+import subprocess
+
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+
+from ebfloeseg.compare import compare_labels, compare_props
+
+
+def blocks(seed=0, shape=(60, 80), n=12):
+    """Label image of rectangular floes on a grid."""
+    rng = np.random.default_rng(seed)
+    labels = np.zeros(shape, dtype=np.int32)
+    for label in range(1, n + 1):
+        r, c = rng.integers(0, shape[0] // 6) * 6, rng.integers(0, shape[1] // 8) * 8
+        labels[r : r + 5, c : c + 7] = label
+    return labels
+
+
+def test_identical_labels_match():
+    labels = blocks()
+    comparison = compare_labels(labels, labels)
+    n = len(np.unique(labels)) - 1
+    assert comparison.summary()["matched"] == n
+    assert comparison.mismatch == 0
+    assert (comparison.matched[:, 0] == comparison.matched[:, 1]).all()
+    assert (comparison.iou == 1).all()
+
+
+def test_relabeled_floes_match():
+    labels = blocks()
+    permutation = np.concatenate([[0], np.random.default_rng(1).permutation(12) + 1])
+    comparison = compare_labels(labels, permutation[labels])
+    assert comparison.mismatch == 0
+    assert (permutation[comparison.matched[:, 0]] == comparison.matched[:, 1]).all()
+
+
+def test_split_merged_missing_and_added_floes():
+    reference = np.zeros((10, 40), dtype=np.int32)
+    reference[:, 0:8] = 1  # matched
+    reference[:, 10:19] = 2  # split
+    reference[:, 20:23] = 3  # merged
+    reference[:, 23:26] = 4  # merged
+    reference[:, 26:29] = 5  # merged
+    reference[:, 31:34] = 6  # missing
+    candidate = np.zeros_like(reference)
+    candidate[:, 0:8] = 11
+    candidate[:, 10:13] = 12
+    candidate[:, 13:16] = 13
+    candidate[:, 16:19] = 14
+    candidate[:, 20:29] = 15
+    candidate[:, 36:40] = 16  # added
+
+    comparison = compare_labels(reference, candidate)
+
+    assert comparison.matched.tolist() == [[1, 11]]
+    assert comparison.split.tolist() == [2]
+    assert comparison.merged.tolist() == [15]
+    assert comparison.missing.tolist() == [6]
+    assert comparison.added.tolist() == [16]
+    assert comparison.mismatch == pytest.approx(1 - 2 / 12)
+
+
+def test_min_iou():
+    reference = np.array([[1, 1, 1, 1, 0]])
+    candidate = np.array([[0, 2, 2, 2, 2]])
+    assert len(compare_labels(reference, candidate, min_iou=0.6).matched) == 1
+    assert len(compare_labels(reference, candidate, min_iou=0.7).matched) == 0
+
+
+def test_different_shapes():
+    with pytest.raises(ValueError):
+        compare_labels(np.zeros((2, 3), int), np.zeros((3, 2), int))
+
+
+def test_compare_props():
+    reference = pd.DataFrame({"label": [1, 2], "area": [10.0, 20.0]})
+    candidate = pd.DataFrame({"label": [7, 8], "area": [21.0, 10.0]})
+    deltas = compare_props(reference, candidate, np.array([[1, 8], [2, 7]]))
+    (row,) = deltas.itertuples()
+    assert row.property == "area"
+    assert row.max_abs_delta == 1
+    assert row.max_rel_delta == pytest.approx(0.05)
+
+
+def write_labels(path, labels):
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=labels.shape[0],
+        width=labels.shape[1],
+        count=1,
+        dtype=labels.dtype,
+    ) as dst:
+        dst.write(labels, 1)
+
+
+def fsdproc_compare(*args):
+    return subprocess.run(
+        ["fsdproc", "compare", *map(str, args)], capture_output=True, text=True
+    )
+
+
+def test_cli_exit_code(tmp_path):
+    labels = blocks()
+    write_labels(tmp_path / "reference_final.tif", labels)
+    write_labels(tmp_path / "same_final.tif", labels)
+    changed = labels.copy()
+    changed[changed == 3] = 0
+    write_labels(tmp_path / "changed_final.tif", changed)
+
+    result = fsdproc_compare(
+        tmp_path / "reference_final.tif", tmp_path / "same_final.tif"
+    )
+    assert result.returncode == 0, result.stderr
+
+    result = fsdproc_compare(
+        tmp_path / "reference_final.tif",
+        tmp_path / "changed_final.tif",
+        "--report",
+        tmp_path / "report.json",
+    )
+    assert result.returncode == 1
+    (report,) = json.loads((tmp_path / "report.json").read_text("utf-8"))
+    assert report["labels"]["missing"] == 1
+
+    result = fsdproc_compare(
+        tmp_path / "reference_final.tif",
+        tmp_path / "changed_final.tif",
+        "--max-mismatch",
+        "0.1",
+    )
+    assert result.returncode == 0, result.stderr
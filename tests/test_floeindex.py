@@ -0,0 +1,151 @@
+import datetime
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+
+from ebfloeseg.bbox import BoundingBox
+from ebfloeseg.floeindex import FloeIndex
+
+EXPECTED = "tests/expected"
+DAY1 = datetime.date(2012, 8, 1)
+DAY2 = datetime.date(2012, 8, 2)
+
+
+@pytest.fixture
+def outputs(tmp_path):
+    """Copies of the props tables and labelled floes of the expected outputs."""
+    direc = tmp_path / "out"
+    for doy, date in [(214, DAY1), (215, DAY2)]:
+        (direc / str(doy)).mkdir(parents=True)
+        for name in ["props.csv", "final.tif"]:
+            shutil.copy(
+                f"{EXPECTED}/{doy}/{date}_terra_{name}",
+                direc / str(doy) / f"{date}_terra_{name}",
+            )
+    return direc
+
+
+def scan(props_path, bbox, by):
+    """The labels of the floes of a props table in a region, the slow way."""
+    props = pd.read_csv(props_path, index_col=0)
+    with rasterio.open(str(props_path).replace("props.csv", "final.tif")) as labels:
+        t = labels.transform
+    if by == "centroid":
+        x = t.c + t.a * (props["col_centroid"] + 0.5)
+        y = t.f + t.e * (props["row_centroid"] + 0.5)
+        inside = x.between(bbox.x1, bbox.x2) & y.between(bbox.y1, bbox.y2)
+    else:
+        x1, x2 = t.c + t.a * props["min_col"], t.c + t.a * props["max_col"]
+        y1, y2 = t.f + t.e * props["max_row"], t.f + t.e * props["min_row"]
+        inside = (x1 <= bbox.x2) & (x2 >= bbox.x1) & (y1 <= bbox.y2) & (y2 >= bbox.y1)
+    return set(props["label"][inside])
+
+
+@pytest.mark.parametrize("by", ["bbox", "centroid"])
+def test_query_finds_the_same_floes_as_a_scan(outputs, tmp_path, by):
+    index = FloeIndex(tmp_path / "floes.sqlite")
+    summary = index.update([outputs])
+    assert summary == {"added": 2, "removed": 0, "unchanged": 0, "floes": 1285}
+
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        x, y = rng.uniform(-2334051, -1127689), rng.uniform(-414387, 757892)
+        size = rng.uniform(1e3, 3e5)
+        bbox = BoundingBox(x, y, x + size, y + size)
+        for doy, date in [(214, DAY1), (215, DAY2)]:
+            floes = index.query(bbox, start=date, end=date, by=by)
+            expected = scan(outputs / str(doy) / f"{date}_terra_props.csv", bbox, by)
+            assert set(floes["label"]) == expected
+            assert (floes["date"] == date.isoformat()).all()
+
+
+def test_query_filters(outputs, tmp_path):
+    index = FloeIndex(tmp_path / "floes.sqlite")
+    index.update([outputs])
+    everywhere = BoundingBox(-1e8, -1e8, 1e8, 1e8)
+
+    floes = index.query(everywhere)
+    assert len(floes) == 1285
+    assert list(floes.columns[:3]) == ["date", "satellite", "label"]
+    assert len(index.query(everywhere, start=DAY2)) == 364
+    assert len(index.query(everywhere, end=DAY1)) == 921
+    assert len(index.query(everywhere, satellite="terra")) == 1285
+    assert len(index.query(everywhere, satellite="aqua")) == 0
+    assert len(index.query(BoundingBox(0, 0, 1, 1))) == 0
+
+
+def test_update_is_incremental(outputs, tmp_path):
+    path = tmp_path / "floes.sqlite"
+    with FloeIndex(path) as index:
+        index.update([outputs])
+    everywhere = BoundingBox(-1e8, -1e8, 1e8, 1e8)
+
+    # the index persists, and unchanged tables aren't read again
+    with FloeIndex(path) as index:
+        summary = index.update([outputs])
+        assert summary == {"added": 0, "removed": 0, "unchanged": 2, "floes": 0}
+        assert len(index.query(everywhere)) == 1285
+
+    # a rewritten table replaces its floes, and a deleted one is removed
+    props_path = outputs / "214" / f"{DAY1}_terra_props.csv"
+    props = pd.read_csv(props_path, index_col=0)
+    props.head(10).to_csv(props_path)
+    os.utime(props_path, ns=(0, 0))
+    (outputs / "215" / f"{DAY2}_terra_props.csv").unlink()
+    (outputs / "other").mkdir()
+    (outputs / "other" / "props.csv").write_text("")  # no date, skipped
+    with FloeIndex(path) as index:
+        summary = index.update([outputs])
+        assert summary == {"added": 1, "removed": 1, "unchanged": 0, "floes": 10}
+        floes = index.query(everywhere)
+        assert floes["label"].tolist() == sorted(props["label"].head(10))
+
+
+def test_index_has_one_crs(outputs, tmp_path):
+    index = FloeIndex(tmp_path / "floes.sqlite")
+    index.update([outputs / "214"])
+
+    labels_path = outputs / "215" / f"{DAY2}_terra_final.tif"
+    with rasterio.open(labels_path) as src:
+        profile, labels = src.profile, src.read()
+    profile["crs"] = "EPSG:3995"
+    with rasterio.open(labels_path, "w", **profile) as dst:
+        dst.write(labels)
+    with pytest.raises(ValueError, match="CRS"):
+        index.update([outputs / "215"])
+
+
+def test_cli(outputs, tmp_path):
+    index = tmp_path / "floes.sqlite"
+    result = subprocess.run(
+        ["fsdproc", "index", str(outputs), "--index", str(index)],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    assert "added 2" in result.stdout
+
+    result = subprocess.run(
+        [
+            "fsdproc",
+            "query",
+            str(index),
+            "--bbox",
+            "-1500000,-300000,-1400000,-200000",
+            "--start",
+            "2012-08-02",
+            "--output",
+            str(tmp_path / "floes.csv"),
+        ],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    floes = pd.read_csv(tmp_path / "floes.csv")
+    assert len(floes) == 39
+    assert (floes["date"] == "2012-08-02").all()
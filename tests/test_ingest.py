@@ -0,0 +1,40 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.windows import Window
+
+from ebfloeseg.ingest import read_rgb
+
+truecolor = Path(__file__).parent / "process/truecolor.tiff"
+
+
+def test_read_rgb():
+    with rasterio.open(truecolor) as tci:
+        rgb = read_rgb(tci)
+        expected = np.dstack(tci.read()[:3])
+    assert rgb.shape == (413, 1078, 3)
+    assert rgb.dtype == np.uint8
+    np.testing.assert_array_equal(rgb, expected)
+
+
+def test_read_rgb_into_preallocated_buffer():
+    window = Window(100, 50, 300, 200)
+    out = np.zeros((200, 300, 3), dtype=np.uint8)
+    with rasterio.open(truecolor) as tci:
+        rgb = read_rgb(tci, window=window, out=out)
+        expected = np.dstack(tci.read(window=window)[:3])
+    assert rgb is out
+    np.testing.assert_array_equal(out, expected)
+
+
+def test_read_rgb_unknown_bands(tmp_path):
+    fname = tmp_path / "gray.tif"
+    with rasterio.open(
+        fname, "w", driver="GTiff", width=2, height=2, count=1, dtype=np.uint8
+    ) as dst:
+        dst.write(np.zeros((1, 2, 2), dtype=np.uint8))
+
+    with rasterio.open(fname) as tci, pytest.raises(ValueError):
+        read_rgb(tci)
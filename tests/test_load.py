@@ -1,10 +1,15 @@
+import io
 from pathlib import Path
 
+import numpy as np
 import pytest
+import rasterio
+import requests
 import requests_mock
+from rasterio.io import MemoryFile
 
-from ebfloeseg.load import load, ImageType, Satellite, DataSet
-
+from ebfloeseg.bbox import BoundingBox
+from ebfloeseg.load import SNAPSHOT_URL, load, mosaic, ImageType, Satellite, DataSet
 
 ExampleDataSetBeaufortSea = DataSet(
     datetime="2016-07-01T00:00:00Z",
@@ -38,3 +43,174 @@ def test_error_on_empty_file():
         )
         with pytest.raises(AssertionError):
             load()
+
+
+def fake_snapshot(request, context):
+    """A GeoTIFF for the requested bbox, whose pixels depend on their position.
+
+    A PNG, without georeferencing, if that is the requested format.
+    """
+    x1, y1, x2, y2 = map(float, request.qs["bbox"][0].split(","))
+    width, height = int(request.qs["width"][0]), int(request.qs["height"][0])
+    transform = rasterio.transform.from_bounds(x1, y1, x2, y2, width, height)
+    cols, rows = np.meshgrid(np.arange(width), np.arange(height))
+    xs, ys = rasterio.transform.xy(transform, rows, cols)
+    xs, ys = np.asarray(xs).reshape(height, width), np.asarray(ys).reshape(
+        height, width
+    )
+    data = np.stack(
+        [(xs // 1000) % 251 + 1, (ys // 1000) % 241 + 1, np.full(xs.shape, 7)]
+    ).astype(np.uint8)
+    if request.qs.get("format") == ["image/png"]:
+        profile = dict(driver="PNG")
+    else:
+        profile = dict(
+            driver="GTiff",
+            crs=request.qs["crs"][0].upper(),
+            transform=transform,
+            photometric="RGB",
+        )
+    with MemoryFile() as memfile:
+        with memfile.open(
+            width=width, height=height, count=3, dtype="uint8", **profile
+        ) as dst:
+            dst.write(data)
+        return memfile.read()
+
+
+def test_tiled_load_matches_single_request():
+    bbox = BoundingBox(-100_000, -50_000, 150_000, 70_000)
+    with requests_mock.Mocker() as m:
+        m.get(SNAPSHOT_URL, content=fake_snapshot)
+        whole = load(bbox=bbox, scale=1000)
+        assert m.call_count == 1
+        tiled = load(bbox=bbox, scale=1000, tile_size=64)
+        assert m.call_count == 1 + 4 * 2
+
+    assert tiled.img.shape == whole.img.shape == (120, 250)
+    assert tiled.img.transform.almost_equals(whole.img.transform)
+    assert tiled.img.crs == whole.img.crs
+    assert tiled.img.colorinterp == whole.img.colorinterp
+    assert np.array_equal(tiled.img.read(), whole.img.read())
+
+
+def test_tiled_load_retries_failed_tiles(monkeypatch):
+    monkeypatch.setattr("ebfloeseg.load.RETRY_DELAY", 0)
+    failed = set()
+
+    def flaky_snapshot(request, context):
+        bbox = request.qs["bbox"][0]
+        if bbox not in failed:
+            failed.add(bbox)
+            context.status_code = 503
+            return b""
+        return fake_snapshot(request, context)
+
+    with requests_mock.Mocker() as m:
+        m.get(SNAPSHOT_URL, content=flaky_snapshot)
+        with pytest.raises(requests.HTTPError):
+            load(bbox=BoundingBox(0, 0, 100_000, 100_000), scale=1000, tile_size=64)
+        failed.clear()
+        result = load(
+            bbox=BoundingBox(0, 0, 100_000, 100_000),
+            scale=1000,
+            tile_size=64,
+            retries=1,
+        )
+    assert result.img.shape == (100, 100)
+
+
+def test_mosaic_reprojects_tiles_off_the_grid():
+    bbox = BoundingBox(0, 0, 8_000, 4_000)
+    with requests_mock.Mocker() as m:
+        m.get(SNAPSHOT_URL, content=fake_snapshot)
+        whole = load(bbox=bbox, scale=1000)
+        # a tile larger than the right half of the image
+        larger = load(bbox=BoundingBox(3_000, 0, 9_000, 4_000), scale=1000)
+
+    left = rasterio.open(io.BytesIO(whole.content))
+    tiles = [(left, slice(0, 4), slice(0, 4)), (larger.img, slice(0, 4), slice(4, 8))]
+    result = mosaic(tiles, 8, 4, whole.img.transform, whole.img.crs)
+    assert np.array_equal(result.img.read(), whole.img.read())
+
+
+def test_cached_load_downloads_each_tile_once(tmp_path):
+    bbox = BoundingBox(-100_000, -50_000, 150_000, 70_000)
+    overlapping = BoundingBox(0, -50_000, 200_000, 70_000)
+    with requests_mock.Mocker() as m:
+        m.get(SNAPSHOT_URL, content=fake_snapshot)
+        whole = load(bbox=bbox, scale=1000)
+        cached = load(bbox=bbox, scale=1000, tile_size=64, cache_dir=tmp_path)
+        # columns -128..191 and rows -128..63 of the grid
+        assert m.call_count == 1 + 5 * 3
+        load(bbox=bbox, scale=1000, tile_size=64, cache_dir=tmp_path)
+        assert m.call_count == 1 + 5 * 3
+        load(bbox=overlapping, scale=1000, tile_size=64, cache_dir=tmp_path)
+        assert m.call_count == 1 + 5 * 3 + 1 * 3
+
+    assert cached.img.shape == whole.img.shape
+    assert cached.img.transform.almost_equals(whole.img.transform)
+    assert np.array_equal(cached.img.read(), whole.img.read())
+
+
+@pytest.mark.filterwarnings("ignore::rasterio.errors.NotGeoreferencedWarning")
+def test_cached_load_keeps_formats_apart(tmp_path):
+    bbox = BoundingBox(0, 0, 64_000, 64_000)
+    with requests_mock.Mocker() as m:
+        m.get(SNAPSHOT_URL, content=fake_snapshot)
+        load(bbox=bbox, scale=1000, tile_size=64, cache_dir=tmp_path)
+        assert m.call_count == 1
+        load(bbox=bbox, scale=1000, tile_size=64, cache_dir=tmp_path, ts=1)
+        assert m.call_count == 2
+        load(
+            bbox=bbox,
+            scale=1000,
+            tile_size=64,
+            cache_dir=tmp_path,
+            format="image/png",
+            validate=False,
+        )
+        assert m.call_count == 3
+        assert m.last_request.qs["format"] == ["image/png"]
+    assert sorted(path.name for path in tmp_path.rglob("*.*")) == [
+        "-1_0.png",
+        "-1_0.tiff",
+        "-1_0.tiff",
+    ]
+
+
+def test_cached_load_doesnt_cache_error_pages(tmp_path):
+    bbox = BoundingBox(0, 0, 64_000, 64_000)
+    with requests_mock.Mocker() as m:
+        m.get(SNAPSHOT_URL, content=b"<html>Service Unavailable</html>")
+        with pytest.raises(rasterio.errors.RasterioIOError):
+            load(bbox=bbox, scale=1000, tile_size=64, cache_dir=tmp_path)
+        assert not any(path.is_file() for path in tmp_path.rglob("*"))
+
+        m.get(SNAPSHOT_URL, content=fake_snapshot)
+        load(bbox=bbox, scale=1000, tile_size=64, cache_dir=tmp_path)
+        assert m.call_count == 2
+
+
+@pytest.mark.filterwarnings("ignore::rasterio.errors.NotGeoreferencedWarning")
+def test_tiled_and_cached_loads_keep_the_format(tmp_path):
+    bbox = BoundingBox(-64_000, 0, 64_000, 64_000)
+    png = dict(bbox=bbox, scale=1000, format="image/png")
+    with requests_mock.Mocker() as m:
+        m.get(SNAPSHOT_URL, content=fake_snapshot)
+        whole = load(**png)
+        tiled = load(**png, tile_size=32)
+        cached = load(**png, tile_size=32, cache_dir=tmp_path)
+
+    for result in (whole, tiled, cached):
+        assert result.content.startswith(b"\x89PNG")
+        assert result.img.driver == "PNG"
+        assert np.array_equal(result.img.read(), whole.img.read())
+
+
+def test_tiled_load_rejects_formats_it_cant_write():
+    with requests_mock.Mocker() as m:
+        m.get(SNAPSHOT_URL, content=fake_snapshot)
+        with pytest.raises(ValueError, match="can't combine tiles into image/gif"):
+            load(scale=1000, tile_size=64, format="image/gif")
+        assert m.call_count == 0
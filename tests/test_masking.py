@@ -1,7 +1,17 @@
 from unittest.mock import patch
 import numpy as np
+import pytest
+import skimage
 from numpy.testing import assert_array_equal
-from ebfloeseg.masking import mask_image, create_land_mask, create_cloud_mask, maskrgb
+from skimage.morphology import diamond
+from ebfloeseg.masking import (
+    MaskDilation,
+    dilate_mask,
+    mask_image,
+    create_land_mask,
+    create_cloud_mask,
+    maskrgb,
+)
 
 
 def test_mask_image():
@@ -48,8 +58,9 @@ def test_create_land_mask():
         def __init__(self, lmfile):
             self.land_mask = land_mask
 
-        def read(self):
-            return [self.land_mask]
+        def read(self, indexes=None, window=None):
+            assert indexes == 1
+            return self.land_mask
 
     with patch("rasterio.open", new=MockRasterioOpen):
         result = create_land_mask("dummy_file")
@@ -65,8 +76,9 @@ def test_create_cloud_mask():
         def __init__(self, lmfile):
             self.cloud_mask = np.array([[0, 0, 255], [0, 255, 0], [255, 0, 0]])
 
-        def read(self):
-            return [self.cloud_mask]
+        def read(self, indexes=None, window=None):
+            assert indexes == 1
+            return self.cloud_mask
 
     with patch("rasterio.open", new=MockRasterioOpen):
         result = create_cloud_mask("dummy_file")
@@ -87,3 +99,25 @@ def test_maskrgb():
 
     # Assert the result
     assert_array_equal(rgb, expected_result)
+
+
+@pytest.mark.parametrize("radius", [0, 1, 3, 10])
+@pytest.mark.parametrize("density", [0.0, 0.001, 0.05, 1.0])
+def test_dilate_mask_matches_binary_dilation(radius, density):
+    rng = np.random.default_rng(radius)
+    mask = rng.random((97, 131)) < density
+    mask[0, 5] = density > 0  # touching the edge
+    expected = skimage.morphology.binary_dilation(mask, diamond(radius))
+    assert_array_equal(dilate_mask(mask, radius), expected)
+
+
+def test_mask_dilation_reuses_the_land_mask():
+    rng = np.random.default_rng(0)
+    land_mask = rng.random((80, 60)) < 0.01
+    mask_dilation = MaskDilation(land_mask)
+    for _ in range(3):
+        cloud_mask = rng.random((80, 60)) < 0.01
+        expected = skimage.morphology.binary_dilation(
+            land_mask | cloud_mask, diamond(10)
+        )
+        assert_array_equal(mask_dilation.dilate(cloud_mask), expected)
@@ -2,12 +2,26 @@ import datetime
 import pytest
 from pathlib import Path
 import logging
+import cv2
 import numpy as np
+import pandas as pd
+import skimage
+from scipy import ndimage
 
 import rasterio
+from ebfloeseg.ingest import read_rgb
+from ebfloeseg.masking import create_cloud_mask, create_land_mask
 from ebfloeseg.preprocess import (
+    BLOCK_EMPTY,
+    BLOCK_ICE,
+    SegmentationParams,
+    classify_blocks,
+    fill_holes,
+    get_erosion_kernel,
+    identify_floes,
     preprocess,
     preprocess_b,
+    segment,
     count_blobs_per_label,
     clean_labels_with_multiple_blobs,
 )
@@ -188,5 +202,244 @@ def test_clean_labels_with_multiple_blobs_throws_errors_when_two_blobs_have_the_
         clean_labels_with_multiple_blobs(original)
 
 
+def identify_floes_over_whole_scene(
+    ice_mask, rgb_masked, land_cloud_mask_dilated, itmax, itmin, step, erosion_kernel
+):
+    """The rounds of _preprocess before they were restricted to regions of interest."""
+    inp = ice_mask
+    input_no = ice_mask
+    output = np.zeros((np.shape(ice_mask)), dtype=np.int16)
+    highest_label_so_far = 0
+    rounds = []
+    for r, it in enumerate(range(itmax, itmin - 1, step)):
+        eroded_ice_mask = cv2.erode(inp.astype(np.uint8), erosion_kernel, iterations=it)
+        eroded_ice_mask = ndimage.binary_fill_holes(eroded_ice_mask.astype(np.uint8))
+        dilated_ice_mask = cv2.dilate(
+            inp.astype(np.uint8), erosion_kernel, iterations=it
+        )
+        n, markers, _, _ = cv2.connectedComponentsWithStats(
+            eroded_ice_mask.astype(np.uint8)
+        )
+        markers = markers + 1
+        unknown = cv2.subtract(
+            dilated_ice_mask.astype(np.uint8), eroded_ice_mask.astype(np.uint8)
+        )
+        markers[unknown == 255] = 0
+        for a in np.arange(0, it + 1, 1):
+            markers = skimage.morphology.dilation(markers, erosion_kernel)
+        watershed = cv2.watershed(rgb_masked, markers)
+        watershed[
+            np.isin(
+                watershed,
+                np.unique(watershed[land_cloud_mask_dilated & (watershed > 1)]),
+            )
+        ] = 1
+        watershed[~input_no] = 1
+        area_lim = (it) ** 4
+        props = skimage.measure.regionprops_table(
+            watershed, properties=["label", "area"]
+        )
+        df = pd.DataFrame.from_dict(props)
+        watershed[np.isin(watershed, df[df.area < area_lim].label.values)] = 1
+        rounds.append(watershed.copy())
+        input_no = ice_mask + inp
+        inp = (watershed == 1) & (inp == 1) & ice_mask
+        watershed[watershed < 2] = 0
+        new_label_mask = watershed > 0
+        output[new_label_mask] = watershed[new_label_mask] + highest_label_so_far
+        highest_label_so_far = np.max(output)
+    return output, rounds
+
+
+def floe_scene(seed, shape=(400, 800)):
+    """Random floes of many sizes, some touching the edges, some nested in rings."""
+    rng = np.random.default_rng(seed)
+    ice = np.zeros(shape, dtype=np.uint8)
+    for _ in range(30):
+        center = (int(rng.integers(0, shape[1])), int(rng.integers(0, shape[0])))
+        axes = (int(rng.integers(2, 25)), int(rng.integers(2, 25)))
+        cv2.ellipse(ice, center, axes, float(rng.uniform(0, 180)), 0, 360, 1, -1)
+    # a ring with a small floe in its middle, which hole filling joins
+    ice[250:, 500:] = 0
+    cv2.circle(ice, (650, 320), 70, 1, 12)
+    cv2.circle(ice, (650, 320), 8, 1, -1)
+    ice = ice.astype(bool) & (rng.random(shape) > 0.02)
+    rgb = rng.integers(0, 255, (*shape, 3), dtype=np.uint8)
+    land_cloud_mask_dilated = np.zeros(shape, dtype=bool)
+    land_cloud_mask_dilated[:, :15] = True
+    return ice, rgb, land_cloud_mask_dilated
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize(
+    "kernel_type, kernel_size", [("diamond", 1), ("ellipse", 3), ("ellipse", 4)]
+)
+def test_identify_floes_matches_rounds_over_whole_scene(seed, kernel_type, kernel_size):
+    ice, rgb, land_cloud_mask_dilated = floe_scene(seed)
+    kernel = get_erosion_kernel(kernel_type, kernel_size)
+    expected, expected_rounds = identify_floes_over_whole_scene(
+        ice, rgb, land_cloud_mask_dilated, 8, 3, -1, kernel
+    )
+    rounds = []
+    output = identify_floes(
+        ice,
+        rgb,
+        land_cloud_mask_dilated,
+        8,
+        3,
+        -1,
+        kernel,
+        on_round=lambda r, watershed: rounds.append(watershed.copy()),
+    )
+    np.testing.assert_array_equal(output, expected)
+    # rounds are only skipped once no ice is left, so they don't change anything
+    assert len(rounds) <= len(expected_rounds)
+    for watershed, expected_watershed in zip(rounds, expected_rounds):
+        np.testing.assert_array_equal(watershed, expected_watershed)
+
+
+@pytest.mark.parametrize("ice", [0.3, 0.6, 0.9])
+def test_fill_holes_matches_scipy(ice):
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        shape = tuple(rng.integers(1, 80, 2))
+        mask = (rng.random(shape) < ice).astype(np.uint8)
+        # larger shapes with holes of several pixels, and nested islands
+        mask = cv2.dilate(mask, np.ones((2, 2), np.uint8))
+        np.testing.assert_array_equal(fill_holes(mask), ndimage.binary_fill_holes(mask))
+        np.testing.assert_array_equal(
+            fill_holes(mask.astype(bool)), ndimage.binary_fill_holes(mask)
+        )
+
+
+def test_segment_matches_preprocess_b(tmp_path):
+    process_dir = Path(__file__).parent / "process"
+    ftci, fcloud, fland = (
+        process_dir / "truecolor.tiff",
+        process_dir / "cloud.tiff",
+        process_dir / "landmask.tiff",
+    )
+    preprocess_b(
+        ftci=ftci,
+        fcloud=fcloud,
+        fland=fland,
+        save_figs=False,
+        save_direc=tmp_path,
+        fname_prefix="",
+        itmax=8,
+        itmin=3,
+        step=-1,
+        erosion_kernel_type="diamond",
+        erosion_kernel_size=1,
+        date=None,
+    )
+
+    with rasterio.open(ftci) as tci:
+        rgb = read_rgb(tci)
+    original = rgb.copy()
+    result = segment(
+        rgb,
+        create_cloud_mask(fcloud),
+        create_land_mask(fland),
+        SegmentationParams(itmax=8, itmin=3, step=-1),
+    )
+
+    assert np.array_equal(rgb, original), "the input was modified"
+    with rasterio.open(tmp_path / "final.tif") as dataset:
+        assert np.array_equal(result.labels, dataset.read(1))
+    pd.testing.assert_frame_equal(
+        result.props, pd.read_csv(tmp_path / "props.csv", index_col=0)
+    )
+    ice_area, unmasked = (tmp_path / "mask_values.txt").read_text().split()[1:3]
+    assert (result.ice_area, result.unmasked) == (int(ice_area), int(unmasked))
+
+
+def test_segment_checks_shapes():
+    rgb = np.zeros((10, 20, 3), dtype=np.uint8)
+    with pytest.raises(ValueError):
+        segment(rgb, np.zeros((10, 20), bool), np.zeros((20, 10), bool))
+
+
+def sparse_scene(seed, shape=(1200, 1500)):
+    """Bright floes on dark water, only in the top left of the scene."""
+    rng = np.random.default_rng(seed)
+    ice = np.zeros(shape, dtype=np.uint8)
+    for _ in range(20):
+        center = (int(rng.integers(0, 500)), int(rng.integers(0, 300)))
+        axes = (int(rng.integers(5, 40)), int(rng.integers(5, 40)))
+        cv2.ellipse(ice, center, axes, float(rng.uniform(0, 180)), 0, 360, 1, -1)
+    red = np.where(ice, 190, 25) + rng.integers(-10, 10, shape)
+    rgb = np.repeat(np.clip(red, 0, 255).astype(np.uint8)[:, :, None], 3, axis=2)
+    land_mask = np.zeros(shape, dtype=bool)
+    land_mask[:, :40] = True
+    cloud_mask = np.zeros(shape, dtype=bool)
+    cloud_mask[900:1100, 200:700] = True
+    return rgb, cloud_mask, land_mask
+
+
+@pytest.mark.parametrize("block_size", [64, 100])
+def test_coarse_pass_does_not_change_the_result(block_size):
+    rgb, cloud_mask, land_mask = sparse_scene(0)
+    expected = segment(rgb, cloud_mask, land_mask)
+    result = segment(
+        rgb,
+        cloud_mask,
+        land_mask,
+        SegmentationParams(coarse_block_size=block_size),
+    )
+
+    # most of the scene is skipped
+    blocks = classify_blocks(
+        rgb[:, :, 0] * ~(cloud_mask | land_mask),
+        cloud_mask | land_mask,
+        expected.ow_cut_min,
+        block_size,
+    )
+    assert (blocks == BLOCK_EMPTY).sum() > 2 * (blocks == BLOCK_ICE).sum()
+
+    np.testing.assert_array_equal(result.ice_mask, expected.ice_mask)
+    np.testing.assert_array_equal(result.labels, expected.labels)
+    pd.testing.assert_frame_equal(result.props, expected.props)
+
+
+def test_coarse_pass_on_a_uniform_scene():
+    rgb, cloud_mask, land_mask = sparse_scene(0)
+    rgb[:] = 20
+    expected = segment(rgb, cloud_mask, land_mask)
+    result = segment(
+        rgb, cloud_mask, land_mask, SegmentationParams(coarse_block_size=64)
+    )
+    np.testing.assert_array_equal(result.ice_mask, expected.ice_mask)
+    assert not result.labels.any()
+
+
+def inverted_cuts_scene(seed=0, shape=(600, 700)):
+    """Dim ice cut by leads only a little darker, so the histogram has one peak."""
+    rng = np.random.default_rng(seed)
+    red = rng.normal(60, 4, shape)
+    leads = np.zeros(shape, dtype=np.uint8)
+    for _ in range(25):
+        (x0, y0), (x1, y1) = rng.integers(0, 700, (2, 2))
+        cv2.line(leads, (int(x0), int(y0)), (int(x1), int(y1)), 1, 3)
+    red[leads > 0] = rng.normal(50, 3, np.count_nonzero(leads))
+    red = np.clip(red, 1, 255).astype(np.uint8)
+    rgb = np.repeat(red[:, :, None], 3, axis=2)
+    no_mask = np.zeros(shape, dtype=bool)
+    return rgb, no_mask, no_mask
+
+
+def test_coarse_pass_with_inverted_cuts():
+    rgb, cloud_mask, land_mask = inverted_cuts_scene()
+    expected = segment(rgb, cloud_mask, land_mask)
+    assert expected.ow_cut_min > expected.ow_cut_max
+    assert expected.labels.any()
+
+    result = segment(
+        rgb, cloud_mask, land_mask, SegmentationParams(coarse_block_size=64)
+    )
+    np.testing.assert_array_equal(result.ice_mask, expected.ice_mask)
+    np.testing.assert_array_equal(result.labels, expected.labels)
+
+
 if __name__ == "__main__":
     pytest.main()
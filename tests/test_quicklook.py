@@ -0,0 +1,62 @@
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from ebfloeseg.preprocess import preprocess_b
+from ebfloeseg.quicklook import GAP, quicklook, write_quicklook
+
+PROCESS_DIR = Path(__file__).parent / "process"
+
+
+def test_quicklook_panels():
+    rgb = np.full((40, 60, 3), 100, dtype=np.uint8)
+    ice_mask = np.zeros((40, 60), dtype=bool)
+    ice_mask[10:20, 10:30] = True
+    labels = np.zeros((40, 60), dtype=np.int16)
+    labels[12:18, 12:28] = 7
+
+    preview = quicklook(rgb, ice_mask, labels, factor=2)
+
+    assert preview.shape == (20, 3 * 30 + 2 * GAP, 3)
+    np.testing.assert_array_equal(preview[:, :30], rgb[::2, ::2])
+    ice = preview[:, 30 + GAP : 60 + GAP]
+    np.testing.assert_array_equal(ice[:, :, 0] == 255, ice_mask[::2, ::2])
+    floes = preview[:, 2 * (30 + GAP) :]
+    assert (floes[7, 8] != 100).any()  # a floe
+    assert (floes[0, 0] == 100).all()  # no floe
+
+
+def test_write_quicklook(tmp_path):
+    image = np.zeros((5, 8, 3), dtype=np.uint8)
+    image[:, :, 0] = 200  # red
+    write_quicklook(tmp_path / "quicklook.png", image)
+    written = cv2.imread(str(tmp_path / "quicklook.png"))[:, :, ::-1]
+    np.testing.assert_array_equal(written, image)
+
+
+def test_process_writes_only_the_quicklook(tmp_path):
+    preprocess_b(
+        ftci=PROCESS_DIR / "truecolor.tiff",
+        fcloud=PROCESS_DIR / "cloud.tiff",
+        fland=PROCESS_DIR / "landmask.tiff",
+        itmax=8,
+        itmin=3,
+        step=-1,
+        erosion_kernel_type="diamond",
+        erosion_kernel_size=1,
+        save_figs=False,
+        save_direc=tmp_path,
+        fname_prefix="",
+        date=None,
+        quicklook_factor=4,
+    )
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "final.tif",
+        "mask_values.txt",
+        "props.csv",
+        "quicklook.png",
+    ]
+    height, width = cv2.imread(str(tmp_path / "final.tif"), cv2.IMREAD_UNCHANGED).shape
+    preview = cv2.imread(str(tmp_path / "quicklook.png"))
+    assert preview.shape == (-(-height // 4), 3 * -(-width // 4) + 2 * GAP, 3)
@@ -0,0 +1,66 @@
+import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import rasterio
+import requests_mock
+
+from ebfloeseg.preprocess import preprocess_b
+from ebfloeseg.run_scene import run_scene
+
+PROCESS_DIR = Path(__file__).parent / "process"
+LAYER_FILES = {
+    "TrueColor": "truecolor.tiff",
+    "Cloud": "cloud.tiff",
+    "Land": "landmask.tiff",
+}
+
+
+def snapshot(request, context):
+    layers = request.qs["layers"][0]
+    (fname,) = [f for key, f in LAYER_FILES.items() if key.lower() in layers]
+    return (PROCESS_DIR / fname).read_bytes()
+
+
+def test_run_scene_matches_load_and_process(tmp_path):
+    date = datetime.date(2012, 8, 1)
+    with requests_mock.Mocker() as m:
+        m.get("https://wvs.earthdata.nasa.gov/api/v1/snapshot", content=snapshot)
+        run_scene(date, tmp_path / "run-scene", save_inputs=True)
+        assert m.call_count == 3
+
+    preprocess_b(
+        ftci=PROCESS_DIR / "truecolor.tiff",
+        fcloud=PROCESS_DIR / "cloud.tiff",
+        fland=PROCESS_DIR / "landmask.tiff",
+        itmax=8,
+        itmin=3,
+        step=-1,
+        erosion_kernel_type="diamond",
+        erosion_kernel_size=1,
+        save_figs=False,
+        save_direc=tmp_path / "process",
+        fname_prefix="",
+        date=date,
+    )
+
+    written = sorted(path.name for path in (tmp_path / "run-scene").iterdir())
+    assert written == [
+        "cloud.tiff",
+        "final.tif",
+        "land.tiff",
+        "mask_values.txt",
+        "props.csv",
+        "truecolor.tiff",
+    ]
+    for fname in ["final.tif", "props.csv", "mask_values.txt"]:
+        expected, actual = tmp_path / "process" / fname, tmp_path / "run-scene" / fname
+        if fname.endswith(".tif"):
+            with rasterio.open(expected) as e, rasterio.open(actual) as a:
+                assert np.array_equal(e.read(), a.read())
+                assert e.transform == a.transform
+        elif fname.endswith(".csv"):
+            pd.testing.assert_frame_equal(pd.read_csv(expected), pd.read_csv(actual))
+        else:
+            assert expected.read_text() == actual.read_text()
@@ -1,3 +1,6 @@
+import subprocess
+import sys
+
 import rasterio
 import numpy as np
 import pytest
@@ -30,3 +33,68 @@ def test_imsave(tmp_path):
             rollaxis=False,
         )
         assert tmp_path.joinpath("fnameuint8").exists()
+
+
+def run_python(script: str) -> str:
+    result = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+def test_figures_do_not_use_pyplot(tmp_path):
+    run_python(f"""
+import sys
+from pathlib import Path
+import numpy as np
+import ebfloeseg.preprocess
+from ebfloeseg.savefigs import save_ice_mask_hist
+from ebfloeseg.utils import RED_BINS
+
+assert "matplotlib" not in sys.modules, "imported before any figure is saved"
+hist = np.arange(len(RED_BINS) - 1)
+save_ice_mask_hist(hist, RED_BINS, 50, 150, Path({str(tmp_path)!r}), "hist.png")
+assert "matplotlib.pyplot" not in sys.modules
+""")
+    assert (tmp_path / "hist.png").exists()
+
+
+@pytest.mark.slow
+def test_memory_is_flat_over_many_scenes_with_figures(tmp_path):
+    # a worker writing the outputs and figures of 1000 small scenes
+    stdout = run_python(f"""
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.io import MemoryFile
+from ebfloeseg.preprocess import SegmentationResult, write_segmentation
+from ebfloeseg.utils import SceneStats
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+rng = np.random.default_rng(0)
+labels = rng.integers(0, 5, (64, 64)).astype(np.int16)
+result = SegmentationResult(
+    labels=labels,
+    ice_mask=labels > 0,
+    props=pd.DataFrame({{"label": [1, 2, 3, 4]}}),
+    stats=SceneStats(rng.integers(0, 100, 256), unmasked=64 * 64),
+    ow_cut_min=50,
+    ow_cut_max=150,
+)
+profile = dict(driver="GTiff", width=64, height=64, count=3, dtype="uint8")
+with MemoryFile() as memfile, memfile.open(**profile) as tci:
+    for scene in range(1000):
+        direc = Path({str(tmp_path)!r}) / str(scene % 10)
+        write_segmentation(result, tci, direc, save_figs=True, doy=scene)
+        if scene == 99:
+            before = rss()
+print(before, rss())
+""")
+    before, after = map(int, stdout.split())
+    assert after - before < 10 * 2**20
@@ -0,0 +1,90 @@
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from ebfloeseg.scenes import Scene, index_scenes, longest_first
+
+test_dir = Path(__file__).parent
+
+
+@pytest.fixture()
+def data_direc(tmp_path):
+    (tmp_path / "tci").mkdir()
+    (tmp_path / "cloud").mkdir()
+    for date, doy in [("2012-08-01", "214"), ("2012-08-02", "215")]:
+        shutil.copy(
+            test_dir / "process/truecolor.tiff",
+            tmp_path / f"tci/tci_{date}_{doy}_terra.tiff",
+        )
+        shutil.copy(
+            test_dir / "process/cloud.tiff",
+            tmp_path / f"cloud/cloud_{date}_{doy}_terra.tiff",
+        )
+    # an unpaired image, sorted before the others, and a hidden file
+    shutil.copy(
+        test_dir / "process/truecolor.tiff",
+        tmp_path / "tci/tci_2012-07-31_213_terra.tiff",
+    )
+    (tmp_path / "cloud/.DS_Store").write_bytes(b"")
+    return tmp_path
+
+
+def test_index_scenes_pairs_by_metadata(data_direc, caplog):
+    scenes = index_scenes(data_direc)
+
+    assert [scene.doy for scene in scenes] == ["214", "215"]
+    for scene in scenes:
+        assert scene.ftci.name == f"tci_{scene.ftci.name[4:14]}_{scene.doy}_terra.tiff"
+        assert scene.fcloud.name == scene.ftci.name.replace("tci", "cloud")
+        assert scene.pixels == 413 * 1078
+        assert 0 < scene.ice_fraction < 1
+    assert "tci_2012-07-31_213_terra.tiff" in caplog.text
+
+
+def test_index_scenes_rejects_duplicates(data_direc):
+    shutil.copy(
+        test_dir / "process/cloud.tiff",
+        data_direc / "cloud/cloud_2012-08-01_214_terra.tif",
+    )
+    with pytest.raises(ValueError):
+        index_scenes(data_direc)
+
+
+def test_longest_first():
+    scenes = [
+        Scene("a", "a", "001", "2020", "terra", pixels=100, ice_fraction=0.0),
+        Scene("b", "b", "002", "2020", "terra", pixels=100, ice_fraction=0.9),
+        Scene("c", "c", "003", "2020", "terra", pixels=1000, ice_fraction=0.1),
+        Scene("d", "d", "004", "2020", "terra", pixels=10, ice_fraction=1.0),
+    ]
+    assert [scene.doy for scene in longest_first(scenes)] == [
+        "003",
+        "002",
+        "001",
+        "004",
+    ]
+
+
+@pytest.mark.slow
+def test_process_batch_with_unpaired_image(data_direc, tmp_path):
+    save_direc = tmp_path / "out"
+    config_file = tmp_path / "config.toml"
+    config_file.write_text(f"""
+        data_direc = "{data_direc}"
+        save_direc = "{save_direc}"
+        land = "{test_dir / "process/landmask.tiff"}"
+        [erosion]
+        """)
+
+    result = subprocess.run(
+        ["fsdproc", "process-batch", "--config-file", str(config_file)],
+        capture_output=True,
+        text=True,
+    )
+
+    assert result.returncode == 0, result.stderr
+    assert sorted(d.name for d in save_direc.iterdir() if d.is_dir()) == ["214", "215"]
+    for doy, date in [("214", "2012-08-01"), ("215", "2012-08-02")]:
+        assert (save_direc / doy / f"{date}_terra_final.tif").exists()
@@ -0,0 +1,174 @@
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from ebfloeseg.serve import (
+    JobServer,
+    default_socket_path,
+    health,
+    private_directory,
+    submit,
+)
+
+test_dir = Path(__file__).parent
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    socket_path = tmp_path_factory.mktemp("serve") / "fsdproc.sock"
+    with JobServer(socket_path, max_workers=1) as server:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield server
+        server.shutdown()
+
+
+def _submit(server, command, args):
+    return submit(command, args, socket_path=server.socket_path, cwd=test_dir)
+
+
+@pytest.mark.slow
+def test_submit_process(server, tmp_path):
+    for outdir in (tmp_path / "first", tmp_path / "second"):
+        result = _submit(
+            server,
+            "process",
+            [
+                "process/truecolor.tiff",
+                "process/cloud.tiff",
+                "process/landmask.tiff",
+                str(outdir),
+                "--no-save-figs",
+            ],
+        )
+        assert result["status"] == "succeeded", result
+        assert (outdir / "final.tif").exists()
+        assert (outdir / "props.csv").exists()
+
+
+def test_submit_reports_failures(server, tmp_path):
+    result = _submit(
+        server,
+        "process",
+        ["does-not-exist.tiff", "cloud.tiff", "land.tiff", str(tmp_path)],
+    )
+    assert result["status"] == "failed"
+    assert "error" in result
+
+
+def test_submit_rejects_unknown_commands(server):
+    result = _submit(server, "get-bbox", [])
+    assert result["status"] == "error"
+
+
+def test_socket_is_private_to_the_user(server):
+    assert server.socket_path.stat().st_mode & 0o777 == 0o600
+
+
+def test_default_socket_is_in_a_private_directory(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    socket_path = default_socket_path()
+    assert socket_path.parent.parent == tmp_path
+    assert socket_path.parent.stat().st_mode & 0o777 == 0o700
+    assert default_socket_path() == socket_path
+
+
+def test_private_directory_rejects_directories_others_can_use(tmp_path):
+    shared = tmp_path / "shared"
+    shared.mkdir(mode=0o755)
+    shared.chmod(0o755)
+    with pytest.raises(PermissionError, match="accessible by other users"):
+        private_directory(shared)
+
+    (tmp_path / "link").symlink_to(private_directory(tmp_path / "private"))
+    with pytest.raises(PermissionError, match="isn't a directory"):
+        private_directory(tmp_path / "link")
+
+
+def test_submit_refuses_a_server_of_another_user(server, monkeypatch):
+    uid = os.getuid()
+    monkeypatch.setattr(os, "getuid", lambda: uid + 1)
+    with pytest.raises(PermissionError, match="not as the current user"):
+        health(server.socket_path)
+
+
+def test_server_refuses_to_replace_a_running_server(server):
+    with pytest.raises(OSError, match="already listening"):
+        JobServer(server.socket_path, max_workers=1)
+
+
+def test_server_replaces_a_stale_socket(tmp_path):
+    socket_path = tmp_path / "fsdproc.sock"
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+        stale.bind(str(socket_path))
+    with JobServer(socket_path, max_workers=1) as server:
+        assert server.socket_path.is_socket()
+    assert not socket_path.exists()
+
+
+@pytest.fixture()
+def own_server(tmp_path):
+    # the workers of the module's server, which must survive
+    other_workers = set(multiprocessing.active_children())
+    with JobServer(tmp_path / "fsdproc.sock", max_workers=1) as server:
+        server.workers = lambda: set(multiprocessing.active_children()) - other_workers
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield server
+        server.shutdown()
+
+
+def _kill_workers(server):
+    for worker in server.workers():
+        os.kill(worker.pid, signal.SIGKILL)
+
+
+def _missing_files(tmp_path):
+    return ["missing.tiff", "missing.tiff", "missing.tiff", str(tmp_path)]
+
+
+def test_job_whose_worker_died_fails_and_the_pool_is_replaced(own_server, tmp_path):
+    args = [
+        "process/truecolor.tiff",
+        "process/cloud.tiff",
+        "process/landmask.tiff",
+        str(tmp_path),
+    ]
+    results = []
+    job = threading.Thread(
+        target=lambda: results.append(_submit(own_server, "process", args))
+    )
+    job.start()
+    while not own_server.workers():
+        time.sleep(0.01)
+    _kill_workers(own_server)
+    job.join()
+
+    assert results[0]["status"] == "failed"
+    assert "BrokenProcessPool" in results[0]["error"]
+    assert health(own_server.socket_path)["status"] == "ok"
+    result = _submit(own_server, "process", _missing_files(tmp_path))
+    assert "BrokenProcessPool" not in result["error"]
+
+
+def test_health_reports_a_broken_pool(own_server, tmp_path):
+    assert (
+        _submit(own_server, "process", _missing_files(tmp_path))["status"] == "failed"
+    )
+    assert health(own_server.socket_path)["status"] == "ok"
+
+    _kill_workers(own_server)
+    deadline = time.monotonic() + 10
+    while not own_server.pool_broken() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert health(own_server.socket_path)["status"] == "broken"
+
+    result = _submit(own_server, "process", _missing_files(tmp_path))
+    assert "BrokenProcessPool" not in result["error"]
+    assert health(own_server.socket_path)["status"] == "ok"
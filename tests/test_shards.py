@@ -0,0 +1,127 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from ebfloeseg.batch import TaskResult, write_report
+from ebfloeseg.scenes import Scene, shard_scenes
+from ebfloeseg.shards import Shard, merge_shards
+
+
+def make_scenes(n):
+    return [
+        Scene(
+            ftci=Path(f"tci_{doy:03}"),
+            fcloud=Path(f"cloud_{doy:03}"),
+            doy=f"{doy:03}",
+            year="2020",
+            sat=sat,
+            pixels=1000 * (doy % 7 + 1),
+            ice_fraction=(doy % 3) / 3,
+        )
+        for doy in range(1, n + 1)
+        for sat in ["aqua", "terra"]
+    ]
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 7, 100])
+def test_shards_are_disjoint_and_cover_all_scenes(count):
+    scenes = make_scenes(40)
+    shards = [shard_scenes(scenes, i, count) for i in range(count)]
+    names = [scene.ftci for shard in shards for scene in shard]
+    assert sorted(names) == sorted(scene.ftci for scene in scenes)
+
+    # both satellites of a day are in the same shard
+    for shard in shards:
+        doys = {scene.doy for scene in shard}
+        assert len(shard) == 2 * len(doys)
+
+
+def test_shards_are_balanced():
+    scenes = make_scenes(100)
+    costs = [
+        sum(scene.estimated_cost for scene in shard_scenes(scenes, i, 4))
+        for i in range(4)
+    ]
+    largest_day = 2 * max(scene.estimated_cost for scene in scenes)
+    assert max(costs) - min(costs) <= largest_day
+
+
+def test_shards_agree_despite_different_costs_and_new_scenes():
+    scenes = make_scenes(40)
+    # another shard couldn't read some scenes, and found more in the meantime
+    other = make_scenes(45)
+    for scene in other[::3]:
+        scene.pixels, scene.ice_fraction = 0, 0.0
+
+    for index in range(4):
+        assert [scene.ftci for scene in shard_scenes(scenes, index, 4)] == [
+            scene.ftci for scene in shard_scenes(other, index, 4) if scene.doy <= "040"
+        ]
+
+
+def write_shard(direc, shard, doys, status="succeeded"):
+    results = []
+    for doy in doys:
+        (direc / doy).mkdir(parents=True)
+        (direc / doy / "mask_values.txt").write_text(doy)
+        results.append(
+            TaskResult(
+                name=f"cloud_{doy}",
+                status=status,
+                attempts=1,
+                info={"year": "2020", "doy": doy, "satellite": "terra"},
+            )
+        )
+    write_report(results, direc / shard.report_name, shard=shard._asdict())
+
+
+def test_merge_shards(tmp_path):
+    write_shard(tmp_path / "a", Shard(0, 2), ["003", "001"])
+    write_shard(tmp_path / "b", Shard(1, 2), ["002"])
+
+    merged = merge_shards([tmp_path / "b", tmp_path / "a"], tmp_path / "out")
+
+    assert merged["summary"]["succeeded"] == 3
+    assert [task["info"]["doy"] for task in merged["tasks"]] == ["001", "002", "003"]
+    assert sorted(p.name for p in (tmp_path / "out").iterdir()) == [
+        "001",
+        "002",
+        "003",
+        "batch_report.json",
+    ]
+    assert (tmp_path / "out" / "002" / "mask_values.txt").read_text() == "002"
+    with open(tmp_path / "out" / "batch_report.json") as f:
+        assert json.load(f) == merged
+
+
+def test_merge_shards_in_place(tmp_path):
+    write_shard(tmp_path, Shard(0, 2), ["001"])
+    write_shard(tmp_path, Shard(1, 2), ["002"], status="failed")
+
+    merged = merge_shards([tmp_path], tmp_path)
+
+    assert merged["summary"] == {
+        "succeeded": 1,
+        "failed": 1,
+        "timed_out": 0,
+        "cancelled": 0,
+    }
+    assert (tmp_path / "batch_report.json").exists()
+
+
+def test_merge_shards_missing_shard(tmp_path):
+    write_shard(tmp_path / "a", Shard(0, 3), ["001"])
+    write_shard(tmp_path / "b", Shard(2, 3), ["002"])
+
+    with pytest.raises(ValueError, match=r"shards \[1\] of 3"):
+        merge_shards([tmp_path / "a", tmp_path / "b"], tmp_path / "out")
+
+
+def test_merge_shards_conflict(tmp_path):
+    write_shard(tmp_path / "a", Shard(0, 2), ["001"])
+    write_shard(tmp_path / "b", Shard(1, 2), ["001"])
+
+    with pytest.raises(ValueError, match="is in both"):
+        merge_shards([tmp_path / "a", tmp_path / "b"], tmp_path / "out")
+    assert not (tmp_path / "out").exists()
@@ -0,0 +1,152 @@
+import datetime
+import multiprocessing
+import zlib
+from pathlib import Path
+
+import numpy as np
+import pytest
+import rasterio
+
+from ebfloeseg.masking import create_cloud_mask
+from ebfloeseg.preprocess import preprocess_b
+from ebfloeseg.stack import MASK_CLOUD, SceneStack
+
+PROCESS_DIR = Path(__file__).parent / "process"
+
+
+def scene(seed, shape=(70, 90)):
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, 50, shape).astype(np.int16)
+    labels[:, 40:] = 0  # empty chunks
+    return {"labels": labels, "ice_mask": labels > 10}
+
+
+@pytest.mark.parametrize("chunk_size", [16, 25, 100])
+def test_read_parts_of_the_time_series(tmp_path, chunk_size):
+    stack = SceneStack(tmp_path, chunk_size=chunk_size)
+    scenes = [scene(seed) for seed in range(3)]
+    for day, arrays in enumerate(scenes):
+        stack.append("2012-08-%02d" % (day + 1), arrays, crs="EPSG:3413")
+
+    expected = np.stack([arrays["labels"] for arrays in scenes])
+    for rows, cols in [
+        (slice(None), slice(None)),
+        (slice(10, 33), slice(30, 61)),
+        (slice(69, 70), slice(0, 1)),
+        (slice(-5, None), slice(20, 20)),
+    ]:
+        np.testing.assert_array_equal(
+            stack.read("labels", rows, cols), expected[:, rows, cols]
+        )
+    np.testing.assert_array_equal(
+        stack.read("ice_mask", times=["2012-08-02"])[0], scenes[1]["ice_mask"]
+    )
+    assert stack.crs == "EPSG:3413"
+
+
+def test_only_chunks_with_data_are_stored_and_read(tmp_path, monkeypatch):
+    empty = SceneStack(tmp_path / "empty", chunk_size=20)
+    empty.append("2012-08-01", {"labels": np.zeros((70, 90), dtype=np.int16)})
+    # only the offsets and lengths of the 4 x 5 chunks
+    assert empty.path("labels", "2012-08-01").stat().st_size == 4 * 5 * 16
+
+    stack = SceneStack(tmp_path / "stack", chunk_size=20)
+    stack.append("2012-08-01", scene(0))
+    decompressed = []
+    decompress = zlib.decompress
+    monkeypatch.setattr(
+        zlib, "decompress", lambda data: decompressed.append(data) or decompress(data)
+    )
+    np.testing.assert_array_equal(
+        stack.read("labels", slice(10, 30), slice(30, 50))[0],
+        scene(0)["labels"][10:30, 30:50],
+    )
+    assert len(decompressed) == 2  # columns 40: are empty
+
+
+def test_append_checks_the_grid(tmp_path):
+    stack = SceneStack(tmp_path)
+    stack.append("2012-08-01", scene(0), transform=(250, 0, 0, 0, -250, 0))
+    with pytest.raises(ValueError):
+        stack.append("2012-08-02", scene(1, shape=(70, 91)))
+    with pytest.raises(ValueError):
+        stack.append("2012-08-02", scene(1), transform=(500, 0, 0, 0, -500, 0))
+    with pytest.raises(ValueError):
+        stack.append("2012-08-02", {"other": np.zeros((70, 90))})
+    with pytest.raises(ValueError):
+        stack.append("2012-08-02", {"labels": np.zeros((70, 90), dtype=np.int64)})
+    with pytest.raises(ValueError):
+        stack.append("../2012-08-02", scene(1))
+    assert stack.times() == ["2012-08-01"]
+
+
+def test_append_needs_every_variable(tmp_path):
+    stack = SceneStack(tmp_path)
+    stack.append("2012-08-01", scene(0))
+    with pytest.raises(ValueError, match="ice_mask"):
+        stack.append("2012-08-02", {"labels": scene(1)["labels"]})
+    # replacing a scene with fewer variables keeps the complete scene
+    with pytest.raises(ValueError, match="ice_mask"):
+        stack.append("2012-08-01", {"labels": scene(1)["labels"]})
+    assert stack.times() == ["2012-08-01"]
+    assert not stack.path("labels", "2012-08-02").exists()
+    np.testing.assert_array_equal(stack.read("labels")[0], scene(0)["labels"])
+    np.testing.assert_array_equal(stack.read("ice_mask")[0], scene(0)["ice_mask"])
+
+
+def test_replacing_and_incomplete_scenes(tmp_path):
+    stack = SceneStack(tmp_path)
+    stack.append("2012-08-01", scene(0), satellite="terra")
+    stack.append("2012-08-01", scene(1), satellite="aqua")
+    np.testing.assert_array_equal(stack.read("labels")[0], scene(1)["labels"])
+    assert stack.attrs("2012-08-01")["satellite"] == "aqua"
+
+    stack.append("2012-08-02", scene(2))
+    (tmp_path / "times" / "2012-08-02.json").unlink()  # e.g. the writer died
+    assert stack.times() == ["2012-08-01"]
+
+
+def append_scene(direc, seed):
+    SceneStack(direc, chunk_size=16).append("2012-08-%02d" % (seed + 1), scene(seed))
+
+
+def test_concurrent_appends(tmp_path):
+    seeds = range(12)
+    with multiprocessing.get_context("spawn").Pool(6) as pool:
+        pool.starmap(append_scene, [(tmp_path, seed) for seed in seeds])
+
+    stack = SceneStack(tmp_path)
+    assert len(stack.times()) == 12
+    assert stack.chunk_size == 16
+    np.testing.assert_array_equal(
+        stack.read("labels", slice(5, 50), slice(5, 50)),
+        np.stack([scene(seed)["labels"][5:50, 5:50] for seed in seeds]),
+    )
+
+
+def test_process_appends_to_stack(tmp_path):
+    stack = SceneStack(tmp_path / "stack")
+    preprocess_b(
+        ftci=PROCESS_DIR / "truecolor.tiff",
+        fcloud=PROCESS_DIR / "cloud.tiff",
+        fland=PROCESS_DIR / "landmask.tiff",
+        itmax=8,
+        itmin=3,
+        step=-1,
+        erosion_kernel_type="diamond",
+        erosion_kernel_size=1,
+        save_figs=False,
+        save_direc=tmp_path / "out",
+        fname_prefix="",
+        date=datetime.datetime(2012, 8, 1),
+        stack=stack,
+    )
+
+    assert stack.times() == ["2012-08-01"]
+    with rasterio.open(tmp_path / "out" / "final.tif") as dataset:
+        np.testing.assert_array_equal(stack.read("labels")[0], dataset.read(1))
+        assert stack.transform == tuple(dataset.transform)[:6]
+        assert stack.crs == dataset.crs.to_wkt()
+    cloud_mask = create_cloud_mask(PROCESS_DIR / "cloud.tiff")
+    np.testing.assert_array_equal(stack.read("mask")[0] & MASK_CLOUD > 0, cloud_mask)
+    assert stack.attrs("2012-08-01")["skipped"] is None
@@ -0,0 +1,55 @@
+import os
+
+import cv2
+import pytest
+
+from ebfloeseg.batch import Task, run_tasks
+from ebfloeseg.threads import (
+    THREAD_ENV_VARS,
+    set_thread_budget,
+    split_cores,
+    thread_budget,
+)
+
+
+@pytest.fixture()
+def restore_threads(monkeypatch):
+    for var in THREAD_ENV_VARS + ("GDAL_NUM_THREADS",):
+        monkeypatch.setenv(var, "")
+    previous = cv2.getNumThreads()
+    yield
+    cv2.setNumThreads(previous)
+
+
+def test_set_thread_budget(restore_threads):
+    set_thread_budget(2)
+    assert cv2.getNumThreads() == 2
+    for var in THREAD_ENV_VARS + ("GDAL_NUM_THREADS",):
+        assert os.environ[var] == "2"
+
+
+def test_thread_budget_restores_previous_limits(restore_threads):
+    cv2.setNumThreads(5)
+    with thread_budget(2):
+        assert cv2.getNumThreads() == 2
+        assert os.environ["OMP_NUM_THREADS"] == "2"
+    assert cv2.getNumThreads() == 5
+    assert os.environ["OMP_NUM_THREADS"] == ""
+
+
+def test_split_cores_uses_all_cores():
+    for cpus in [1, 4, 6, 64]:
+        for threads in [1, 2, 4]:
+            workers, threads_ = split_cores(threads=threads, cpus=cpus)
+            assert threads_ == threads
+            assert workers * threads <= max(cpus, threads)
+
+
+def record_threads(path):
+    path.write_text(f"{cv2.getNumThreads()} {os.environ['OMP_NUM_THREADS']}")
+
+
+def test_run_tasks_applies_thread_budget_in_workers(tmp_path):
+    tasks = [Task("threads", record_threads, (tmp_path / "threads",))]
+    run_tasks(tasks, max_workers=1, initializer=set_thread_budget, initargs=(3,))
+    assert (tmp_path / "threads").read_text() == "3 3"
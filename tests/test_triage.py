@@ -0,0 +1,184 @@
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+
+from ebfloeseg.preprocess import (
+    SegmentationParams,
+    segment,
+    segment_and_write,
+    write_segmentation,
+)
+from ebfloeseg.triage import TriageThresholds, triage
+
+
+def scene(shape=(200, 300), seed=0):
+    """Bright floes on dark water, with land on the left."""
+    rng = np.random.default_rng(seed)
+    red = rng.integers(15, 35, shape).astype(np.uint8)
+    red[40:80, 100:150] = 200
+    red[120:180, 200:260] = 200
+    land_mask = np.zeros(shape, dtype=bool)
+    land_mask[:, :30] = True
+    return red, np.zeros(shape, dtype=bool), land_mask
+
+
+def test_usable_scene():
+    red, cloud_mask, land_mask = scene()
+    t = triage(red, cloud_mask, land_mask)
+    assert t.usable
+    assert t.land_fraction == pytest.approx(0.1, abs=0.01)
+    assert t.cloud_fraction == 0
+    assert t.ice_pixels == pytest.approx(40 * 50 + 60 * 60, rel=0.1)
+
+
+def test_clouded_scene():
+    red, cloud_mask, land_mask = scene()
+    cloud_mask[:, 35:] = True
+    t = triage(red, cloud_mask, land_mask, TriageThresholds(max_cloud_fraction=0.9))
+    assert t.cloud_fraction > 0.97
+    assert t.reason.startswith("cloud fraction")
+    assert triage(red, cloud_mask, land_mask).usable
+
+
+def test_scene_without_clear_pixels():
+    red, cloud_mask, land_mask = scene()
+    cloud_mask[:] = True
+    t = triage(red, cloud_mask, land_mask)
+    assert t.clear_fraction == 0
+    assert t.reason.startswith("clear fraction")
+
+
+def test_scene_with_too_little_ice():
+    red, cloud_mask, land_mask = scene()
+    red[red > 100] = 25
+    red[100:106, 150:156] = 200
+    t = triage(red, cloud_mask, land_mask)
+    assert t.ice_pixels < 100
+    assert t.reason.startswith("about")
+
+
+def test_degenerate_histogram():
+    red, cloud_mask, land_mask = scene()
+    red[:] = 0  # e.g. a missing swath
+    t = triage(red, cloud_mask, land_mask)
+    assert (t.ow_cut_min, t.ow_cut_max) == (None, None)
+    assert t.reason == "no ice peak in the histogram"
+
+
+def test_inverted_cuts():
+    # dim ice cut by leads only a little darker, so the histogram has one
+    # peak and the cuts are inverted: the threshold is ow_cut_max everywhere
+    rng = np.random.default_rng(0)
+    red = rng.normal(60, 4, (600, 700))
+    red[::40] = rng.normal(50, 3, red[::40].shape)
+    red = np.clip(red, 1, 255).astype(np.uint8)
+    no_mask = np.zeros(red.shape, dtype=bool)
+    t = triage(red, no_mask, no_mask)
+    assert t.ow_cut_min > t.ow_cut_max
+    assert t.usable
+    assert t.ice_pixels > 0.9 * red.size
+
+    rgb = np.repeat(red[:, :, None], 3, axis=2)
+    result = segment(
+        rgb, no_mask, no_mask, SegmentationParams(triage=TriageThresholds())
+    )
+    assert result.skipped is None
+    assert result.labels.any()
+
+
+def write_tci(path, rgb):
+    height, width, _ = rgb.shape
+    profile = dict(driver="GTiff", width=width, height=height, count=3, dtype="uint8")
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(np.moveaxis(rgb, 2, 0))
+
+
+def test_skipped_scene_has_empty_outputs(tmp_path):
+    red, cloud_mask, land_mask = scene()
+    cloud_mask[:, 35:] = True
+    rgb = np.repeat(red[:, :, None], 3, axis=2)
+    thresholds = TriageThresholds(max_cloud_fraction=0.9)
+    result = segment(rgb, cloud_mask, land_mask, SegmentationParams(triage=thresholds))
+    assert result.skipped.startswith("cloud fraction")
+    assert not result.labels.any()
+    assert result.unmasked == np.count_nonzero(~(cloud_mask | land_mask))
+
+    write_tci(tmp_path / "tci.tif", rgb)
+    with rasterio.open(tmp_path / "tci.tif") as tci:
+        write_segmentation(result, tci, tmp_path / "out", save_figs=True)
+
+    props = pd.read_csv(tmp_path / "out" / "props.csv", index_col=0)
+    assert len(props) == 0 and "area" in props.columns
+    with rasterio.open(tmp_path / "out" / "final.tif") as dataset:
+        assert not dataset.read(1).any()
+    assert (tmp_path / "out" / "triage.json").exists()
+    assert not (tmp_path / "out" / "ice_mask_hist.png").exists()
+
+
+def test_mask_values_of_both_satellites_of_a_day(tmp_path):
+    red, cloud_mask, land_mask = scene()
+    rgb = np.repeat(red[:, :, None], 3, axis=2)
+    clear = segment(rgb, cloud_mask, land_mask)
+    cloud_mask[:100] = True
+    clouded = segment(rgb, cloud_mask, land_mask)
+    assert clear.unmasked != clouded.unmasked
+
+    def mask_values(sat):
+        path = tmp_path / "out" / f"2012-08-01_{sat}_mask_values.txt"
+        return path.read_text().splitlines()
+
+    def row(result):
+        return f"214\t{result.ice_area}\t{result.unmasked}\t"
+
+    write_tci(tmp_path / "tci.tif", rgb)
+    with rasterio.open(tmp_path / "tci.tif") as tci:
+        for sat, result in [("terra", clear), ("aqua", clouded)]:
+            write_segmentation(
+                result, tci, tmp_path / "out", doy=214, sat=sat, res="2012-08-01"
+            )
+        (terra,), (aqua,) = mask_values("terra"), mask_values("aqua")
+        assert terra.startswith(row(clear)) and aqua.startswith(row(clouded))
+
+        # processing a scene again replaces its row
+        write_segmentation(
+            clouded, tci, tmp_path / "out", doy=214, sat="terra", res="2012-08-01"
+        )
+        (terra,), (aqua,) = mask_values("terra"), mask_values("aqua")
+        assert terra.startswith(row(clouded)) and aqua.startswith(row(clouded))
+
+
+def test_quicklook_of_a_skipped_scene_is_masked(tmp_path):
+    red, cloud_mask, land_mask = scene()
+    cloud_mask[:, 35:] = True
+    rgb = np.repeat(red[:, :, None], 3, axis=2)
+    write_tci(tmp_path / "tci.tif", rgb)
+    with rasterio.open(tmp_path / "tci.tif") as tci:
+        result = segment_and_write(
+            tci,
+            rgb.copy(),
+            cloud_mask,
+            land_mask,
+            SegmentationParams(triage=TriageThresholds(max_cloud_fraction=0.9)),
+            save_figs=False,
+            save_direc=tmp_path / "out",
+            quicklook_factor=1,
+        )
+    assert result.skipped
+    preview = cv2.imread(str(tmp_path / "out" / "quicklook.png"))
+    true_color = preview[:, : red.shape[1]]
+    assert not true_color[land_mask | cloud_mask].any()
+    assert true_color[~(land_mask | cloud_mask)].any()
+
+
+def test_triage_does_not_change_usable_scenes():
+    red, cloud_mask, land_mask = scene()
+    rgb = np.repeat(red[:, :, None], 3, axis=2)
+    expected = segment(rgb, cloud_mask, land_mask)
+    result = segment(
+        rgb, cloud_mask, land_mask, SegmentationParams(triage=TriageThresholds())
+    )
+    assert result.skipped is None
+    np.testing.assert_array_equal(result.labels, expected.labels)
+    pd.testing.assert_frame_equal(result.props, expected.props)
@@ -1,7 +1,12 @@
 import numpy as np
 
 from ebfloeseg.utils import (
+    RED_BINS,
     write_mask_values,
+    write_mask_sums,
+    get_scene_stats,
+    get_wcuts,
+    get_wcuts_from_histogram,
     get_region_properties,
     imshow,
     getdoy,
@@ -69,3 +74,70 @@ def test_imshow():
     img = np.random.choice([False, True], size=(1, 1))
     imshow(img, show=False)
     assert True
+
+
+def test_get_scene_stats_matches_histogram():
+    rng = np.random.default_rng(42)
+    red_masked = rng.integers(0, 256, size=(300, 200), dtype=np.uint8)
+    land_cloud_mask = rng.choice([False, True], size=(300, 200))
+
+    stats = get_scene_stats(red_masked, land_cloud_mask)
+
+    expected, _ = np.histogram(red_masked.flatten(), bins=RED_BINS)
+    np.testing.assert_array_equal(stats.histogram(), expected)
+    assert stats.red_counts.sum() == red_masked.size
+    assert stats.unmasked == np.sum(~land_cloud_mask)
+
+
+def test_get_scene_stats_with_stride():
+    red_masked = np.arange(100, dtype=np.uint8).reshape(10, 10)
+    stats = get_scene_stats(red_masked, np.zeros((10, 10), dtype=bool), stride=2)
+    assert stats.red_counts.sum() == 25
+    assert stats.unmasked == 100
+
+
+def test_get_wcuts_from_histogram_matches_get_wcuts():
+    rng = np.random.default_rng(0)
+    red_masked = np.concatenate(
+        [rng.normal(60, 10, 5000), rng.normal(200, 15, 5000)]
+    ).clip(0, 255)
+    red_masked = red_masked.astype(np.uint8).reshape(100, 100)
+
+    ow_cut_min, ow_cut_max, bins = get_wcuts(red_masked)
+
+    hist = get_scene_stats(red_masked, np.zeros((100, 100), dtype=bool)).histogram()
+    assert get_wcuts_from_histogram(hist, bins) == (ow_cut_min, ow_cut_max)
+
+
+def test_write_mask_sums(tmpdir):
+    write_mask_sums(
+        ice_mask_sum=3,
+        land_cloud_mask_sum=6,
+        doy="214",
+        save_direc=tmpdir,
+        fname="mask_values.txt",
+    )
+
+    with open(tmpdir / "mask_values.txt", "r") as f:
+        assert f.readline() == "214\t3\t6\t0.5\n"
+
+
+def test_write_mask_sums_appends_or_replaces(tmp_path):
+    def write(ice_mask_sum, fname, replace=False):
+        write_mask_sums(
+            ice_mask_sum=ice_mask_sum,
+            land_cloud_mask_sum=10,
+            doy="214",
+            save_direc=tmp_path,
+            fname=fname,
+            replace=replace,
+        )
+
+    write(3, "shared.txt")
+    write(4, "shared.txt")
+    assert (tmp_path / "shared.txt").read_text() == "214\t3\t10\t0.3\n214\t4\t10\t0.4\n"
+
+    write(3, "scene.txt", replace=True)
+    write(4, "scene.txt", replace=True)
+    assert (tmp_path / "scene.txt").read_text() == "214\t4\t10\t0.4\n"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["scene.txt", "shared.txt"]
@@ -0,0 +1,70 @@
+import datetime
+from pathlib import Path
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.errors import WindowError
+from rasterio.windows import Window
+
+from ebfloeseg.bbox import BoundingBox
+from ebfloeseg.preprocess import preprocess_b
+from ebfloeseg.window import SceneWindow, WindowUnits
+
+test_dir = Path(__file__).parent
+truecolor = test_dir / "process/truecolor.tiff"
+
+# The truecolor test image has 250 m pixels and its top left corner at
+# (381550, -899225), so these windows cover the same pixels.
+pixel_window = SceneWindow(BoundingBox(100, 50, 400, 250), WindowUnits.pixel)
+crs_window = SceneWindow(BoundingBox(406550, -961725, 481550, -911725))
+
+
+@pytest.mark.parametrize("window", [pixel_window, crs_window])
+def test_to_window(window):
+    with rasterio.open(truecolor) as dataset:
+        assert window.to_window(dataset) == Window(100, 50, 300, 200)
+
+
+def test_to_window_is_clipped_to_the_dataset():
+    window = SceneWindow((1000, 400, 2000, 1000), "pixel")
+    with rasterio.open(truecolor) as dataset:
+        assert window.to_window(dataset) == Window(1000, 400, 78, 13)
+
+
+def test_to_window_outside_the_dataset():
+    window = SceneWindow((0, 0, 1000, 1000))
+    with rasterio.open(truecolor) as dataset, pytest.raises(WindowError):
+        window.to_window(dataset)
+
+
+def _process(window, save_direc):
+    preprocess_b(
+        ftci=truecolor,
+        fcloud=test_dir / "process/cloud.tiff",
+        fland=test_dir / "process/landmask.tiff",
+        save_figs=False,
+        save_direc=save_direc,
+        fname_prefix="",
+        itmax=8,
+        itmin=3,
+        step=-1,
+        erosion_kernel_type="diamond",
+        erosion_kernel_size=1,
+        date=datetime.date.fromisoformat("2001-01-01"),
+        window=window,
+    )
+    return rasterio.open(save_direc / "final.tif")
+
+
+def test_windowed_processing_is_georeferenced(tmp_path):
+    with (
+        _process(pixel_window, tmp_path / "pixel") as by_pixel,
+        _process(crs_window, tmp_path / "crs") as by_crs,
+        rasterio.open(truecolor) as full,
+    ):
+        assert by_pixel.shape == (200, 300)
+        assert by_pixel.transform == full.window_transform(Window(100, 50, 300, 200))
+        assert by_pixel.crs == full.crs
+        assert by_crs.transform == by_pixel.transform
+        assert np.array_equal(by_crs.read(), by_pixel.read())
@@ -0,0 +1,184 @@
+import multiprocessing
+import os
+import time
+
+from ebfloeseg.batch import Task, run_tasks
+from ebfloeseg.workqueue import WorkQueue, process_queue, write_queue_report
+
+
+def record(path, name):
+    # fails if the item is processed twice
+    fd = os.open(path / name, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    os.write(fd, str(os.getpid()).encode())
+    os.close(fd)
+    time.sleep(0.05)
+
+
+def drain(queue_dir, out):
+    queue = WorkQueue(queue_dir, lease_duration=5)
+    for i in range(20):
+        queue.add(f"item{i:02}", {"name": f"item{i:02}", "cost": i})
+    process_queue(
+        queue,
+        lambda item: Task(item["name"], record, (out, item["name"])),
+        poll_interval=0.1,
+        max_workers=2,
+    )
+
+
+def test_several_processes_share_a_queue(tmp_path):
+    out = tmp_path / "out"
+    out.mkdir()
+    processes = [
+        multiprocessing.Process(target=drain, args=(tmp_path / "queue", out))
+        for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    assert sorted(p.name for p in out.iterdir()) == [f"item{i:02}" for i in range(20)]
+    # the work was spread over the processes
+    assert len({p.read_text() for p in out.iterdir()}) > 1
+
+    queue = WorkQueue(tmp_path / "queue")
+    assert queue.remaining() == []
+    assert list(queue.leases_direc.iterdir()) == []
+    report = write_queue_report(queue, tmp_path / "report.json")
+    assert report["summary"]["succeeded"] == 20
+
+
+def test_claim_order_and_exclusivity(tmp_path):
+    first = WorkQueue(tmp_path, lease_duration=60)
+    second = WorkQueue(tmp_path, lease_duration=60)
+    for key, cost in [("a", 1), ("b", 3), ("c", 2)]:
+        assert first.add(key, {"cost": cost})
+    assert not second.add("a", {"cost": 100})
+
+    def by_cost(key, item):
+        return -item["cost"]
+
+    assert first.claim(order=by_cost) == ("b", {"cost": 3})
+    assert second.claim(order=by_cost) == ("c", {"cost": 2})
+    assert first.claim(order=by_cost) == ("a", {"cost": 1})
+    assert second.claim(order=by_cost) is None
+
+    first.complete("a", {"status": "succeeded"})
+    second.release("c")
+    assert first.remaining() == ["b", "c"]
+    assert second.claim(order=by_cost) == ("c", {"cost": 2})
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    dead = WorkQueue(tmp_path, lease_duration=60, owner="dead")
+    dead.add("a", {})
+    assert dead.claim() == ("a", {})
+
+    alive = WorkQueue(tmp_path, lease_duration=60, owner="alive")
+    assert alive.claim() is None
+
+    # the dead process stopped renewing its lease long ago
+    old = time.time() - 120
+    os.utime(tmp_path / "leases" / "a", (old, old))
+    assert alive.claim() == ("a", {})
+    assert (tmp_path / "leases" / "a").read_text() == "alive"
+
+    # releasing a lease which was taken over leaves it alone
+    dead.release("a")
+    assert (tmp_path / "leases" / "a").exists()
+
+
+def expire(queue, key):
+    old = time.time() - 2 * queue.lease_duration
+    os.utime(queue.leases_direc / key, (old, old))
+
+
+def test_slow_owner_drops_a_lease_taken_over(tmp_path):
+    slow = WorkQueue(tmp_path, lease_duration=60, owner="slow")
+    slow.add("a", {})
+    assert slow.claim() == ("a", {})
+    expire(slow, "a")
+    other = WorkQueue(tmp_path, lease_duration=60, owner="other")
+    assert other.claim() == ("a", {})
+    lease_mtime = (tmp_path / "leases" / "a").stat().st_mtime
+
+    # the slow process notices when renewing, and doesn't touch the new lease
+    time.sleep(0.01)
+    slow.renew()
+    assert slow.held == set()
+    assert (tmp_path / "leases" / "a").stat().st_mtime == lease_mtime
+
+    assert not slow.complete("a", {"status": "succeeded", "owner": "slow"})
+    assert not slow.is_done("a")
+    assert other.complete("a", {"status": "succeeded", "owner": "other"})
+    assert other.results() == {"a": {"status": "succeeded", "owner": "other"}}
+
+
+def test_expired_lease_is_taken_over_once(tmp_path):
+    dead = WorkQueue(tmp_path, lease_duration=60, owner="dead")
+    dead.add("a", {})
+    assert dead.claim() == ("a", {})
+    expire(dead, "a")
+
+    # both saw the expired lease, but only the first takes it over
+    first = WorkQueue(tmp_path, lease_duration=60, owner="first")
+    second = WorkQueue(tmp_path, lease_duration=60, owner="second")
+    assert first._take_over("a")
+    assert not second._take_over("a")
+    assert (tmp_path / "leases" / "a").read_text() == "first"
+    assert second.held == set()
+
+
+def test_takeover_in_progress_is_left_alone(tmp_path):
+    dead = WorkQueue(tmp_path, lease_duration=60, owner="dead")
+    dead.add("a", {})
+    assert dead.claim() == ("a", {})
+    expire(dead, "a")
+
+    takeover = tmp_path / "leases" / ".a.takeover"
+    takeover.touch()
+    alive = WorkQueue(tmp_path, lease_duration=60, owner="alive")
+    assert alive.claim() is None
+
+    # the process taking over died too
+    old = time.time() - 120
+    os.utime(takeover, (old, old))
+    assert alive.claim() is None
+    assert not takeover.exists()
+    assert alive.claim() == ("a", {})
+
+
+def test_renewed_lease_is_kept(tmp_path):
+    owner = WorkQueue(tmp_path, lease_duration=0.4)
+    owner.add("a", {})
+    other = WorkQueue(tmp_path, lease_duration=0.4)
+    with owner:
+        assert owner.claim() == ("a", {})
+        time.sleep(1)
+        assert other.claim() is None
+    # leases are released when leaving the context
+    assert other.claim() == ("a", {})
+
+
+def test_run_tasks_claims_tasks(tmp_path):
+    names = iter(["a", "b", "c"])
+    finished = []
+
+    def claim():
+        name = next(names, None)
+        return None if name is None else Task(name, record, (tmp_path, name))
+
+    results = run_tasks(
+        [],
+        max_workers=2,
+        claim=claim,
+        on_result=lambda task, result: finished.append((task.name, result.status)),
+    )
+    assert [result.name for result in results] == ["a", "b", "c"]
+    assert sorted(finished) == [
+        ("a", "succeeded"),
+        ("b", "succeeded"),
+        ("c", "succeeded"),
+    ]